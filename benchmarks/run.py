@@ -0,0 +1,310 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Benchmark suite over a synthetic CPAC archive.
+
+    python -m benchmarks.run --scale 4 --output results.json
+    python -m benchmarks.run --scale 4 --compare results.json
+
+Each stage is run ``--repeat`` times and the best time is reported,
+along with throughput and the peak Python heap usage of one extra,
+untimed run under tracemalloc. Full CLI runs also report the peak RSS of
+the child process. Results are written as JSON together with the commit
+and settings they were measured with, and ``--compare`` prints speedups
+against an earlier results file.
+"""
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+from gtcpacdump import stats
+from gtcpacdump.compression import stock_decompress
+from gtcpacdump.cpac import CPAC
+from gtcpacdump.encoders import COMPRESSORS
+from gtcpacdump.subarchive import SubArchive
+from gtcpacdump.tiledimage import TiledImage
+
+from .startup import measure_startup
+from .synthetic import generate
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+GHOSTTRICK = REPO_ROOT / "ghosttrick.py"
+MB = 1 << 20
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def measure(fn, repeat: int) -> dict:
+    """
+    Time ``fn`` and measure its peak heap usage. ``fn`` returns a dict of
+    work counts (bytes, tiles, images...) used for throughput.
+    """
+    times = []
+    work = {}
+    for _ in range(repeat):
+        start = perf_counter()
+        work = fn()
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best = min(times)
+    result = {"seconds": best, "runs": times, "peak_heap_bytes": peak}
+    for name, amount in work.items():
+        result[name] = amount
+        result[f"{name}_per_s"] = amount / best if best else None
+    return result
+
+
+def load_all(cpac_path: Path, mode: str):
+    """
+    Parse everything up front so each stage measures only itself.
+    """
+    cpac = CPAC(cpac_path)
+    cpac.parse_subfiles()
+    subarchives = []
+    for i in range(len(cpac.subarchives)):
+        subarchive = SubArchive(cpac.open(i))
+        subarchive.parse()
+        subarchives.append(subarchive)
+    compressed = []
+    images = []
+    tile_size = (8, 8) if mode == "nds" else (16, 16)
+    for subarchive in subarchives:
+        for i in range(1, len(subarchive.subfiles)):
+            sf = subarchive.subfiles[i]
+            if sf.size is None:
+                continue
+            raw = bytes(subarchive.open(i, skip_decompression=True))
+            if sf.compressed:
+                compressed.append(raw)
+            data = stock_decompress(raw) if sf.compressed else raw
+            try:
+                image = TiledImage(data, tile_size)
+                image.parse()
+            except ValueError:
+                continue
+            images.append((data, image))
+    return cpac, subarchives, compressed, images, tile_size
+
+
+def bench_in_process(cpac_path: Path, mode: str, repeat: int) -> dict:
+    cpac, subarchives, compressed, images, tile_size = load_all(
+        cpac_path, mode
+    )
+    raw_subarchives = [cpac.open(i) for i in range(len(cpac.subarchives))]
+    decompressed_size = sum(len(stock_decompress(c)) for c in compressed)
+    tile_count = sum(len(image.tiles) for _, image in images)
+
+    def parse_cpac():
+        CPAC(cpac_path).parse_subfiles()
+        return {"subarchives": len(cpac.subarchives)}
+
+    def parse_subarchives():
+        for raw in raw_subarchives:
+            SubArchive(raw).parse()
+        return {"subarchives": len(raw_subarchives)}
+
+    def decompress(engine):
+        def run():
+            for data in compressed:
+                stock_decompress(data, engine)
+            return {"MB": decompressed_size / MB}
+        return run
+
+    originals = [stock_decompress(c) for c in compressed]
+
+    def compress(method):
+        def run():
+            out = sum(len(COMPRESSORS[method](data)) for data in originals)
+            return {"MB": decompressed_size / MB, "out": out}
+        return run
+
+    def parse_images():
+        for data, _ in images:
+            TiledImage(data, tile_size).parse()
+        return {"images": len(images), "tiles": tile_count}
+
+    def dump_images():
+        for _, image in images:
+            image.dump(False)
+        return {"images": len(images), "tiles": tile_count}
+
+    results = {
+        "CPAC.parse_subfiles": measure(parse_cpac, repeat),
+        "SubArchive.parse": measure(parse_subarchives, repeat),
+        "stock_decompress": measure(decompress("fast"), repeat),
+        "stock_decompress[stream]": measure(decompress("stream"), 1),
+        "TiledImage.parse": measure(parse_images, repeat),
+        "TiledImage.dump": measure(dump_images, repeat),
+    }
+    for method in sorted(COMPRESSORS):
+        result = measure(compress(method), 1)
+        # Output size over input size, lower is better
+        result["ratio"] = result.pop("out") / max(decompressed_size, 1)
+        del result["out_per_s"]
+        results[f"stock_compress[{method}]"] = result
+    return results
+
+
+def bench_cli(cpac_path: Path, mode: str, jobs: int, repeat: int) -> dict:
+    images = None
+    results = {"cli.startup": measure_startup(cpac_path)}
+    commands = {
+        "cli.list_subarchives": ["list_subarchives"],
+        "cli.subarchive_images": ["subarchive_images", "--mode", mode, "0"],
+        "cli.dump_all": ["dump_all", "--mode", mode, "-j", str(jobs)],
+    }
+    for name, command in commands.items():
+        times = []
+        peak_rss = 0
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as output_dir:
+                argv = [
+                    sys.executable, str(GHOSTTRICK), "-q",
+                    "-i", str(cpac_path), *command,
+                ]
+                if name != "cli.list_subarchives":
+                    argv.append(output_dir)
+                start = perf_counter()
+                subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+                times.append(perf_counter() - start)
+                images = len(list(Path(output_dir).glob("**/*.png")))
+            # ru_maxrss of children is the largest of any child so far;
+            # kilobytes on Linux.
+            peak_rss = max(
+                peak_rss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            )
+        best = min(times)
+        results[name] = {
+            "seconds": best,
+            "runs": times,
+            "peak_rss_kb": peak_rss,
+        }
+        if images:
+            results[name]["images"] = images
+            results[name]["images_per_s"] = images / best
+    return results
+
+
+def compare(current: dict, previous: dict):
+    print(
+        f"{'benchmark':<28} {'before':>10} {'after':>10} {'speedup':>8}"
+        f"    ({previous['meta']['commit']} -> {current['meta']['commit']})"
+    )
+    for name, result in current["results"].items():
+        before = previous["results"].get(name)
+        if before is None:
+            continue
+        print(
+            f"{name:<28} {before['seconds']:>9.4f}s "
+            f"{result['seconds']:>9.4f}s "
+            f"{before['seconds'] / result['seconds']:>7.2f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark gtCPACdump on a synthetic CPAC file."
+    )
+    parser.add_argument(
+        "--scale", type=int, default=1,
+        help="Number of subarchives is 4 * SCALE (default: 1)"
+    )
+    parser.add_argument("--subfiles", type=int, default=32)
+    parser.add_argument("--max-tiles", type=int, default=16)
+    parser.add_argument("--mode", choices=["nds", "ios"], default="nds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=2)
+    parser.add_argument(
+        "--no-cli", action="store_true", help="Skip the full CLI runs"
+    )
+    parser.add_argument(
+        "--cpac", type=Path,
+        help="Benchmark this CPAC file instead of generating one"
+    )
+    parser.add_argument("--output", type=Path, help="Write results here")
+    parser.add_argument(
+        "--compare", type=Path, help="Print speedups against these results"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.cpac is not None:
+            cpac_path = args.cpac
+            archive = {"path": str(cpac_path)}
+        else:
+            cpac_path = Path(tmp) / "cpac_2d.bin"
+            archive = generate(
+                cpac_path,
+                subarchives=4 * args.scale,
+                subfiles=args.subfiles,
+                tile_size=8 if args.mode == "nds" else 16,
+                max_tiles=args.max_tiles,
+                seed=args.seed,
+            )
+        # Keep the library quiet and uninstrumented while timing it.
+        stats.enabled = False
+        results = bench_in_process(cpac_path, args.mode, args.repeat)
+        if not args.no_cli:
+            results.update(
+                bench_cli(cpac_path, args.mode, args.jobs, args.repeat)
+            )
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {
+                k: str(v) if isinstance(v, Path) else v
+                for k, v in vars(args).items()
+            },
+            "archive": archive,
+            "peak_rss_kb": resource.getrusage(
+                resource.RUSAGE_SELF
+            ).ru_maxrss,
+        },
+        "results": results,
+    }
+    for name, result in results.items():
+        rates = ", ".join(
+            f"{result[k]:.1f} {k[:-6]}/s"
+            for k in result
+            if k.endswith("_per_s") and result[k] is not None
+        )
+        if "ratio" in result:
+            rates += f", ratio {result['ratio']:.3f}"
+        print(f"{name:<28} {result['seconds']:>9.4f}s  {rates}")
+    if args.output is not None:
+        with args.output.open("w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with args.compare.open() as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
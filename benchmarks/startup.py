@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+CLI startup time benchmark.
+
+Times ``ghosttrick.py list_subarchives`` against a bare interpreter
+start, and checks which heavy modules the listing path imported. Exits
+with status 1 if the overhead over a bare interpreter exceeds
+``--target-ms`` or PIL/NumPy got imported.
+
+    python -m benchmarks.startup --target-ms 100
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from .synthetic import generate
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+GHOSTTRICK = REPO_ROOT / "ghosttrick.py"
+HEAVY_MODULES = ("PIL", "numpy")
+DEFAULT_TARGET_MS = 100
+
+
+def _median_runtime(argv, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+def heavy_imports(argv) -> list:
+    """
+    Return the heavy top-level modules imported while running ``argv``
+    (a ghosttrick.py command line without the interpreter).
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *argv],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            imported.add(name.split(".")[0])
+    return sorted(imported.intersection(HEAVY_MODULES))
+
+
+def measure_startup(cpac_path: Path, runs: int = 10) -> dict:
+    argv = [str(GHOSTTRICK), "-q", "-i", str(cpac_path), "list_subarchives"]
+    # Build the layout index first so it doesn't count against startup.
+    subprocess.run(
+        [sys.executable, *argv], check=True, stdout=subprocess.DEVNULL
+    )
+    baseline = _median_runtime([sys.executable, "-c", "pass"], runs)
+    listing = _median_runtime([sys.executable, *argv], runs)
+    return {
+        "seconds": listing,
+        "interpreter_seconds": baseline,
+        "overhead_ms": (listing - baseline) * 1000,
+        "heavy_imports": heavy_imports(argv),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure ghosttrick.py startup time."
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--target-ms", type=float, default=DEFAULT_TARGET_MS,
+        help="Maximum overhead over a bare interpreter start "
+             f"(default: {DEFAULT_TARGET_MS})"
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        cpac_path = Path(tmp) / "cpac_2d.bin"
+        generate(cpac_path, subarchives=4, subfiles=4)
+        result = measure_startup(cpac_path, args.runs)
+    print(
+        f"list_subarchives: {result['seconds'] * 1000:.1f}ms "
+        f"(interpreter: {result['interpreter_seconds'] * 1000:.1f}ms, "
+        f"overhead: {result['overhead_ms']:.1f}ms, "
+        f"target: {args.target_ms:.0f}ms)"
+    )
+    ok = result["overhead_ms"] <= args.target_ms
+    if result["heavy_imports"]:
+        print(f"Imported heavy modules: {', '.join(result['heavy_imports'])}")
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
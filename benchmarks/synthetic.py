@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Synthetic cpac_2d.bin generator.
+
+Builds CPAC files with the same structure as the retail one: a header
+of offset/size pairs, subarchives with TADB/TADP data and YEKB/YEKP
+table sections, and subfiles that are 4bpp and 8bpp tiled images,
+stored or LZ77-compressed in both the short and long-length variants.
+Output is fully determined by the arguments, so benchmark results are
+comparable across commits.
+
+    python -m benchmarks.synthetic cpac_2d.bin --subarchives 16
+"""
+import argparse
+import random
+import struct
+from pathlib import Path
+from typing import List, Tuple
+
+# (data, compressed)
+SubfileData = Tuple[bytes, bool]
+
+
+def lz77_compress(data: bytes, longlengths: bool = False) -> bytes:
+    """
+    Greedy LZ77 compressor producing data stock_decompress can read.
+
+    Only looks at the most recent occurrence of each 3-byte prefix, which
+    is plenty for generating test data.
+    """
+    header = 0x11 if longlengths else 0x10
+    out = bytearray(struct.pack("<I", header | (len(data) << 8)))
+    max_length = 0x10110 if longlengths else 18
+    last_seen = {}
+    pos = 0
+    while pos < len(data):
+        flag_pos = len(out)
+        out.append(0)
+        for bit in range(8):
+            if pos >= len(data):
+                break
+            key = data[pos:pos + 3]
+            candidate = last_seen.get(key)
+            last_seen[key] = pos
+            length = 0
+            if candidate is not None and pos - candidate <= 0x1000:
+                limit = min(max_length, len(data) - pos)
+                while (
+                    length < limit
+                    and data[candidate + length] == data[pos + length]
+                ):
+                    length += 1
+            if length < 3:
+                out.append(data[pos])
+                pos += 1
+                continue
+            out[flag_pos] |= 0x80 >> bit
+            distance = pos - candidate - 1
+            if not longlengths:
+                out.append(((length - 3) << 4) | (distance >> 8))
+            elif length <= 0x10:
+                out.append(((length - 1) << 4) | (distance >> 8))
+            elif length <= 0x110:
+                length_bits = length - 0x11
+                out.append(length_bits >> 4)
+                out.append(((length_bits & 0xF) << 4) | (distance >> 8))
+            else:
+                length_bits = length - 0x111
+                out.append(0x10 | (length_bits >> 12))
+                out.append((length_bits >> 4) & 0xFF)
+                out.append(((length_bits & 0xF) << 4) | (distance >> 8))
+            out.append(distance & 0xFF)
+            for skipped in range(pos + 1, min(pos + length, len(data) - 2)):
+                last_seen[data[skipped:skipped + 3]] = skipped
+            pos += length
+    return bytes(out)
+
+
+def make_image(
+    rng: random.Random, width: int, height: int, bpp: int, tile_size: int
+) -> bytes:
+    """
+    Make a tiled image subfile. Tiles are drawn from a small pool, like
+    backgrounds and sprites are, so the data compresses realistically.
+    """
+    header = struct.pack(
+        "<HH", width, height | (0x8000 if bpp == 4 else 0)
+    ).ljust(512, b"\0")
+    palette_size = 16 if bpp == 4 else 256
+    palette = struct.pack(
+        f"<{palette_size}H",
+        *(rng.randrange(0x8000) for _ in range(palette_size)),
+    )
+    tile_bytes = tile_size * tile_size * bpp // 8
+    pool = [
+        bytes(rng.randrange(256) for _ in range(tile_bytes))
+        for _ in range(8)
+    ]
+    pool.append(bytes(tile_bytes))
+    tile_count = (width // tile_size) * (height // tile_size)
+    tiles = b"".join(rng.choice(pool) for _ in range(tile_count))
+    return header + palette + tiles
+
+
+def make_subarchive(files: List[SubfileData], yekp: bool = False) -> bytes:
+    table_name, data_name = (b"YEKP", b"TADP") if yekp else (b"YEKB", b"TADB")
+    table_offset = 8 + 2 * 8
+    data = bytearray()
+    table = bytearray()
+    for payload, compressed in files:
+        flag = 0x80000000 if compressed else 0
+        if yekp:
+            table += struct.pack("<I", len(data) | flag)
+        else:
+            table += struct.pack("<II", len(data), len(payload) | flag)
+        data += payload
+        data += bytes(-len(data) % 4)
+    if yekp:
+        # readYEKP doesn't size the last three entries
+        table += struct.pack("<3I", *([len(data)] * 3))
+        data += bytes(16)
+    data_base_offset = table_offset + len(table)
+    header = struct.pack("<II", 0, 2)
+    header += table_name + struct.pack("<I", table_offset)
+    header += data_name + struct.pack("<I", data_base_offset)
+    return header + bytes(table) + bytes(data)
+
+
+def make_cpac(subarchives: List[bytes]) -> bytes:
+    pointers = []
+    body = bytearray()
+    offset = 8 * len(subarchives)
+    for subarchive in subarchives:
+        pointers.append((offset + len(body), len(subarchive)))
+        body += subarchive
+        body += bytes(-(offset + len(body)) % 16)
+    header = b"".join(struct.pack("<II", *p) for p in pointers)
+    return header + bytes(body)
+
+
+def generate(
+    path: Path,
+    subarchives: int = 8,
+    subfiles: int = 32,
+    tile_size: int = 8,
+    max_tiles: int = 8,
+    seed: int = 0,
+) -> dict:
+    """
+    Write a synthetic CPAC file and return a summary of what's in it.
+
+    Images are up to ``max_tiles`` tiles on each side (rounded to whole
+    2x2 big tiles). Subfile kinds cycle through stored, short LZ77 and
+    long-length LZ77, and bpp alternates between 4 and 8.
+    """
+    rng = random.Random(seed)
+    summary = {
+        "subarchives": subarchives,
+        "subfiles": 0,
+        "images": 0,
+        "tiles": 0,
+        "decompressed_bytes": 0,
+        "compressed_bytes": 0,
+    }
+    built = []
+    for i in range(subarchives):
+        files = [(bytes(16), False)]
+        for j in range(subfiles):
+            bpp = 4 if j % 2 == 0 else 8
+            width = tile_size * 2 * rng.randrange(1, max_tiles // 2 + 1)
+            height = tile_size * 2 * rng.randrange(1, max_tiles // 2 + 1)
+            image = make_image(rng, width, height, bpp, tile_size)
+            summary["images"] += 1
+            summary["tiles"] += (width // tile_size) * (height // tile_size)
+            kind = j % 3
+            if kind == 0:
+                files.append((image, False))
+            else:
+                compressed = lz77_compress(image, longlengths=kind == 2)
+                summary["decompressed_bytes"] += len(image)
+                summary["compressed_bytes"] += len(compressed)
+                files.append((compressed, True))
+        summary["subfiles"] += len(files)
+        built.append(make_subarchive(files, yekp=i % 2 == 1))
+    data = make_cpac(built)
+    path.write_bytes(data)
+    summary["size"] = len(data)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic cpac_2d.bin."
+    )
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--subarchives", type=int, default=8)
+    parser.add_argument("--subfiles", type=int, default=32)
+    parser.add_argument(
+        "--mode", choices=["nds", "ios"], default="nds",
+        help="Tile size: 8x8 for 'nds' (default), 16x16 for 'ios'"
+    )
+    parser.add_argument("--max-tiles", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(
+        generate(
+            args.output,
+            args.subarchives,
+            args.subfiles,
+            8 if args.mode == "nds" else 16,
+            args.max_tiles,
+            args.seed,
+        )
+    )
@@ -2,82 +2,1344 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 import argparse
+import json
+import logging
+import os
+import sys
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
+from time import perf_counter
 
-from gtcpacdump.common import OKBLUE, OKGREEN, WARNING, FAIL, ENDC, BOLD
+from gtcpacdump import stats
+from gtcpacdump.cache import DecompressionCache
+from gtcpacdump.common import (
+    OKBLUE, OKGREEN, WARNING, FAIL, ENDC, BOLD, ColorFormatter, content_hash,
+    content_hasher, read_error,
+)
+from gtcpacdump.compression import decompress_stream
 from gtcpacdump.cpac import CPAC
+from gtcpacdump.encoders import COMPRESSORS
+from gtcpacdump.index import CPACIndex
+from gtcpacdump.manifest import Manifest, entry_is_current, make_entry
+from gtcpacdump.output import (
+    ARCHIVE_FORMATS, IMAGE_FORMATS, BackgroundWriter, DirectoryOutput,
+    encode_image, encode_png, image_file_name, open_new, open_output,
+)
+from gtcpacdump.repack import (
+    LAYOUT_FILE, pack_directory, repack_cpac, unpack_subarchive,
+)
+from gtcpacdump.report import FailureReport, describe_error, wanted
+from gtcpacdump.splitarchive import SplitArchive
 from gtcpacdump.subarchive import SubArchive
 
 BGS_SUBARCHIVE_IDX = 4
+# Tiles per row of --tilemap sheets: 256px, a screen's width in NDS mode
+TILEMAP_COLUMNS = 32
+# Read size when streaming subfiles to disk
+CHUNK_SIZE = 1 << 16
+
+log = logging.getLogger("ghosttrick")
+
+
+def setup_logging(level: int):
+    handler = logging.StreamHandler()
+    handler.setFormatter(ColorFormatter("%(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
 
 
 class GhostTrickDumper:
-    def __init__(self, path_to_cpac: Path):
-        print(
-            f"{OKBLUE}{BOLD}Initializing "
-            f"{WARNING}Ghost Trick CPAC dumper{ENDC}{BOLD}{OKBLUE}.{ENDC}"
-        )
+    def __init__(
+        self,
+        path_to_cpac: Path,
+        use_mmap: bool = False,
+        cache: DecompressionCache = None,
+    ):
+        log.info("Initializing Ghost Trick CPAC dumper.")
         self.path_to_cpac2d = path_to_cpac
-        self.cpac = CPAC(self.path_to_cpac2d)
+        self.cache = cache
+        self.cpac = CPAC(self.path_to_cpac2d, use_mmap=use_mmap)
         self.cpac.parse_subfiles()
 
-    def load_subarchive(self, i: int) -> SubArchive:
-        print(
-            f"{BOLD}{OKBLUE}Loading subarchive {WARNING}{i}{OKBLUE}{BOLD}."
-            f" {ENDC}"
-        )
+    def load_subarchive(
+        self, i: int, report: FailureReport = None
+    ) -> SubArchive:
+        """
+        Parse subarchive ``i``, or log the error (recording it in
+        ``report`` if given) and return None.
+        """
+        log.info("Loading subarchive %d.", i)
         try:
-            subarchive = SubArchive(self.cpac.open(i))
+            subarchive = SubArchive(self.cpac.open(i), cache=self.cache)
             subarchive.parse()
-            print(f"{OKBLUE}Subarchive {WARNING}{i}{OKBLUE} loaded.{ENDC}")
+            log.debug("Subarchive %d loaded.", i)
             return subarchive
-        except ValueError as e:
-            print(f"{BOLD}{FAIL}ERROR: {WARNING}{e}.")
+        except (ValueError, IndexError, read_error) as e:
+            log.error("ERROR: subarchive %d: %s.", i, describe_error(e))
+            if report is not None:
+                offset = size = None
+                if 0 <= i < len(self.cpac.subarchives):
+                    offset, size = self.cpac.subarchives[i]
+                report.add(i, None, "subarchive", e, offset, size)
+
+    def locate(self, subarchive: SubArchive, i: int, j: int):
+        """
+        Absolute offset in the CPAC file and stored size of subfile ``j``
+        of the already loaded subarchive ``i``.
+        """
+        offset, size = subarchive.location(j)
+        return self.cpac.subarchives[i].offset + offset, size
 
 
 def init_dumper(args):
-    return GhostTrickDumper(args.input_file)
+    return GhostTrickDumper(
+        args.input_file, use_mmap=args.mmap, cache=init_cache(args)
+    )
+
+
+def cache_options(args):
+    return args.memory_cache << 20, args.cache_dir, args.cache_dir_size << 20
+
+
+def init_cache(args, options=None) -> DecompressionCache:
+    memory_limit, disk_dir, disk_limit = options or cache_options(args)
+    if not memory_limit and disk_dir is None:
+        return None
+    return DecompressionCache(memory_limit, disk_dir, disk_limit)
+
+
+def init_index(args) -> CPACIndex:
+    return CPACIndex.open(args.input_file, args.index)
+
+
+def load_retry(args):
+    """
+    Subarchive -> subfiles selection of the --retry-from report, or None
+    to process everything.
+    """
+    if args.retry_from is None:
+        return None
+    selection = FailureReport.load(args.retry_from).selection()
+    log.info("Retrying %d subarchives from %s.", len(selection),
+             args.retry_from)
+    return selection
+
+
+def add_failure(report: FailureReport, locate, i: int, j: int, stage: str,
+                error):
+    """
+    Record a subfile failure, with its location if ``locate(j)`` can
+    still find it.
+    """
+    log.error("ERROR: subfile %d/%d (%s): %s.", i, j, stage,
+              describe_error(error))
+    try:
+        offset, size = locate(j)
+    except Exception:
+        offset = size = None
+    report.add(i, j, stage, error, offset, size)
+
+
+def finish_report(args, report: FailureReport):
+    for failure in report:
+        location = f"subarchive {failure.subarchive}"
+        if failure.subfile is not None:
+            location += f", subfile {failure.subfile}"
+        if failure.offset is not None:
+            location += f" at {failure.offset}"
+            if failure.size is not None:
+                location += f"+{failure.size}"
+        print(f"{FAIL}Failed ({failure.stage}): {WARNING}{location}{ENDC} "
+              f"{failure.error}")
+    if args.report is not None:
+        report.save(args.report)
+        log.info("Wrote %d failures to %s.", len(report), args.report)
 
 
 def cmd_list_subarchives(args):
-    dumper = init_dumper(args)
-    for (offset, size) in dumper.cpac.subarchives:
+    if args.no_index:
+        subarchives = init_dumper(args).cpac.subarchives
+    else:
+        subarchives = init_index(args).pointers
+    for (offset, size) in subarchives:
         print(f"Offset: {offset}, size: {size}")
 
 
 def cmd_list_subfiles(args):
-    dumper = init_dumper(args)
-    subarchive = dumper.load_subarchive(args.subarchive_index)
+    if args.no_index:
+        dumper = init_dumper(args)
+        subarchive = dumper.load_subarchive(args.subarchive_index)
+        if subarchive is None:
+            return
+    else:
+        subarchive = init_index(args).subarchives[args.subarchive_index]
+        if subarchive.error is not None:
+            log.error("ERROR: %s.", subarchive.error)
+            return
     for sfe in subarchive.subfiles:
         print(f"Offset: {sfe.offset}, size: {sfe.size}, compressed:"
               f" {sfe.compressed}, ?: {sfe.unknown_flag}")
 
 
+def cmd_scan(args):
+    # Deferred: nothing else needs the classifier.
+    from gtcpacdump.classify import (
+        SCAN_CHUNK_SIZE, TILE_SIZES, classify_chunks,
+    )
+
+    tile_size = TILE_SIZES[args.mode]
+    if args.no_index:
+        dumper = init_dumper(args)
+        count = len(dumper.cpac.subarchives)
+
+        def load(i):
+            subarchive = dumper.load_subarchive(i)
+            if subarchive is None:
+                return None
+            return subarchive.subfiles, lambda j: subarchive.classify(
+                j, args.mode
+            )
+    else:
+        index = init_index(args)
+        count = len(index.subarchives)
+
+        def load(i):
+            subarchive = index.subarchives[i]
+            if subarchive.error is not None:
+                log.error("ERROR: %s.", subarchive.error)
+                return None
+
+            def classify(j):
+                _, size, entry = index.locate(i, j)
+                return classify_chunks(
+                    index.iter_subfile(i, j, SCAN_CHUNK_SIZE * 16),
+                    size, entry.compressed, tile_size,
+                )
+            return subarchive.subfiles, classify
+
+    catalog = []
+    totals = {}
+    for i in args.subarchive or range(count):
+        loaded = load(i)
+        if loaded is None:
+            continue
+        subfiles, classify = loaded
+        for j in range(len(subfiles)):
+            try:
+                info = classify(j)
+            except Exception as e:
+                log.error("ERROR: subfile %d/%d: %r.", i, j, e)
+                continue
+            totals[info.type] = totals.get(info.type, 0) + 1
+            if args.json:
+                catalog.append(dict(info._asdict(), subarchive=i, subfile=j))
+            else:
+                line = (
+                    f"{i}/{j}: {info.type}, {info.compression or 'none'}, "
+                    f"{info.stored_size} -> {info.size} bytes"
+                )
+                if info.type == "image":
+                    line += f", {info.width}x{info.height} {info.bpp}bpp"
+                print(line)
+    if args.json:
+        json.dump(catalog, sys.stdout, indent=1)
+        print()
+    else:
+        print(", ".join(f"{n} {kind}" for kind, n in sorted(totals.items())))
+
+
 def cmd_subarchive_images(args):
+    retry = load_retry(args)
+    report = FailureReport()
+    sa_index = args.subarchive_index
+    if not wanted(retry, sa_index):
+        finish_report(args, report)
+        return
     dumper = init_dumper(args)
-    subarchive = dumper.load_subarchive(args.subarchive_index)
-    output_dir = args.output_dir / str(args.subarchive_index)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    for i in range(1, len(subarchive.subfiles)):
-        im = subarchive.dump_image(i, args.mode)
-        im_path = output_dir / f"{i}.png"
-        with im_path.open("wb") as f:
-            im.save(f)
+    subarchive = dumper.load_subarchive(sa_index, report)
+    if subarchive is None:
+        finish_report(args, report)
+        return
+
+    def locate(j):
+        return dumper.locate(subarchive, sa_index, j)
+    try:
+        palettes = load_palettes(subarchive, args.palette_from, args.mode)
+    except ValueError as e:
+        log.error("ERROR: %s.", e)
+        finish_report(args, report)
+        return
+    output = open_output(
+        args.output_dir, str(args.subarchive_index), "images", args.archive
+    )
+    manifest = None
+    if args.incremental:
+        manifest = Manifest(output.directory, "images")
+    settings = image_settings(args, palettes)
+    dedup = init_dedup(args, output, "images")
+    # key -> first subfile with that content and settings
+    primaries = {}
+    duplicates = []
+    # Decoding stays on this thread; encoding and writing happen on the
+    # writer's.
+    with BackgroundWriter(output, keep_going=True) as writer:
+        for i in range(1, len(subarchive.subfiles)):
+            if not wanted(retry, sa_index, i):
+                continue
+            source_hash = key = None
+            stage = "read"
+            try:
+                if manifest is not None or dedup is not None:
+                    source_hash = content_hash(
+                        subarchive.open(i, skip_decompression=True)
+                    )
+                if manifest is not None:
+                    if manifest.is_current(i, source_hash, settings):
+                        continue
+                if dedup is not None:
+                    key = dedup.key(source_hash, settings)
+                    if is_duplicate(dedup, primaries, key, sa_index, i):
+                        duplicates.append((i, source_hash, key))
+                        continue
+                with decode_timing(dedup, key):
+                    stage = "classify"
+                    if subarchive.classify(i, args.mode).type != "image":
+                        log.debug("Skipping non-image subfile %d.", i)
+                        continue
+                    stage = "image"
+                    image = subarchive.load_image(i, args.mode)
+            except Exception as e:
+                add_failure(report, locate, sa_index, i, stage, e)
+                continue
+            stem = str(i)
+            if args.tilemap:
+                with decode_timing(dedup, key):
+                    image = submit_tilemap(
+                        writer, (i, source_hash), stem, image
+                    )
+                stem += ".tiles"
+            for suffix, (_, palette) in palettes.items():
+                try:
+                    image.bank_lut(palette, args.palette_bank)
+                except ValueError as e:
+                    add_failure(report, locate, sa_index, i, "palette", e)
+                    continue
+
+                def payload(image=image, palette=palette):
+                    return [
+                        encode_image(
+                            image, args.format, args.png_level,
+                            args.transparent, args.palette_bank, palette,
+                        )
+                    ]
+
+                if dedup is not None:
+                    payload = dedup.timed(key, payload)
+                writer.submit(
+                    (i, source_hash),
+                    image_file_name(stem + suffix, image, args.format),
+                    payload,
+                )
+        if dedup is not None:
+            finish_dedup(
+                dedup, writer, primaries, duplicates, sa_index, report,
+                locate, manifest, settings,
+            )
+    for (i, _), _, e in writer.errors:
+        add_failure(report, locate, sa_index, i, "write", e)
+    if manifest is not None:
+        record_outputs(manifest, sa_index, writer, settings)
+    finish_report(args, report)
+
+
+def submit_tilemap(writer: BackgroundWriter, key, stem: str, image):
+    """
+    Write the tilemap of ``image`` to ``stem.tilemap.json``, returning
+    the sheet of its unique tiles to render instead of it.
+    """
+    sheet = image.tile_sheet(TILEMAP_COLUMNS)
+    writer.submit(
+        key, f"{stem}.tilemap.json",
+        lambda: [
+            json.dumps(
+                image.tilemap(TILEMAP_COLUMNS), separators=(",", ":")
+            ).encode()
+        ],
+    )
+    return sheet
+
+
+def load_palettes(subarchive: SubArchive, sources, mode: str) -> dict:
+    """
+    Map output name suffixes to (source hash, palette) for every palette
+    images should be rendered against: the image's own (None) unless
+    ``sources`` lists subfiles to borrow palettes from.
+
+    Raises ValueError if a source isn't an image.
+    """
+    if not sources:
+        return {"": (None, None)}
+    palettes = {}
+    for j in sources:
+        try:
+            info = subarchive.classify(j, mode)
+            source = None
+            if info.type == "image":
+                source = subarchive.load_image(j, mode)
+        except (ValueError, IndexError, read_error) as e:
+            raise ValueError(
+                f"Can't read palette source {j}: {describe_error(e)}"
+            ) from e
+        if source is None:
+            raise ValueError(
+                f"Palette source {j} is {info.type}, not an image"
+            )
+        source_hash = content_hash(
+            subarchive.open(j, skip_decompression=True)
+        )
+        palettes[f".pal{j}"] = (source_hash, source.palette)
+    return palettes
+
+
+def image_settings(args, palettes: dict) -> dict:
+    settings = {"mode": args.mode}
+    # Only recorded when not the default, so older manifests stay valid.
+    if args.format != "png":
+        settings["format"] = args.format
+    if args.png_level is not None:
+        settings["png_level"] = args.png_level
+    if args.transparent:
+        settings["transparent"] = True
+    if args.palette_bank:
+        settings["palette_bank"] = args.palette_bank
+    if args.tilemap:
+        settings["tilemap"] = True
+    if args.palette_from:
+        # Borrowed palettes changing must re-render every image.
+        settings["palettes"] = {
+            suffix: source_hash
+            for suffix, (source_hash, _) in palettes.items()
+        }
+    return settings
+
+
+def record_outputs(
+    manifest: Manifest,
+    subarchive_index: int,
+    writer: BackgroundWriter,
+    settings: dict,
+):
+    outputs = {}
+    for key, name, record in writer.records:
+        outputs.setdefault(key, {})[name] = record
+    for (i, source_hash), records in outputs.items():
+        manifest.record(
+            i, (subarchive_index, i), source_hash, settings, records
+        )
+    finish_manifest(manifest)
+
+
+def finish_manifest(manifest: Manifest):
+    removed = manifest.prune()
+    manifest.save()
+    if removed:
+        log.info("Removed outputs of %d missing subfiles.", removed)
+
+
+def init_dedup(args, output, kind: str):
+    if not args.dedup:
+        return None
+    # Deferred: only --dedup runs need it.
+    from gtcpacdump.dedup import Deduplicator
+
+    # Only directory outputs can be hardlinked to.
+    root = args.output_dir if isinstance(output, DirectoryOutput) else None
+    return Deduplicator(root, kind)
+
+
+def is_duplicate(dedup, primaries: dict, key: str, i: int, j: int) -> bool:
+    """
+    Check whether subfile ``j`` of subarchive ``i`` repeats one already
+    seen in this run or written by an earlier one, or else make it the
+    first copy of ``key``.
+    """
+    if key in primaries or dedup.original(key, str(i), j) is not None:
+        return True
+    primaries[key] = (i, j)
+    return False
+
+
+def decode_timing(dedup, key: str):
+    if dedup is None:
+        return nullcontext()
+    return dedup.timing(key)
+
+
+def finish_dedup(
+    dedup,
+    writer: BackgroundWriter,
+    primaries: dict,
+    duplicates: list,
+    subarchive_index: int,
+    report: FailureReport,
+    locate,
+    manifest: Manifest,
+    settings: dict,
+    stages: dict = None,
+):
+    """
+    Once the first copies are written, give each duplicate their
+    outputs, or the failures they had. ``stages`` maps subfiles whose
+    writes failed before the write itself to the stage that failed.
+    """
+    from gtcpacdump.dedup import DUPLICATES_FILE, write_references
+
+    writer.flush()
+    directory = str(subarchive_index)
+    outputs = {}
+    for (j, _), name, record in writer.records:
+        outputs.setdefault(j, {})[name] = record
+    failures = {}
+    for failure in report.failures:
+        if failure.subarchive == subarchive_index:
+            failures.setdefault(failure.subfile, []).append(
+                (failure.stage, failure.error)
+            )
+    for (j, _), _, e in writer.errors:
+        stage = "write" if stages is None else stages.get(j, "write")
+        failures.setdefault(j, []).append((stage, e))
+    for key, (_, j) in primaries.items():
+        if j in outputs:
+            dedup.add(key, directory, j, outputs[j])
+    linkable = isinstance(writer.output, DirectoryOutput)
+    references = {}
+    for j, source_hash, key in duplicates:
+        _, original = primaries.get(key, (None, None))
+        for stage, error in failures.get(original, ()):
+            add_failure(report, locate, subarchive_index, j, stage, error)
+        if dedup.original(key, directory, j) is None:
+            # The first copy wrote nothing, e.g. not being an image.
+            continue
+        linked, referenced = dedup.materialize(
+            key, writer.output.directory if linkable else None, j
+        )
+        references.update(referenced)
+        if manifest is not None and not referenced:
+            manifest.record(
+                j, (subarchive_index, j), source_hash, settings, linked
+            )
+    if linkable:
+        write_references(writer.output.directory, references)
+    elif references:
+        writer.submit(
+            None, DUPLICATES_FILE,
+            [json.dumps(references, indent=1, sort_keys=True).encode()],
+        )
+    dedup.save()
+    log.info(dedup.summary())
 
 
 def cmd_dump_subfiles(args):
+    retry = load_retry(args)
+    report = FailureReport()
+    sa_index = args.subarchive_index
+    if not wanted(retry, sa_index):
+        finish_report(args, report)
+        return
+    reader = None
+    if args.no_index:
+        dumper = init_dumper(args)
+        subarchive = dumper.load_subarchive(sa_index, report)
+
+        def read_chunks(i):
+            return writer_chunks(i)()
+
+        def writer_chunks(i):
+            # A memoryview into the subarchive buffer, so slicing it on
+            # the writer thread doesn't touch the shared reader.
+            sf = subarchive.open(i, skip_decompression=True)
+            return lambda: (
+                sf[pos:pos + CHUNK_SIZE]
+                for pos in range(0, len(sf), CHUNK_SIZE)
+            )
+
+        def locate(i):
+            return dumper.locate(subarchive, sa_index, i)
+    else:
+        index = init_index(args)
+        subarchive = index.subarchives[sa_index]
+        if subarchive.error is not None:
+            log.error("ERROR: subarchive %d: %s.", sa_index,
+                      subarchive.error)
+            report.add(
+                sa_index, None, "subarchive", subarchive.error,
+                subarchive.pointer.offset, subarchive.pointer.size,
+            )
+            subarchive = None
+
+        # The writer thread reads through its own file handle.
+        reader = index.reader()
+
+        def read_chunks(i):
+            return index.iter_subfile(sa_index, i, CHUNK_SIZE)
+
+        def writer_chunks(i):
+            return lambda: reader.iter_subfile(sa_index, i, CHUNK_SIZE)
+
+        def locate(i):
+            return index.locate(sa_index, i)[:2]
+    if subarchive is None:
+        finish_report(args, report)
+        return
+    output = open_output(
+        args.output_dir, str(args.subarchive_index), "subfiles",
+        args.archive,
+    )
+    manifest = None
+    if args.incremental:
+        manifest = Manifest(output.directory, "subfiles")
+    settings = {"decompress": True} if args.decompress else {}
+    dedup = init_dedup(args, output, "subfiles")
+    # key -> first subfile with that content and settings
+    primaries = {}
+    duplicates = []
+    # subfile -> stage at which the writer thread failed to read it
+    stages = {}
+    # Subfiles are read, and decompressed, on the writer thread as they
+    # are written, so only a chunk of each is in memory at a time. The
+    # reader is closed once the writer is done with it.
+    reader_context = nullcontext() if reader is None else reader
+    with reader_context, BackgroundWriter(output, keep_going=True) as writer:
+        for i in range(1, len(subarchive.subfiles)):
+            if not wanted(retry, sa_index, i):
+                continue
+            source_hash = key = None
+            try:
+                if manifest is not None or dedup is not None:
+                    hasher = content_hasher()
+                    for chunk in read_chunks(i):
+                        hasher.update(chunk)
+                    source_hash = hasher.hexdigest()
+                if manifest is not None:
+                    if manifest.is_current(i, source_hash, settings):
+                        continue
+                if dedup is not None:
+                    key = dedup.key(source_hash, settings)
+                    if is_duplicate(dedup, primaries, key, sa_index, i):
+                        duplicates.append((i, source_hash, key))
+                        continue
+                payload = partial(
+                    stream_subfile, writer_chunks(i),
+                    args.decompress and subarchive.subfiles[i].compressed,
+                    stages, i, decode_timing(dedup, key),
+                )
+            except Exception as e:
+                add_failure(report, locate, sa_index, i, "read", e)
+                continue
+            writer.submit((i, source_hash), f"{i}.bin", payload)
+        if dedup is not None:
+            finish_dedup(
+                dedup, writer, primaries, duplicates, sa_index, report,
+                locate, manifest, settings, stages,
+            )
+    for (i, _), _, e in writer.errors:
+        add_failure(report, locate, sa_index, i, stages.get(i, "write"), e)
+    if manifest is not None:
+        record_outputs(manifest, sa_index, writer, settings)
+    finish_report(args, report)
+
+
+def stream_subfile(chunks, decompress: bool, stages: dict, i: int, timing):
+    """
+    Yield the chunks ``chunks()`` returns, decompressed within the
+    ``timing`` context if asked to, noting the stage in ``stages[i]`` if
+    reading them fails.
+    """
+    stage = "read"
+    try:
+        chunks = chunks()
+        if not decompress:
+            yield from chunks
+            return
+        stage = "decompress"
+        with timing:
+            yield from decompress_stream(chunks)
+    except Exception:
+        stages[i] = stage
+        raise
+
+
+def open_split_archive(args) -> SplitArchive:
+    """
+    Open the split archive in the given subfile, then the one nested in
+    each --entry in turn; only the entries along the way are
+    decompressed.
+    """
+    dumper = init_dumper(args)
+    subarchive = dumper.load_subarchive(args.subarchive_index)
+    if subarchive is None:
+        return None
+    path = f"{args.subarchive_index}/{args.subfile_index}"
+    try:
+        split = SplitArchive(
+            subarchive.open(args.subfile_index), cache=dumper.cache
+        )
+        split.parse()
+        for entry in args.entry or ():
+            path += f"/{entry}"
+            split = split.open_split(entry)
+    except (ValueError, IndexError) as e:
+        log.error("ERROR: %s is not a split archive: %s.", path,
+                  describe_error(e))
+        return None
+    log.info("Found %d entries in %s.", len(split), path)
+    return split
+
+
+def split_label(args) -> str:
+    path = [args.subarchive_index, args.subfile_index, *(args.entry or ())]
+    return "-".join(str(i) for i in path)
+
+
+def cmd_list_split(args):
+    split = open_split_archive(args)
+    if split is None:
+        return
+    for j, entry in enumerate(split.entries):
+        line = f"{j}: offset: {entry.offset}, size: {entry.size}"
+        try:
+            info = split.classify(j, args.mode)
+        except Exception as e:
+            print(f"{line}, {FAIL}{describe_error(e)}{ENDC}")
+            continue
+        line += f", {info.type}, {info.compression}, {info.size} bytes"
+        if info.type == "image":
+            line += f", {info.width}x{info.height} {info.bpp}bpp"
+        print(line)
+
+
+def cmd_dump_split(args):
+    split = open_split_archive(args)
+    if split is None:
+        return
+    output = open_output(
+        args.output_dir, split_label(args), "split", args.archive
+    )
+    with BackgroundWriter(output, keep_going=True) as writer:
+        for j in range(len(split)):
+            try:
+                # Decompressed here: the split archive's reader isn't
+                # safe to share with the writer thread.
+                data = split.open(j, skip_decompression=args.raw)
+            except Exception as e:
+                log.error("ERROR: entry %d: %s.", j, describe_error(e))
+                continue
+            writer.submit(j, f"{j}.bin", [data])
+    log.info("Wrote %d of %d entries.", len(writer.records), len(split))
+
+
+def cmd_split_images(args):
+    split = open_split_archive(args)
+    if split is None:
+        return
+    output = open_output(
+        args.output_dir, split_label(args), "split-images", args.archive
+    )
+    with BackgroundWriter(output, keep_going=True) as writer:
+        for j in range(len(split)):
+            try:
+                if split.classify(j, args.mode).type != "image":
+                    log.debug("Skipping non-image entry %d.", j)
+                    continue
+                image = split.load_image(j, args.mode)
+            except Exception as e:
+                log.error("ERROR: entry %d: %s.", j, describe_error(e))
+                continue
+            stem = str(j)
+            if args.tilemap:
+                image = submit_tilemap(writer, j, stem, image)
+                stem += ".tiles"
+            writer.submit(
+                j, image_file_name(stem, image, args.format),
+                lambda image=image: [
+                    encode_image(
+                        image, args.format, args.png_level, args.transparent
+                    )
+                ],
+            )
+    log.info("Wrote %d images.", len(writer.records))
+
+
+def cmd_atlas(args):
+    # Deferred: only this command packs atlases.
+    from PIL import Image
+    from gtcpacdump.atlas import Atlas
+
+    dumper = init_dumper(args)
+    if args.subarchive:
+        indices = args.subarchive
+        label = "-".join(str(i) for i in indices)
+    else:
+        indices = range(len(dumper.cpac.subarchives))
+        label = "all"
+    atlas = Atlas(args.page_size, args.page_size, args.padding)
+    skipped = 0
+    for i in indices:
+        subarchive = dumper.load_subarchive(i)
+        if subarchive is None:
+            continue
+        for j in range(1, len(subarchive.subfiles)):
+            if subarchive.subfiles[j].size is None:
+                continue
+            try:
+                if subarchive.classify(j, args.mode).type != "image":
+                    skipped += 1
+                    continue
+                image = subarchive.load_image(j, args.mode)
+            except Exception as e:
+                log.debug("Subfile %d/%d is not an image: %r", i, j, e)
+                skipped += 1
+                continue
+            atlas.add(image, subarchive=i, subfile=j)
+    atlas.pack()
+    output = DirectoryOutput(args.output_dir)
+    page_names = [
+        f"atlas-{label}-{page}.png" for page in range(atlas.page_count)
+    ]
+    with BackgroundWriter(output) as writer:
+        for page, pixels in atlas.render_pages(args.transparent):
+            writer.submit(
+                page, page_names[page],
+                lambda pixels=pixels: [
+                    encode_png(Image.fromarray(pixels), args.png_level)
+                ],
+            )
+    with (args.output_dir / f"atlas-{label}.json").open("w") as f:
+        json.dump(atlas.index(page_names), f, indent=1)
+    print(
+        f"{OKGREEN}Packed {WARNING}{len(atlas)}{OKGREEN} images into "
+        f"{WARNING}{atlas.page_count}{OKGREEN} pages, skipped "
+        f"{WARNING}{skipped}{OKGREEN} non-image subfiles.{ENDC}"
+    )
+
+
+DIFF_COLORS = {
+    "added": OKGREEN,
+    "removed": FAIL,
+    "changed": WARNING,
+    "recompressed": OKBLUE,
+}
+
+
+def cmd_diff(args):
+    # Deferred: only this command diffs.
+    from gtcpacdump.archive import Archive
+    from gtcpacdump.diff import diff_archives
+
+    with Archive(args.input_file) as old, Archive(args.other_file) as new:
+        changes = list(diff_archives(old, new))
+        if args.render is not None:
+            render_changes(old, new, changes, args.render, args.mode)
+    if args.json:
+        json.dump([change._asdict() for change in changes], sys.stdout,
+                  indent=1)
+        print()
+        return
+    totals = {}
+    for change in changes:
+        totals[change.status] = totals.get(change.status, 0) + 1
+        location = str(change.subarchive)
+        if change.subfile is not None:
+            location += f"/{change.subfile}"
+        print(f"{DIFF_COLORS[change.status]}{change.status}{ENDC}: "
+              f"{location} ({change.old_size} -> {change.new_size} bytes)")
+    print(", ".join(f"{n} {status}" for status, n in sorted(totals.items()))
+          or "No differences.")
+
+
+def render_changes(old, new, changes, output_dir: Path, mode: str):
+    """
+    Write ``<subarchive>-<subfile>.old.png`` and ``.new.png`` for every
+    changed, added or removed image subfile.
+    """
+    with BackgroundWriter(DirectoryOutput(output_dir)) as writer:
+        for change in changes:
+            if change.subfile is None or change.status == "recompressed":
+                continue
+            for side, archive, size in (
+                ("old", old, change.old_size), ("new", new, change.new_size)
+            ):
+                if size is None:
+                    continue
+                i, j = change.subarchive, change.subfile
+                try:
+                    subarchive = archive.subarchive(i)
+                    if subarchive.classify(j, mode).type != "image":
+                        continue
+                    image = subarchive.load_image(j, mode)
+                except Exception as e:
+                    log.error("ERROR: %s subfile %d/%d: %s.", side, i, j,
+                              describe_error(e))
+                    continue
+                writer.submit(
+                    (i, j), f"{i}-{j}.{side}.png",
+                    lambda image=image: [encode_image(image)],
+                )
+    log.info("Rendered %d images to %s.", len(writer.records), output_dir)
+
+
+def cmd_unpack(args):
     dumper = init_dumper(args)
     subarchive = dumper.load_subarchive(args.subarchive_index)
+    if subarchive is None:
+        return
     output_dir = args.output_dir / str(args.subarchive_index)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    for i in range(1, len(subarchive.subfiles)):
+    unpack_subarchive(subarchive, args.subarchive_index, output_dir)
+    log.info("Unpacked subarchive %d to %s.", args.subarchive_index,
+             output_dir)
+
+
+def cmd_repack(args):
+    dumper = init_dumper(args)
+    replacements = {}
+    for directory in sorted(args.input_dir.iterdir()):
+        if not (directory / LAYOUT_FILE).is_file():
+            continue
         try:
-            sf = subarchive.open(i, skip_decompression=True)
-        except:
+            i = int(directory.name)
+        except ValueError:
+            continue
+        if i >= len(dumper.cpac.subarchives):
+            log.error("ERROR: No subarchive %d in the input file.", i)
             continue
-        sf_path = output_dir / f"{i}.bin"
-        with sf_path.open("wb") as f:
+        log.info("Repacking subarchive %d.", i)
+        replacements[i] = pack_directory(
+            directory, dumper.load_subarchive(i), args.method
+        )
+    repack_cpac(dumper.cpac, replacements, args.output_file)
+    print(
+        f"{OKGREEN}Wrote {BOLD}{args.output_file}{ENDC}{OKGREEN} with "
+        f"{WARNING}{len(replacements)}{OKGREEN} rebuilt subarchives.{ENDC}"
+    )
+
+
+def cmd_serve(args):
+    # Deferred: nothing else needs the HTTP server.
+    from gtcpacdump.archive import Archive
+    from gtcpacdump.server import make_server
+
+    archive = Archive(
+        args.input_file, cache=init_cache(args) or DecompressionCache()
+    )
+    server = make_server(archive, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"{OKGREEN}Serving {BOLD}{args.input_file}{ENDC}{OKGREEN} on "
+          f"{BOLD}http://{host}:{port}/{ENDC}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        archive.close()
+
+
+def write_png(im, path: Path) -> bytes:
+    data = encode_png(im)
+    with open_new(path) as f:
+        f.write(data)
+    return data
+
+
+# dump_all workers open the CPAC themselves and keep the most recently
+# used subarchive parsed, so tasks only carry indices.
+_worker_cpac = None
+_worker_options = None
+_worker_subarchive = (None, None)
+_worker_ships_stats = False
+_worker_cache = None
+
+
+def _init_dump_all_worker(
+    path_to_cpac: Path, use_mmap: bool, options, cache_opts, log_level=None,
+    collect_stats=False
+):
+    global _worker_cpac, _worker_options, _worker_subarchive
+    global _worker_ships_stats, _worker_cache
+    if log_level is not None:
+        setup_logging(log_level)
+    if collect_stats:
+        stats.enable()
+    _worker_ships_stats = collect_stats
+    _worker_cpac = CPAC(path_to_cpac, use_mmap=use_mmap)
+    _worker_cpac.parse_subfiles()
+    _worker_cache = init_cache(None, cache_opts)
+    _worker_options = options
+    _worker_subarchive = (None, None)
+
+
+def _worker_load_subarchive(i: int) -> SubArchive:
+    global _worker_subarchive
+    if _worker_subarchive[0] != i:
+        subarchive = SubArchive(_worker_cpac.open(i), cache=_worker_cache)
+        subarchive.parse()
+        _worker_subarchive = (i, subarchive)
+    return _worker_subarchive[1]
+
+
+def _dump_all_settings(mode: str, images: bool, decompress: bool) -> dict:
+    return {"mode": mode, "images": images, "decompress": decompress}
+
+
+def _dump_all_task(task):
+    """
+    Dump one subfile. Returns ``(subarchive index, subfile index,
+    failures, stats, manifest result, seconds)``; failures are ``(stage,
+    error, offset, size)``, and the manifest result is None outside
+    incremental and dedup mode, "skipped" for unchanged subfiles and the
+    new manifest entry otherwise.
+    """
+    start = perf_counter()
+    subarchive_index, subfile_index, previous = task
+    (
+        output_dir, mode, images, decompress, incremental, dedup
+    ) = _worker_options
+    output_dir = output_dir / str(subarchive_index)
+    settings = _dump_all_settings(mode, images, decompress)
+    failures = []
+    outputs = {}
+    stage = "subarchive"
+    try:
+        subarchive = _worker_load_subarchive(subarchive_index)
+        stage = "read"
+        sf = subarchive.open(subfile_index, skip_decompression=True)
+        if incremental:
+            source_hash = content_hash(sf)
+            if entry_is_current(previous, output_dir, source_hash, settings):
+                return (
+                    subarchive_index, subfile_index, failures, _take_stats(),
+                    "skipped", perf_counter() - start,
+                )
+        if decompress:
+            stage = "decompress"
+            sf = subarchive.open(subfile_index)
+        stage = "write"
+        sf_path = output_dir / f"{subfile_index}.bin"
+        with open_new(sf_path) as f:
             f.write(sf)
+        outputs[sf_path.name] = sf
+    except Exception as e:
+        failures.append(_worker_failure(subarchive_index, subfile_index,
+                                        stage, e))
+        return (
+            subarchive_index, subfile_index, failures, _take_stats(), None,
+            perf_counter() - start,
+        )
+    if images:
+        try:
+            # Reuse the data decompressed above rather than decompress
+            # it again.
+            im = subarchive.dump_image(
+                subfile_index, mode, data=sf if decompress else None
+            )
+            im_path = output_dir / f"{subfile_index}.png"
+            outputs[im_path.name] = write_png(im, im_path)
+        except Exception as e:
+            failures.append(_worker_failure(subarchive_index, subfile_index,
+                                            "image", e))
+    result = None
+    if incremental or dedup:
+        # dump_all hashed the stored data up front when deduplicating.
+        result = make_entry(
+            (subarchive_index, subfile_index),
+            source_hash if incremental else None, settings, outputs,
+        )
+    return (
+        subarchive_index, subfile_index, failures, _take_stats(), result,
+        perf_counter() - start,
+    )
+
+
+def _worker_failure(i: int, j: int, stage: str, error) -> tuple:
+    offset = size = None
+    if _worker_subarchive[0] == i:
+        try:
+            offset, size = _worker_subarchive[1].location(j)
+            offset += _worker_cpac.subarchives[i].offset
+        except Exception:
+            offset = size = None
+    return stage, describe_error(error), offset, size
+
+
+def _take_stats():
+    if _worker_ships_stats:
+        return stats.take()
+    return None
+
+
+def _subfile_counts(args, report: FailureReport, retry):
+    """
+    Yield ``(subarchive index, subfile count or None, hash function)``
+    for every subarchive selected by ``retry``, recording the ones that
+    fail to parse in ``report``. The hash function returns the hash of a
+    subfile's stored bytes, or None if it can't be read.
+    """
+    if not args.no_index:
+        index = init_index(args)
+        for i, subarchive in enumerate(index.subarchives):
+            if not wanted(retry, i):
+                continue
+            if subarchive.error is not None:
+                log.error("ERROR: subarchive %d: %s.", i, subarchive.error)
+                report.add(
+                    i, None, "subarchive", subarchive.error,
+                    subarchive.pointer.offset, subarchive.pointer.size,
+                )
+                yield i, None, None
+            else:
+                yield i, len(subarchive.subfiles), partial(
+                    _stored_hash, index.iter_subfile, i
+                )
+        return
+    dumper = init_dumper(args)
+    for i in range(len(dumper.cpac.subarchives)):
+        if not wanted(retry, i):
+            continue
+        subarchive = dumper.load_subarchive(i, report)
+        if subarchive is None:
+            yield i, None, None
+        else:
+            yield i, len(subarchive.subfiles), partial(
+                _stored_hash,
+                lambda i, j, _, subarchive=subarchive: [
+                    subarchive.open(j, skip_decompression=True)
+                ],
+                i,
+            )
+
+
+def _stored_hash(iter_subfile, i: int, j: int):
+    hasher = content_hasher()
+    try:
+        for chunk in iter_subfile(i, j, CHUNK_SIZE):
+            hasher.update(chunk)
+    except Exception as e:
+        log.debug("Can't hash subfile %d/%d: %r", i, j, e)
+        return None
+    return hasher.hexdigest()
+
+
+def cmd_dump_all(args):
+    retry = load_retry(args)
+    report = FailureReport()
+    settings = _dump_all_settings(
+        args.mode, not args.no_images, args.decompress
+    )
+    dedup = None
+    if args.dedup:
+        # Deferred: only --dedup runs need it.
+        from gtcpacdump.dedup import Deduplicator
+
+        dedup = Deduplicator(args.output_dir, "all")
+    # With dedup, only the first copy of each subfile becomes a task.
+    primaries = {}
+    duplicates = []
+    tasks = []
+    manifests = {}
+    subarchive_count = 0
+    subfile_count = 0
+    succeeded = 0
+    skipped = 0
+    for subarchive_index, count, stored_hash in _subfile_counts(
+        args, report, retry
+    ):
+        subarchive_count += 1
+        if count is None:
+            continue
+        output_dir = args.output_dir / str(subarchive_index)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        manifest = None
+        if args.incremental:
+            manifest = manifests[subarchive_index] = Manifest(
+                output_dir, "all"
+            )
+        for subfile_index in range(1, count):
+            if not wanted(retry, subarchive_index, subfile_index):
+                continue
+            subfile_count += 1
+            previous = manifest.get(subfile_index) if manifest else None
+            source_hash = None
+            if dedup is not None:
+                source_hash = stored_hash(subfile_index)
+            if source_hash is not None:
+                if manifest is not None and entry_is_current(
+                    previous, output_dir, source_hash, settings
+                ):
+                    manifest.mark_seen(subfile_index)
+                    succeeded += 1
+                    skipped += 1
+                    continue
+                key = dedup.key(source_hash, settings)
+                if is_duplicate(
+                    dedup, primaries, key, subarchive_index, subfile_index
+                ):
+                    duplicates.append(
+                        (subarchive_index, subfile_index, source_hash, key)
+                    )
+                    continue
+            tasks.append((subarchive_index, subfile_index, previous))
+
+    initargs = (
+        args.input_file,
+        args.mmap,
+        (
+            args.output_dir, args.mode, not args.no_images, args.decompress,
+            args.incremental, dedup is not None,
+        ),
+        cache_options(args),
+        logging.getLogger().level,
+        stats.enabled,
+    )
+    if args.jobs == 1:
+        # Running in-process, stats are recorded straight into ours.
+        _init_dump_all_worker(*initargs[:4])
+        results = map(_dump_all_task, tasks)
+        pool = None
+    else:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(
+            args.jobs, initializer=_init_dump_all_worker, initargs=initargs
+        )
+        # Tasks are ordered by subarchive, so chunks mostly hit the
+        # worker's already-parsed subarchive.
+        chunksize = max(1, min(64, len(tasks) // (args.jobs * 4)))
+        results = pool.imap_unordered(_dump_all_task, tasks, chunksize)
+
+    # (subarchive, subfile) -> (outputs, seconds) of first copies
+    dumped = {}
+    failed = {}
+    for (
+        subarchive_index, subfile_index, task_failures, task_stats, result,
+        seconds,
+    ) in results:
+        if task_stats is not None:
+            stats.merge(task_stats)
+        if result == "skipped":
+            skipped += 1
+            previous = manifests[subarchive_index].get(subfile_index)
+            dumped[subarchive_index, subfile_index] = (
+                previous["outputs"], 0
+            )
+        elif isinstance(result, dict):
+            dumped[subarchive_index, subfile_index] = (
+                result["outputs"], seconds
+            )
+        if task_failures:
+            failed[subarchive_index, subfile_index] = task_failures
+        if args.incremental:
+            manifest = manifests[subarchive_index]
+            if isinstance(result, dict):
+                manifest.set_entry(subfile_index, result)
+            else:
+                # Unchanged, or failed before writing anything: keep
+                # whatever the previous run produced.
+                manifest.mark_seen(subfile_index)
+        if not task_failures:
+            succeeded += 1
+        for stage, error, offset, size in task_failures:
+            report.add(
+                subarchive_index, subfile_index, stage, error, offset, size
+            )
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if dedup is not None:
+        succeeded += _link_duplicates(
+            args, dedup, primaries, duplicates, dumped, failed, report,
+            manifests, settings,
+        )
+
+    if args.incremental:
+        for manifest in manifests.values():
+            finish_manifest(manifest)
+        # Subarchives that no longer exist at all
+        for output_dir in args.output_dir.iterdir():
+            if (
+                output_dir.name.isdigit()
+                and int(output_dir.name) >= subarchive_count
+                and (output_dir / ".manifest-all.json").exists()
+            ):
+                finish_manifest(Manifest(output_dir, "all"))
+
+    finish_report(args, report)
+    print(
+        f"{BOLD}{OKGREEN}Dumped {WARNING}{succeeded}{OKGREEN} of "
+        f"{WARNING}{subfile_count}{OKGREEN} subfiles from "
+        f"{WARNING}{subarchive_count}{OKGREEN} subarchives, "
+        f"{FAIL}{len(report)}{OKGREEN} failures.{ENDC}"
+    )
+    if args.incremental:
+        print(
+            f"{OKGREEN}Skipped {WARNING}{skipped}{OKGREEN} unchanged "
+            f"subfiles.{ENDC}"
+        )
+    if dedup is not None:
+        print(f"{OKGREEN}{dedup.summary()}{ENDC}")
+
+
+def _link_duplicates(
+    args,
+    dedup,
+    primaries: dict,
+    duplicates: list,
+    dumped: dict,
+    failed: dict,
+    report: FailureReport,
+    manifests: dict,
+    settings: dict,
+) -> int:
+    """
+    Give each duplicate the outputs of its first copy, and the failures
+    it had. Returns the number of duplicates that got every output.
+    """
+    from gtcpacdump.dedup import write_references
+
+    for key, primary in primaries.items():
+        if primary in dumped:
+            outputs, seconds = dumped[primary]
+            dedup.add(key, str(primary[0]), primary[1], outputs, seconds)
+    succeeded = 0
+    references = {}
+    for i, j, source_hash, key in duplicates:
+        primary = primaries.get(key)
+        for stage, error, _, _ in failed.get(primary, ()):
+            report.add(i, j, stage, error)
+        if dedup.original(key, str(i), j) is None:
+            continue
+        linked, referenced = dedup.materialize(
+            key, args.output_dir / str(i), j
+        )
+        references.setdefault(i, {}).update(referenced)
+        if not referenced and primary not in failed:
+            succeeded += 1
+        if args.incremental:
+            if referenced:
+                # Outputs that only exist elsewhere can't be checked.
+                manifests[i].mark_seen(j)
+            else:
+                manifests[i].set_entry(
+                    j, make_entry((i, j), source_hash, settings, linked)
+                )
+    directories = {i for i, _ in primaries.values()}
+    directories.update(i for i, _, _, _ in duplicates)
+    for i in directories:
+        write_references(args.output_dir / str(i), references.get(i, {}))
+    dedup.save()
+    return succeeded
 
 
 if __name__ == "__main__":
@@ -102,9 +1364,51 @@ if __name__ == "__main__":
     dump_subfiles.set_defaults(func=cmd_dump_subfiles)
     dump_subfiles.add_argument('subarchive_index', type=int)
     dump_subfiles.add_argument(
+        "--decompress", action="store_true",
+        help="Decompress subfiles while writing them out"
+    )
+    dump_subfiles.add_argument(
+        "--incremental", action="store_true",
+        help="Skip subfiles that haven't changed since the last run"
+    )
+    dump_subfiles.add_argument(
+        "--archive", choices=ARCHIVE_FORMATS,
+        help="Write outputs into a single zip or tar file in OUTPUT_DIR "
+             "instead of a directory"
+    )
+    dump_subfiles.add_argument(
+        "output_dir", help="Path to the output directory", type=Path
+    )
+
+    unpack = subparsers.add_parser(
+        "unpack", help="Unpack a subarchive into a directory for repacking"
+    )
+    unpack.set_defaults(func=cmd_unpack)
+    unpack.add_argument('subarchive_index', type=int)
+    unpack.add_argument(
         "output_dir", help="Path to the output directory", type=Path
     )
 
+    repack = subparsers.add_parser(
+        "repack", help="Build a new CPAC file from unpacked subarchives"
+    )
+    repack.set_defaults(func=cmd_repack)
+    repack.add_argument(
+        "--method",
+        choices=[*COMPRESSORS, "best"],
+        default="lz77",
+        help="Compression for edited subfiles whose original method is "
+             "unknown (default: lz77)"
+    )
+    repack.add_argument(
+        "input_dir", type=Path,
+        help="Directory of subarchives written by unpack; subarchives "
+             "missing from it are copied from the input file"
+    )
+    repack.add_argument(
+        "output_file", help="Path to the new CPAC file", type=Path
+    )
+
     subarchive_images = subparsers.add_parser("subarchive_images",
                                               help="Dump images from a given subarchive")
     subarchive_images.set_defaults(func=cmd_subarchive_images)
@@ -117,12 +1421,316 @@ if __name__ == "__main__":
         help="Extraction mode: either 'nds' (default) or 'ios'.",
     )
     subarchive_images.add_argument(
+        "--format", choices=IMAGE_FORMATS, default="png",
+        help="png (RGBA, default), indexed (paletted PNG), raw (bare RGBA "
+             "pixels, named N.WxH.rgba) or npy (NumPy array)"
+    )
+    subarchive_images.add_argument(
+        "--png-level", type=int, choices=range(10), metavar="0-9",
+        help="zlib compression level for PNGs (default: Pillow's, 6)"
+    )
+    subarchive_images.add_argument(
+        "--transparent", action="store_true",
+        help="Make palette index 0 transparent"
+    )
+    subarchive_images.add_argument(
+        "--tilemap", action="store_true",
+        help="Write a sheet of the unique tiles (N.tiles.png) and a "
+             "tilemap (N.tilemap.json) instead of each image"
+    )
+    subarchive_images.add_argument(
+        "--palette-bank", type=int, default=0, metavar="BANK",
+        help="Render 4bpp images with 16-color bank BANK of the "
+             "--palette-from palettes (default: 0)"
+    )
+    subarchive_images.add_argument(
+        "--palette-from", type=int, action="append", metavar="SUBFILE",
+        help="Render every image against the palette of SUBFILE too, as "
+             "N.palSUBFILE.png; can be repeated"
+    )
+    subarchive_images.add_argument(
+        "--incremental", action="store_true",
+        help="Skip subfiles that haven't changed since the last run"
+    )
+    subarchive_images.add_argument(
+        "--archive", choices=ARCHIVE_FORMATS,
+        help="Write outputs into a single zip or tar file in OUTPUT_DIR "
+             "instead of a directory"
+    )
+    subarchive_images.add_argument(
+        "output_dir", help="Path to the output directory", type=Path
+    )
+
+    list_split = subparsers.add_parser(
+        "list_split", help="List the entries of a split archive subfile"
+    )
+    list_split.set_defaults(func=cmd_list_split)
+    dump_split = subparsers.add_parser(
+        "dump_split", help="Dump the entries of a split archive subfile"
+    )
+    dump_split.set_defaults(func=cmd_dump_split)
+    dump_split.add_argument(
+        "--raw", action="store_true",
+        help="Write entries as stored, without decompressing them"
+    )
+    split_images = subparsers.add_parser(
+        "split_images", help="Dump images from a split archive subfile"
+    )
+    split_images.set_defaults(func=cmd_split_images)
+    split_images.add_argument(
+        "--format", choices=IMAGE_FORMATS, default="png",
+        help="png (RGBA, default), indexed (paletted PNG), raw (bare RGBA "
+             "pixels, named N.WxH.rgba) or npy (NumPy array)"
+    )
+    split_images.add_argument(
+        "--png-level", type=int, choices=range(10), metavar="0-9",
+        help="zlib compression level for PNGs (default: Pillow's, 6)"
+    )
+    split_images.add_argument(
+        "--transparent", action="store_true",
+        help="Make palette index 0 transparent"
+    )
+    split_images.add_argument(
+        "--tilemap", action="store_true",
+        help="Write a sheet of the unique tiles (N.tiles.png) and a "
+             "tilemap (N.tilemap.json) instead of each image"
+    )
+    for split_command in (list_split, dump_split, split_images):
+        split_command.add_argument('subarchive_index', type=int)
+        split_command.add_argument('subfile_index', type=int)
+        split_command.add_argument(
+            "--entry", type=int, action="append", metavar="INDEX",
+            help="Descend into the split archive nested in entry INDEX; "
+                 "repeat for deeper nesting"
+        )
+        split_command.add_argument(
+            "--mode",
+            choices=["nds", "ios"],
+            default="nds",
+            metavar="MODE",
+            help="Extraction mode: either 'nds' (default) or 'ios'.",
+        )
+    for split_command in (dump_split, split_images):
+        split_command.add_argument(
+            "--archive", choices=ARCHIVE_FORMATS,
+            help="Write outputs into a single zip or tar file in OUTPUT_DIR "
+                 "instead of a directory"
+        )
+        split_command.add_argument(
+            "output_dir", help="Path to the output directory", type=Path
+        )
+
+    scan = subparsers.add_parser(
+        "scan",
+        help="Classify every subfile from its headers, without decoding "
+             "pixel data"
+    )
+    scan.set_defaults(func=cmd_scan)
+    scan.add_argument(
+        "--subarchive", type=int, action="append", metavar="INDEX",
+        help="Only scan this subarchive; can be repeated (default: every "
+             "subarchive)"
+    )
+    scan.add_argument(
+        "--mode",
+        choices=["nds", "ios"],
+        default="nds",
+        metavar="MODE",
+        help="Extraction mode: either 'nds' (default) or 'ios'.",
+    )
+    scan.add_argument(
+        "--json", action="store_true", help="Print the catalog as JSON"
+    )
+
+    atlas = subparsers.add_parser(
+        "atlas", help="Pack every image into a few atlas pages"
+    )
+    atlas.set_defaults(func=cmd_atlas)
+    atlas.add_argument(
+        "--subarchive", type=int, action="append", metavar="INDEX",
+        help="Only pack images from this subarchive; can be repeated "
+             "(default: every subarchive)"
+    )
+    atlas.add_argument(
+        "--mode",
+        choices=["nds", "ios"],
+        default="nds",
+        metavar="MODE",
+        help="Extraction mode: either 'nds' (default) or 'ios'.",
+    )
+    atlas.add_argument(
+        "--page-size", type=int, default=2048, metavar="PX",
+        help="Width and height of atlas pages (default: 2048)"
+    )
+    atlas.add_argument(
+        "--padding", type=int, default=1, metavar="PX",
+        help="Space between images (default: 1)"
+    )
+    atlas.add_argument(
+        "--transparent", action="store_true",
+        help="Make palette index 0 transparent"
+    )
+    atlas.add_argument(
+        "--png-level", type=int, choices=range(10), metavar="0-9",
+        help="zlib compression level for pages (default: Pillow's, 6)"
+    )
+    atlas.add_argument(
+        "output_dir", help="Path to the output directory", type=Path
+    )
+
+    dump_all = subparsers.add_parser(
+        "dump_all", help="Dump every subfile and image from every subarchive"
+    )
+    dump_all.set_defaults(func=cmd_dump_all)
+    dump_all.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="Number of worker processes (default: number of CPUs)"
+    )
+    dump_all.add_argument(
+        "--mode",
+        choices=["nds", "ios"],
+        default="nds",
+        metavar="MODE",
+        help="Extraction mode: either 'nds' (default) or 'ios'.",
+    )
+    dump_all.add_argument(
+        "--no-images", action="store_true", help="Don't render images"
+    )
+    dump_all.add_argument(
+        "--decompress", action="store_true",
+        help="Write decompressed subfiles instead of the raw data"
+    )
+    dump_all.add_argument(
+        "--incremental", action="store_true",
+        help="Skip subfiles that haven't changed since the last run"
+    )
+    dump_all.add_argument(
         "output_dir", help="Path to the output directory", type=Path
     )
 
+    diff = subparsers.add_parser(
+        "diff",
+        help="List subfiles added, removed or changed in another CPAC file"
+    )
+    diff.set_defaults(func=cmd_diff)
+    diff.add_argument(
+        "other_file", type=Path, help="Path to the newer cpac_2d.bin"
+    )
+    diff.add_argument(
+        "--json", action="store_true", help="Print the changes as JSON"
+    )
+    diff.add_argument(
+        "--render", type=Path, metavar="OUTPUT_DIR",
+        help="Also render the old and new versions of changed images to "
+             "OUTPUT_DIR"
+    )
+    diff.add_argument(
+        "--mode",
+        choices=["nds", "ios"],
+        default="nds",
+        metavar="MODE",
+        help="Extraction mode: either 'nds' (default) or 'ios'.",
+    )
+
+    serve = subparsers.add_parser(
+        "serve", help="Serve subfiles and rendered images over HTTP"
+    )
+    serve.set_defaults(func=cmd_serve)
+    serve.add_argument(
+        "--host", default="127.0.0.1",
+        help="Address to listen on (default: 127.0.0.1)"
+    )
+    serve.add_argument(
+        "--port", type=int, default=8000,
+        help="Port to listen on (default: 8000)"
+    )
+
     parser.add_argument(
         "-i", "--input-file", help="Path to cpac_2d.bin", type=Path,
         required=True
     )
+    parser.add_argument(
+        "--mmap", help="Memory-map the CPAC file instead of reading "
+                       "subarchives into memory", action="store_true"
+    )
+    parser.add_argument(
+        "--index", type=Path, metavar="INDEX_FILE",
+        help="Path to the layout index (default: next to the input file)"
+    )
+    parser.add_argument(
+        "--no-index", action="store_true",
+        help="Parse the CPAC file instead of using the layout index"
+    )
+    parser.add_argument(
+        "--memory-cache", type=int, default=0, metavar="MB",
+        help="Keep up to MB megabytes of decompressed subfiles in memory"
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path,
+        help="Cache decompressed subfiles in this directory"
+    )
+    parser.add_argument(
+        "--cache-dir-size", type=int, default=1024, metavar="MB",
+        help="Size limit of the cache directory (default: 1024)"
+    )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="Only print warnings and errors"
+    )
+    verbosity.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="Print per-subfile progress"
+    )
+    for batch in (dump_subfiles, subarchive_images, dump_all):
+        batch.add_argument(
+            "--dedup", action="store_true",
+            help="Decode identical subfiles once and hardlink the copies' "
+                 "outputs, across subarchives and runs"
+        )
+        batch.add_argument(
+            "--report", type=Path, metavar="REPORT_FILE",
+            help="Write every failure, with its stage and byte offsets, to "
+                 "REPORT_FILE as JSON"
+        )
+        batch.add_argument(
+            "--retry-from", type=Path, metavar="REPORT_FILE",
+            help="Only process the subfiles that failed in REPORT_FILE"
+        )
+
+    parser.add_argument(
+        "--stats", choices=["text", "json"],
+        help="Print timing and throughput statistics when done"
+    )
     args = parser.parse_args()
+    if getattr(args, "archive", None) and getattr(args, "incremental", False):
+        parser.error("--incremental can't be used with --archive")
+    if getattr(args, "retry_from", None) and getattr(
+        args, "incremental", False
+    ):
+        # A partial run would prune the manifest entries it didn't visit.
+        parser.error("--incremental can't be used with --retry-from")
+    if getattr(args, "jobs", 1) < 1:
+        parser.error("--jobs must be at least 1")
+    if getattr(args, "palette_bank", 0) and not args.palette_from:
+        # Images carry a single bank of their own.
+        parser.error("--palette-bank needs --palette-from")
+    if args.quiet:
+        setup_logging(logging.WARNING)
+    elif args.verbose:
+        setup_logging(logging.DEBUG)
+    else:
+        setup_logging(logging.INFO)
+    if args.stats:
+        stats.enable()
+    start = perf_counter()
     args.func(args)
+    if args.stats:
+        stats.timers["total"] = perf_counter() - start
+        stats.timer_calls["total"] = 1
+        report = stats.report()
+        if args.stats == "json":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            print(stats.format_report(report))
@@ -0,0 +1,130 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Random-access, read-only view of a CPAC file.
+
+``Archive`` keeps the CPAC memory-mapped and every subarchive it has
+parsed, decompresses through a DecompressionCache and keeps recently
+rendered PNGs, so repeated reads of the same subfile are dictionary
+lookups. It is safe to share between threads.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+from . import stats
+from .cache import DecompressionCache
+from .common import content_hash
+from .cpac import CPAC
+from .output import encode_png
+from .subarchive import SubArchive
+
+log = logging.getLogger(__name__)
+
+
+class Archive:
+    def __init__(
+        self,
+        cpac_path: Path,
+        cache: Optional[DecompressionCache] = None,
+        png_cache_limit: int = 32 << 20,
+    ):
+        self.cpac = CPAC(cpac_path, use_mmap=True)
+        self.cpac.parse_subfiles()
+        self.cache = cache if cache is not None else DecompressionCache()
+        self.png_cache_limit = png_cache_limit
+        self._subarchives: Dict[int, SubArchive] = {}
+        self._hashes: Dict[Tuple[int, int], str] = {}
+        self._pngs = OrderedDict()
+        self._pngs_size = 0
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._subarchives.clear()
+            self.cpac.close()
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        """
+        Yield (subarchive, subfile) for every readable subfile, skipping
+        subarchives that fail to parse.
+        """
+        for i in range(len(self.cpac.subarchives)):
+            try:
+                subarchive = self.subarchive(i)
+            except ValueError as e:
+                log.error("ERROR: subarchive %d: %s.", i, e)
+                continue
+            for j, entry in enumerate(subarchive.subfiles):
+                if entry.size is not None:
+                    yield i, j
+
+    def subarchive(self, i: int) -> SubArchive:
+        with self._lock:
+            subarchive = self._subarchives.get(i)
+            if subarchive is None:
+                subarchive = SubArchive(self.cpac.open(i), cache=self.cache)
+                subarchive.parse()
+                self._subarchives[i] = subarchive
+            return subarchive
+
+    def read(
+        self, subarchive: int, subfile: int, decompress: bool = True
+    ) -> bytes:
+        with self._lock:
+            data = self.subarchive(subarchive).open(
+                subfile, skip_decompression=not decompress
+            )
+            return bytes(data)
+
+    def content_hash(self, subarchive: int, subfile: int) -> str:
+        """
+        Hash of the subfile's stored (compressed) bytes.
+        """
+        key = (subarchive, subfile)
+        with self._lock:
+            out = self._hashes.get(key)
+            if out is None:
+                out = content_hash(
+                    self.subarchive(subarchive).open(
+                        subfile, skip_decompression=True
+                    )
+                )
+                self._hashes[key] = out
+            return out
+
+    def image(self, subarchive: int, subfile: int, mode: str = "nds"):
+        with self._lock:
+            return self.subarchive(subarchive).dump_image(subfile, mode)
+
+    def png(
+        self, subarchive: int, subfile: int, mode: str = "nds"
+    ) -> Optional[bytes]:
+        key = (subarchive, subfile, mode)
+        with self._lock:
+            out = self._pngs.get(key)
+            if out is not None:
+                self._pngs.move_to_end(key)
+                if stats.enabled:
+                    stats.count("archive.png_hits")
+                return out
+            im = self.image(subarchive, subfile, mode)
+            if im is None:
+                return None
+            out = encode_png(im)
+            if len(out) <= self.png_cache_limit:
+                self._pngs[key] = out
+                self._pngs_size += len(out)
+                while self._pngs_size > self.png_cache_limit:
+                    _, evicted = self._pngs.popitem(last=False)
+                    self._pngs_size -= len(evicted)
+            return out
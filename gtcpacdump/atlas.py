@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Packing many images into a few atlas pages.
+
+Images are placed with a shelf packer (tallest first, left to right,
+starting a new shelf when a row is full and a new page when the page is
+full). Only parsed TiledImages are held while packing; each page is
+rendered straight from their pixel arrays when it is written.
+"""
+import logging
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from . import stats
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 2048
+
+
+def pack_shelves(
+    sizes: List[Tuple[int, int]],
+    page_width: int,
+    page_height: int,
+    padding: int = 0,
+) -> List[Tuple[int, int, int]]:
+    """
+    Place rectangles of the given (width, height) sizes, returning a
+    (page, x, y) for each. Rectangles wider or taller than a page get a
+    shelf or page to themselves.
+    """
+    order = sorted(
+        range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0])
+    )
+    placements = [None] * len(sizes)
+    page = x = y = shelf_height = 0
+    for i in order:
+        width = sizes[i][0] + padding
+        height = sizes[i][1] + padding
+        if x and x + width > page_width:
+            y += shelf_height
+            x = shelf_height = 0
+        if y and y + height > page_height:
+            page += 1
+            x = y = shelf_height = 0
+        placements[i] = (page, x, y)
+        x += width
+        shelf_height = max(shelf_height, height)
+    return placements
+
+
+class Atlas:
+    def __init__(
+        self,
+        page_width: int = DEFAULT_PAGE_SIZE,
+        page_height: int = DEFAULT_PAGE_SIZE,
+        padding: int = 1,
+    ):
+        self.page_width = page_width
+        self.page_height = page_height
+        self.padding = padding
+        # (info, TiledImage) pairs in insertion order
+        self._images = []
+        # One dict per image, filled in by pack()
+        self.entries = []
+        self.page_count = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def add(self, image, **info):
+        """
+        Queue a parsed TiledImage; ``info`` is copied into its index
+        entry.
+        """
+        self._images.append((info, image))
+
+    def pack(self):
+        placements = pack_shelves(
+            [(image.width, image.height) for _, image in self._images],
+            self.page_width,
+            self.page_height,
+            self.padding,
+        )
+        self.entries = [
+            {
+                **info,
+                "page": page,
+                "x": x,
+                "y": y,
+                "width": image.width,
+                "height": image.height,
+            }
+            for (info, image), (page, x, y) in zip(
+                self._images, placements
+            )
+        ]
+        self.page_count = max((p[0] + 1 for p in placements), default=0)
+
+    def render_pages(
+        self, transparent: bool = False
+    ) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Yield (page, RGBA array) for every page. Pages are cropped to
+        the area actually used.
+        """
+        by_page = [[] for _ in range(self.page_count)]
+        for entry, (_, image) in zip(self.entries, self._images):
+            by_page[entry["page"]].append((entry, image))
+        for page, placed in enumerate(by_page):
+            with stats.timer("atlas.render"):
+                width = max(e["x"] + e["width"] for e, _ in placed)
+                height = max(e["y"] + e["height"] for e, _ in placed)
+                pixels = np.zeros((height, width, 4), "uint8")
+                for entry, image in placed:
+                    x, y = entry["x"], entry["y"]
+                    pixels[
+                        y:y + entry["height"], x:x + entry["width"]
+                    ] = image.rgba(transparent)
+            if stats.enabled:
+                stats.count("atlas.pages")
+                stats.count("atlas.images", len(placed))
+            yield page, pixels
+
+    def index(self, page_names: List[str]) -> dict:
+        return {
+            "pages": page_names,
+            "images": [
+                dict(entry, page=page_names[entry["page"]])
+                for entry in self.entries
+            ],
+        }
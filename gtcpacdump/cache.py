@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Content-addressed cache of decompressed subfiles.
+
+Entries are keyed by a hash of the compressed bytes, so identical
+payloads share an entry no matter which subarchive they came from. There
+is an in-memory LRU tier bounded in bytes and an optional on-disk tier
+with a size cap; the disk tier evicts least recently used files, using
+the mtime (which hits refresh) as the recency marker.
+"""
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from . import stats
+from .common import content_hash
+from .compression import stock_decompress
+
+log = logging.getLogger(__name__)
+
+
+class DecompressionCache:
+    def __init__(
+        self,
+        memory_limit: int = 64 << 20,
+        disk_dir: Optional[Path] = None,
+        disk_limit: int = 1 << 30,
+    ):
+        self.memory_limit = memory_limit
+        self.disk_dir = disk_dir
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _count(self, name: str):
+        setattr(self, name, getattr(self, name) + 1)
+        if stats.enabled:
+            stats.count(f"cache.{name}")
+
+    def decompress(self, data) -> bytes:
+        """
+        Drop-in replacement for stock_decompress that goes through the
+        cache.
+        """
+        if data[0] >> 4 == 0:
+            # Stored, not compressed; nothing to save.
+            return stock_decompress(data)
+        key = content_hash(data)
+        out = self.get(key)
+        if out is None:
+            self._count("misses")
+            out = bytes(stock_decompress(data))
+            self.put(key, out)
+        return out
+
+    def get(self, key: str) -> Optional[bytes]:
+        out = self._memory.get(key)
+        if out is not None:
+            self._memory.move_to_end(key)
+            self._count("memory_hits")
+            return out
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with path.open("rb") as f:
+                out = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        self._count("disk_hits")
+        self._put_memory(key, out)
+        return out
+
+    def put(self, key: str, data: bytes):
+        self._put_memory(key, data)
+        if self.disk_dir is not None:
+            self._put_disk(key, data)
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.memory_limit:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / key
+
+    def _disk_entries(self):
+        for path in self.disk_dir.glob("??/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                yield path, path.stat()
+            except OSError:
+                pass
+
+    def _put_disk(self, key: str, data: bytes):
+        if len(data) > self.disk_limit:
+            return
+        path = self._disk_path(key)
+        if self._disk_size is None:
+            self._disk_size = sum(st.st_size for _, st in self._disk_entries())
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+            with tmp_path.open("wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("Couldn't write cache entry %s: %s", path, e)
+            return
+        self._disk_size += len(data)
+        if self._disk_size > self.disk_limit:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        # Other processes may share the directory, so recount from disk
+        # rather than trusting the running total.
+        entries = sorted(self._disk_entries(), key=lambda e: e[1].st_mtime)
+        size = sum(st.st_size for _, st in entries)
+        target = self.disk_limit * 9 // 10
+        for path, st in entries:
+            if size <= target:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            size -= st.st_size
+            if stats.enabled:
+                stats.count("cache.disk_evictions")
+        self._disk_size = size
@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Header-only classification of subfiles.
+
+Only the compression header and the first 4 bytes of decompressed data
+(TiledImage's width and flags) are decoded. A subfile counts as an image
+if those describe whole tiles and the decompressed length covers the
+palette at offset 512 and every tile.
+"""
+import struct
+from collections import namedtuple
+from typing import Iterable
+
+from . import stats
+from .compression import decompress_prefix
+from .encoders import method_for_header
+
+# Read size when scanning in-memory data; small, so LZ77 decoding stops
+# soon after the header.
+SCAN_CHUNK_SIZE = 256
+PALETTE_OFFSET = 512
+TILE_SIZES = {"nds": (8, 8), "ios": (16, 16)}
+
+SubfileInfo = namedtuple(
+    "SubfileInfo",
+    (
+        "type",  # "image", "data" or "empty"
+        "compression",  # None, or the method name/header byte
+        "stored_size",
+        "size",  # decompressed
+        "width",
+        "height",
+        "bpp",
+    ),
+)
+
+
+def compression_name(header: int) -> str:
+    if header >> 4 == 0:
+        return "stored"
+    method = method_for_header(header)
+    if method is not None:
+        return method
+    return f"0x{header:02x}"
+
+
+def image_size(width: int, height: int, bpp: int) -> int:
+    """
+    Number of bytes TiledImage reads for an image of these dimensions.
+    """
+    palette = (16 if bpp == 4 else 256) * 2
+    return PALETTE_OFFSET + palette + width * height * bpp // 8
+
+
+def classify_header(
+    header: bytes, size: int, tile_size=(8, 8)
+) -> SubfileInfo:
+    """
+    Classify decompressed data of ``size`` bytes from its first 4 bytes.
+    """
+    if size < 4 or len(header) < 4:
+        kind = "data" if size else "empty"
+        return SubfileInfo(kind, None, None, size, None, None, None)
+    width, flags = struct.unpack_from("<HH", header)
+    height = flags & ~0x8000
+    bpp = 4 if flags & 0x8000 else 8
+    if (
+        width
+        and height
+        and not width % tile_size[0]
+        and not height % tile_size[1]
+        and image_size(width, height, bpp) <= size
+    ):
+        return SubfileInfo("image", None, None, size, width, height, bpp)
+    return SubfileInfo("data", None, None, size, None, None, None)
+
+
+def classify_chunks(
+    chunks: Iterable[bytes],
+    stored_size: int,
+    compressed: bool,
+    tile_size=(8, 8),
+) -> SubfileInfo:
+    """
+    Classify a subfile given its stored bytes in chunks, reading no more
+    of them than needed.
+    """
+    with stats.timer("classify"):
+        compression = None
+        if compressed:
+            chunks = iter(chunks)
+            first = next(chunks, b"")
+            if not first:
+                return SubfileInfo("empty", None, 0, 0, None, None, None)
+            compression = compression_name(first[0])
+            header, size = decompress_prefix(_prepend(first, chunks), 4)
+        else:
+            header = b""
+            for chunk in chunks:
+                header += bytes(chunk[:4 - len(header)])
+                if len(header) >= 4:
+                    break
+            size = stored_size
+        info = classify_header(header, size, tile_size)
+    if stats.enabled:
+        stats.count("classify.subfiles")
+        stats.count(f"classify.{info.type}")
+    return info._replace(compression=compression, stored_size=stored_size)
+
+
+def classify(data, compressed: bool, tile_size=(8, 8)) -> SubfileInfo:
+    """
+    Classify a subfile given all of its stored bytes.
+    """
+    view = memoryview(data)
+    return classify_chunks(
+        (
+            view[pos:pos + SCAN_CHUNK_SIZE]
+            for pos in range(0, len(view), SCAN_CHUNK_SIZE)
+        ),
+        len(view),
+        compressed,
+        tile_size,
+    )
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
@@ -1,11 +1,49 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import hashlib
+import logging
 import struct
 
 read_error = struct.error
 
 
+class BufferReader:
+    """
+    Minimal seekable reader over a bytes-like object.
+
+    Unlike BytesIO, it doesn't copy the underlying buffer, and ``read``
+    returns memoryview slices of it.
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def read(self, size: int = -1) -> memoryview:
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(self._pos + size, len(self._view))
+        out = self._view[self._pos:end]
+        self._pos = max(self._pos, end)
+        return out
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
 def read_type(stream, t):
     # Wrapper around struct.unpack to make it less ugly to use
     res = struct.unpack(f"<{t}", stream.read(struct.calcsize(f"<{t}")))
@@ -15,6 +53,19 @@ def read_type(stream, t):
         return res
 
 
+def content_hasher():
+    """
+    Incremental version of content_hash.
+    """
+    return hashlib.blake2b(digest_size=16)
+
+
+def content_hash(data) -> str:
+    hasher = content_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
 # Colors
 OKBLUE = "\033[94m"
 OKGREEN = "\033[92m"
@@ -22,3 +73,17 @@ WARNING = "\033[93m"
 FAIL = "\033[91m"
 ENDC = "\033[0m"
 BOLD = "\033[1m"
+
+
+class ColorFormatter(logging.Formatter):
+    LEVEL_COLORS = {
+        logging.DEBUG: OKBLUE,
+        logging.INFO: OKGREEN,
+        logging.WARNING: WARNING,
+        logging.ERROR: FAIL,
+        logging.CRITICAL: BOLD + FAIL,
+    }
+
+    def format(self, record: logging.LogRecord) -> str:
+        color = self.LEVEL_COLORS.get(record.levelno, "")
+        return f"{color}{super().format(record)}{ENDC}"
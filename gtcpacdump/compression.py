@@ -1,9 +1,14 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import struct
+import sys
+from array import array
 from io import BytesIO
-from typing import Tuple
-from .common import read_type
+from itertools import accumulate
+from typing import Iterator, Tuple
+from . import stats
+from .common import read_type, BufferReader
 
 
 def read_3_byte_uint(stream: BytesIO) -> int:
@@ -11,8 +16,18 @@ def read_3_byte_uint(stream: BytesIO) -> int:
     return i0 | (i1 << 8) | (i2 << 16)
 
 
-def stock_decompress(data: bytes) -> bytes:
-    stream = BytesIO(data)
+def stock_decompress(data, engine: str = "fast"):
+    # Stored (uncompressed) data is returned as a memoryview slice of data.
+    with stats.timer("decompress"):
+        out = _stock_decompress(data, engine)
+    if stats.enabled:
+        stats.count("decompress.bytes_in", len(data))
+        stats.count("decompress.bytes_out", len(out))
+    return out
+
+
+def _stock_decompress(data, engine: str):
+    stream = BufferReader(data)
     typ = read_type(stream, "B")
     variant = typ & 0x0F
     typ >>= 4
@@ -21,29 +36,33 @@ def stock_decompress(data: bytes) -> bytes:
     if compression == 0:
         data = stream.read(length)
     elif compression == 1:
-        data = lz77_decode(stream, length, variant == 1)
+        if engine == "fast":
+            data = lz77_decode_fast(data, length, variant == 1, 4)
+        elif engine == "stream":
+            data = lz77_decode(stream, length, variant == 1)
+        else:
+            raise ValueError(f"Unknown LZ77 engine: {engine}")
     elif compression == 2:
-        raise NotImplementedError("Huffman decompression not supported yet")
+        data = huffman_decode(data, length, variant, 4)
     elif compression == 3:
-        raise NotImplementedError("RLE decompression not supported yet")
+        data = rle_decode(data, length, 4)
     else:
         raise ValueError("Unknown compression")
 
     if (typ & 8) == 8:
-        raise ValueError("diffUnFilter not implemented yet")
+        data = diff_unfilter(data, 16 if variant == 2 else 8)
     return data
 
 
 def lz77_decode(
     stream: BytesIO, decoded_length: int, longlengths: bool
 ) -> bytes:
+    # Reference implementation, kept for verifying lz77_decode_fast.
     bit = 0x0
+    flagbyte = 0
     decoded = BytesIO()
     while len(decoded.getvalue()) < decoded_length:
-        flagbyte = 0
         bit = bit >> 1
-        if bit > 4294967295:
-            bit = 0
         if bit == 0:
             flagbyte = read_type(stream, "B")
             bit = 0x80
@@ -56,25 +75,26 @@ def lz77_decode(
             else:
                 readbyte = read_type(stream, "B")
                 length = readbyte >> 4
-                distance = readbyte & 0x0F << 8
+                distance = (readbyte & 0x0F) << 8
                 b = read_type(stream, "B")
                 distance |= b
                 length += 3
 
-            if distance > len(decoded.getvalue()):
+            if distance >= len(decoded.getvalue()):
                 raise ValueError("Hit seek past start of data")
 
             offset = len(decoded.getvalue()) - distance - 1
             readpos = offset
             for i in range(length):
                 decoded.seek(readpos)
-                readbyte = read_type(stream, "B")
+                readbyte = decoded.read(1)
                 decoded.seek(0, 2)
                 decoded.write(readbyte)
+                readpos += 1
         else:
             b = read_type(stream, "B")
             decoded.write(b.to_bytes(1, 'little'))
-    return decoded.getvalue()
+    return decoded.getvalue()[:decoded_length]
 
 
 def _lz77_longlengths_read_byte(stream: BytesIO) -> Tuple[int, int, int]:
@@ -91,7 +111,7 @@ def _lz77_longlengths_read_byte(stream: BytesIO) -> Tuple[int, int, int]:
         readbyte = read_type(stream, "B")
         distance |= readbyte
     elif b == 1:
-        length = (readbyte & 0xF) << 4
+        length = (readbyte & 0xF) << 12
         readbyte = read_type(stream, "B")
         length |= readbyte << 4
         readbyte = read_type(stream, "B")
@@ -107,3 +127,399 @@ def _lz77_longlengths_read_byte(stream: BytesIO) -> Tuple[int, int, int]:
         readbyte = read_type(stream, "B")
         distance |= readbyte
     return distance, length, readbyte
+
+
+def lz77_decode_fast(
+    data: bytes, decoded_length: int, longlengths: bool, pos: int = 0
+) -> bytes:
+    """
+    Decode LZ77 data starting at ``data[pos]`` into a preallocated buffer.
+
+    Produces the same output as :func:`lz77_decode`, but indexes the input
+    directly and copies non-overlapping back-references as slices.
+    """
+    decoded = bytearray(decoded_length)
+    out = 0
+    try:
+        while out < decoded_length:
+            flagbyte = data[pos]
+            pos += 1
+            for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if out >= decoded_length:
+                    break
+                if not flagbyte & bit:
+                    decoded[out] = data[pos]
+                    pos += 1
+                    out += 1
+                    continue
+
+                readbyte = data[pos]
+                if not longlengths:
+                    length = (readbyte >> 4) + 3
+                    distance = ((readbyte & 0x0F) << 8) | data[pos + 1]
+                    pos += 2
+                elif readbyte >> 4 == 0:
+                    b1 = data[pos + 1]
+                    length = ((readbyte << 4) | (b1 >> 4)) + 0x11
+                    distance = ((b1 & 0x0F) << 8) | data[pos + 2]
+                    pos += 3
+                elif readbyte >> 4 == 1:
+                    b2 = data[pos + 2]
+                    length = (
+                        ((readbyte & 0x0F) << 12)
+                        | (data[pos + 1] << 4)
+                        | (b2 >> 4)
+                    ) + 0x111
+                    distance = ((b2 & 0x0F) << 8) | data[pos + 3]
+                    pos += 4
+                else:
+                    length = (readbyte >> 4) + 1
+                    distance = ((readbyte & 0x0F) << 8) | data[pos + 1]
+                    pos += 2
+
+                if distance >= out:
+                    raise ValueError("Hit seek past start of data")
+                readpos = out - distance - 1
+                length = min(length, decoded_length - out)
+                if distance + 1 >= length:
+                    decoded[out:out + length] = decoded[
+                        readpos:readpos + length
+                    ]
+                    out += length
+                else:
+                    for readpos in range(readpos, readpos + length):
+                        decoded[out] = decoded[readpos]
+                        out += 1
+    except IndexError:
+        raise ValueError("Compressed data ended unexpectedly")
+    return bytes(decoded)
+
+
+# Huffman codes up to this many bits are decoded with a single table
+# lookup; longer ones fall back to a dict keyed by (length, code).
+HUFFMAN_TABLE_BITS = 10
+
+
+def _huffman_codes(data, tree_end: int):
+    """
+    Walk a BIOS Huffman tree (root at data[5]) and return a list of
+    ``(code, length, symbol)`` for its leaves.
+    """
+    codes = []
+    stack = [(5, 0, 0)]
+    while stack:
+        addr, code, length = stack.pop()
+        if length >= 64:
+            raise ValueError("Huffman tree is too deep")
+        node = data[addr]
+        child = (addr & ~1) + (node & 0x3F) * 2 + 2
+        if child + 1 >= tree_end:
+            raise ValueError("Huffman tree node points past the tree")
+        for bit, is_data in ((0, node & 0x80), (1, node & 0x40)):
+            child_code = (code << 1) | bit
+            if is_data:
+                codes.append((child_code, length + 1, data[child + bit]))
+            else:
+                stack.append((child + bit, child_code, length + 1))
+    return codes
+
+
+def huffman_decode(
+    data, decoded_length: int, symbol_bits: int, pos: int = 0
+) -> bytes:
+    """
+    Decode BIOS Huffman data whose tree size byte is at ``data[pos]``.
+
+    Codes are decoded through a lookup table indexed by the next
+    HUFFMAN_TABLE_BITS bits of the stream.
+    """
+    if symbol_bits not in (4, 8):
+        raise ValueError(f"Unsupported Huffman data size: {symbol_bits}")
+    if pos != 4:
+        data = data[pos - 4:]
+    tree_end = 4 + (data[4] + 1) * 2
+    codes = _huffman_codes(data, tree_end)
+    max_length = max(length for _, length, _ in codes)
+    table_bits = min(max_length, HUFFMAN_TABLE_BITS)
+    table = [None] * (1 << table_bits)
+    long_codes = {}
+    for code, length, symbol in codes:
+        if length <= table_bits:
+            first = code << (table_bits - length)
+            table[first:first + (1 << (table_bits - length))] = [
+                (symbol, length)
+            ] * (1 << (table_bits - length))
+        else:
+            long_codes[length, code] = symbol
+
+    word_count = (len(data) - tree_end) // 4
+    words = struct.unpack_from(f"<{word_count}I", data, tree_end)
+    total_bits = word_count * 32
+    word_index = 0
+    bitbuf = 0
+    bitcount = 0
+    table_mask = (1 << table_bits) - 1
+
+    symbols_per_byte = 8 // symbol_bits
+    decoded = bytearray(decoded_length)
+    for out in range(decoded_length):
+        byte = 0
+        for shift in range(0, 8, symbol_bits):
+            while bitcount < max_length:
+                word = words[word_index] if word_index < word_count else 0
+                word_index += 1
+                bitbuf = (bitbuf << 32) | word
+                bitcount += 32
+            entry = table[(bitbuf >> (bitcount - table_bits)) & table_mask]
+            if entry is not None:
+                symbol, length = entry
+            else:
+                length = table_bits
+                while True:
+                    length += 1
+                    if length > max_length:
+                        raise ValueError("Invalid Huffman code")
+                    code = (bitbuf >> (bitcount - length)) & (
+                        (1 << length) - 1
+                    )
+                    symbol = long_codes.get((length, code))
+                    if symbol is not None:
+                        break
+            bitcount -= length
+            bitbuf &= (1 << bitcount) - 1
+            byte |= symbol << shift
+        decoded[out] = byte
+    if word_index * 32 - bitcount > total_bits:
+        raise ValueError("Compressed data ended unexpectedly")
+    return bytes(decoded)
+
+
+def rle_decode(data, decoded_length: int, pos: int = 0) -> bytes:
+    """
+    Decode BIOS RLE data starting at ``data[pos]``, filling runs in bulk.
+    """
+    decoded = bytearray(decoded_length)
+    out = 0
+    try:
+        while out < decoded_length:
+            flag = data[pos]
+            if flag & 0x80:
+                length = min((flag & 0x7F) + 3, decoded_length - out)
+                decoded[out:out + length] = bytes((data[pos + 1],)) * length
+                pos += 2
+            else:
+                length = min((flag & 0x7F) + 1, decoded_length - out)
+                run = data[pos + 1:pos + 1 + length]
+                if len(run) != length:
+                    raise IndexError
+                decoded[out:out + length] = run
+                pos += 1 + length
+            out += length
+    except IndexError:
+        raise ValueError("Compressed data ended unexpectedly")
+    return bytes(decoded)
+
+
+def diff_unfilter(data, width: int = 8) -> bytes:
+    """
+    Undo the BIOS 8- or 16-bit difference filter (a running sum).
+    """
+    if width == 8:
+        return bytes(v & 0xFF for v in accumulate(data))
+    if len(data) % 2:
+        raise ValueError("16-bit diff filtered data has an odd length")
+    units = array("H", bytes(data))
+    if sys.byteorder == "big":
+        units.byteswap()
+    units = array("H", (v & 0xFFFF for v in accumulate(units)))
+    if sys.byteorder == "big":
+        units.byteswap()
+    return units.tobytes()
+
+
+# Largest LZ77 back-reference distance (12 bits, plus one)
+LZ77_WINDOW_SIZE = 0x1000
+
+
+class StreamDecompressor:
+    """
+    Incremental decoder for the formats stock_decompress reads.
+
+    Compressed data is passed to :meth:`feed` in chunks of any size, and
+    each call returns the output those chunks completed. For stored and
+    LZ77 data, only the last 4 KiB of output (the LZ77 window) and any
+    partial token are kept between calls. Huffman, RLE and diff filtered
+    data are buffered and decoded by :meth:`flush` once all input has
+    been fed.
+    """
+
+    def __init__(self):
+        self.decoded_length = None
+        self.written = 0
+        self._pending = bytearray()
+        self._window = bytearray()
+        self._compression = None
+        self._longlengths = False
+        self._flagbyte = 0
+        self._bit = 0
+        self._buffered = False
+
+    @property
+    def finished(self) -> bool:
+        return (
+            self.decoded_length is not None
+            and self.written >= self.decoded_length
+        )
+
+    def feed(self, data) -> bytes:
+        self._pending += data
+        if self.decoded_length is None:
+            if len(self._pending) < 4:
+                return b""
+            self._read_header()
+        if self._buffered:
+            return b""
+        if self._compression == 0:
+            out = bytes(
+                self._pending[:self.decoded_length - self.written]
+            )
+            self._pending.clear()
+        else:
+            out = self._lz77_feed()
+        self.written += len(out)
+        return out
+
+    def flush(self) -> bytes:
+        """
+        Signal the end of the input, returning any remaining output.
+        """
+        if not self._buffered:
+            return b""
+        out = bytes(stock_decompress(bytes(self._pending)))
+        self._pending.clear()
+        self.written += len(out)
+        return out
+
+    def _read_header(self):
+        header = self._pending[0]
+        typ = header >> 4
+        self.decoded_length = int.from_bytes(self._pending[1:4], "little")
+        if typ not in (0, 1):
+            # Keep the header for stock_decompress in flush().
+            self._buffered = True
+            return
+        self._compression = typ
+        self._longlengths = (header & 0x0F) == 1
+        del self._pending[:4]
+
+    def _lz77_feed(self) -> bytes:
+        data = self._pending
+        decoded = self._window
+        start = len(decoded)
+        remaining = self.decoded_length - self.written
+        pos = 0
+        end = len(data)
+        flagbyte = self._flagbyte
+        bit = self._bit
+        while len(decoded) - start < remaining:
+            if bit == 0:
+                if pos >= end:
+                    break
+                flagbyte = data[pos]
+                pos += 1
+                bit = 0x80
+            if not flagbyte & bit:
+                if pos >= end:
+                    break
+                decoded.append(data[pos])
+                pos += 1
+                bit >>= 1
+                continue
+
+            if pos >= end:
+                break
+            readbyte = data[pos]
+            if not self._longlengths or readbyte >> 4 > 1:
+                size = 2
+            else:
+                size = 3 if readbyte >> 4 == 0 else 4
+            if pos + size > end:
+                break
+            if not self._longlengths:
+                length = (readbyte >> 4) + 3
+                distance = ((readbyte & 0x0F) << 8) | data[pos + 1]
+            elif size == 3:
+                b1 = data[pos + 1]
+                length = ((readbyte << 4) | (b1 >> 4)) + 0x11
+                distance = ((b1 & 0x0F) << 8) | data[pos + 2]
+            elif size == 4:
+                b2 = data[pos + 2]
+                length = (
+                    ((readbyte & 0x0F) << 12)
+                    | (data[pos + 1] << 4)
+                    | (b2 >> 4)
+                ) + 0x111
+                distance = ((b2 & 0x0F) << 8) | data[pos + 3]
+            else:
+                length = (readbyte >> 4) + 1
+                distance = ((readbyte & 0x0F) << 8) | data[pos + 1]
+            pos += size
+            bit >>= 1
+
+            if distance >= len(decoded):
+                raise ValueError("Hit seek past start of data")
+            length = min(length, remaining - (len(decoded) - start))
+            readpos = len(decoded) - distance - 1
+            if distance + 1 >= length:
+                decoded += decoded[readpos:readpos + length]
+            else:
+                for readpos in range(readpos, readpos + length):
+                    decoded.append(decoded[readpos])
+
+        self._flagbyte = flagbyte
+        self._bit = bit
+        del data[:pos]
+        out = bytes(decoded[start:])
+        if len(decoded) > LZ77_WINDOW_SIZE:
+            del decoded[:len(decoded) - LZ77_WINDOW_SIZE]
+        return out
+
+
+def decompress_stream(chunks) -> Iterator[bytes]:
+    """
+    Decompress an iterable of compressed chunks, yielding output chunks.
+    """
+    decompressor = StreamDecompressor()
+    for chunk in chunks:
+        out = decompressor.feed(chunk)
+        if out:
+            yield out
+        if decompressor.finished:
+            return
+    out = decompressor.flush()
+    if out:
+        yield out
+    if not decompressor.finished:
+        raise ValueError("Compressed data ended unexpectedly")
+
+
+def decompress_prefix(chunks, length: int) -> Tuple[bytes, int]:
+    """
+    Decompress just enough of an iterable of compressed chunks to get
+    the first ``length`` bytes of output (or all of it, if shorter).
+
+    Returns the prefix and the total decompressed length from the
+    header. Stored and LZ77 data stop reading as soon as the prefix is
+    complete; other formats are decoded in full.
+    """
+    decompressor = StreamDecompressor()
+    out = bytearray()
+    for chunk in chunks:
+        out += decompressor.feed(chunk)
+        if len(out) >= length or decompressor.finished:
+            break
+    else:
+        out += decompressor.flush()
+    if decompressor.decoded_length is None:
+        raise ValueError("Compressed data ended unexpectedly")
+    return bytes(out[:length]), decompressor.decoded_length
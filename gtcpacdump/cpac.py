@@ -1,40 +1,84 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import logging
+import mmap
 from pathlib import Path
 from collections import namedtuple
 
-from gtcpacdump.common import OKBLUE, OKGREEN, WARNING, ENDC
-from .common import read_type
+from . import stats
+from .common import BufferReader
+
+log = logging.getLogger(__name__)
 
 SubarchivePointer = namedtuple("Subfile", ("offset", "size"))
 
 
 class CPAC:
-    def __init__(self, cpac_2d_path: Path):
+    def __init__(self, cpac_2d_path: Path, use_mmap: bool = False):
         self.cpac_path = cpac_2d_path
+        self.use_mmap = use_mmap
         self.subarchives = []
+        self._file = None
+        self._mmap = None
+        self._view = None
 
-    def parse_subfiles(self):
-        with self.cpac_path.open("rb") as f:
-            print(
-                f"  {OKBLUE}Reading {ENDC}{self.cpac_path.absolute()}"
-                f"{OKBLUE}...{ENDC} ",
-                end="",
-            )
-            self.subarchives = []
-            while True:
-                offset_size = read_type(f, "II")
-                self.subarchives.append(SubarchivePointer(*offset_size))
-                if f.tell() >= self.subarchives[0].offset:
-                    break
-            print(
-                f"{OKGREEN}OK!\n  Found "
-                f"{WARNING}{len(self.subarchives)}{OKGREEN} subfiles.{ENDC}"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _map(self) -> memoryview:
+        if self._view is None:
+            self._file = self.cpac_path.open("rb")
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ
             )
+            self._view = memoryview(self._mmap)
+        return self._view
+
+    def close(self):
+        if self._view is None:
+            return
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Slices handed out by open() are still alive; the mapping
+            # goes away when the last of them does.
+            pass
+        self._file.close()
+        self._file = self._mmap = self._view = None
+
+    def parse_subfiles(self):
+        log.info("  Reading %s...", self.cpac_path.absolute())
+        with stats.timer("cpac.parse_subfiles"):
+            if self.use_mmap:
+                self._parse_header(BufferReader(self._map()))
+            else:
+                with self.cpac_path.open("rb") as f:
+                    self._parse_header(f)
+        log.info("  Found %d subarchives.", len(self.subarchives))
+
+    def _parse_header(self, f):
+        from .entrytable import read_pointers
+
+        self.subarchives = read_pointers(f)
+
+    def open(self, id_: int):
+        """
+        Read subarchive ``id_``.
 
-    def open(self, id_: int) -> bytes:
+        Returns ``bytes``, or a read-only ``memoryview`` into the mapping
+        if the CPAC was opened with ``use_mmap``.
+        """
+        offset, size = self.subarchives[id_]
+        if stats.enabled:
+            stats.count("cpac.bytes_read", size)
+        if self.use_mmap:
+            return self._map()[offset:offset + size]
         with self.cpac_path.open("rb") as f:
-            f.seek(self.subarchives[id_].offset)
-            subfile = f.read(self.subarchives[id_].size)
+            f.seek(offset)
+            subfile = f.read(size)
         return subfile
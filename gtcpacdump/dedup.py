@@ -0,0 +1,237 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Deduplication of identical subfiles across subarchives.
+
+Subfiles are keyed by the hash of their stored (compressed) bytes, which
+needs no decompression, and the settings they are extracted with. Only
+the first copy is decoded and written; later copies are hardlinked to
+its outputs, or, where that isn't possible (outputs written into a zip
+or tar file, or a filesystem without hardlinks), listed in a
+``duplicates.json`` as references to them.
+
+First copies are remembered in ``.dedup-<kind>.json`` in the output
+root, so runs over other subarchives can link to them too.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from . import stats
+from .common import content_hash, content_hasher
+
+log = logging.getLogger(__name__)
+
+DEDUP_VERSION = 1
+DUPLICATES_FILE = "duplicates.json"
+
+
+def link_output(original: Path, target: Path) -> bool:
+    """
+    Replace ``target`` with a hardlink to ``original``, returning False
+    if the filesystem won't link them.
+    """
+    try:
+        target.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(original, target)
+    except OSError as e:
+        log.debug("Can't link %s to %s: %s", target, original, e)
+        return False
+    return True
+
+
+def file_hash(path: Path) -> Optional[str]:
+    hasher = content_hasher()
+    try:
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                hasher.update(chunk)
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+
+def rename_output(name: str, original: int, subfile: int) -> str:
+    # Output names start with the subfile index.
+    return str(subfile) + name[len(str(original)):]
+
+
+def write_references(directory: Path, references: Dict[str, str]):
+    """
+    Write ``duplicates.json`` to ``directory``, or remove a stale one if
+    there are no references.
+    """
+    path = directory / DUPLICATES_FILE
+    if not references:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        return
+    with path.open("w") as f:
+        json.dump(references, f, indent=1, sort_keys=True)
+
+
+class Deduplicator:
+    def __init__(self, root: Path = None, kind: str = None):
+        # Without a root (archive outputs), nothing can be linked and
+        # first copies are only remembered for this run.
+        self.root = root
+        self.path = None if root is None else root / f".dedup-{kind}.json"
+        # key -> {"directory", "subfile", "outputs", "seconds"}
+        self.originals = {}
+        self._verified = set()
+        self._seconds = {}
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        self.linked = 0
+        self.referenced = 0
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+        if self.path is not None:
+            try:
+                with self.path.open("r") as f:
+                    data = json.load(f)
+                if data.get("version") == DEDUP_VERSION:
+                    self.originals = data["originals"]
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError) as e:
+                log.warning("Ignoring unreadable dedup index %s: %s",
+                            self.path, e)
+
+    @staticmethod
+    def key(source_hash: str, settings: dict) -> str:
+        settings_hash = content_hash(
+            json.dumps(settings, sort_keys=True).encode()
+        )
+        return f"{source_hash}-{settings_hash[:16]}"
+
+    @contextmanager
+    def timing(self, key: str):
+        """
+        Count the time spent in the block towards decoding ``key``.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._seconds[key] = self._seconds.get(key, 0) + elapsed
+
+    def timed(self, key: str, fn):
+        """
+        Wrap a deferred payload so its run time counts towards ``key``.
+        """
+        def run():
+            with self.timing(key):
+                return fn()
+        return run
+
+    def original(
+        self, key: str, directory: str = None, subfile: int = None
+    ) -> Optional[dict]:
+        """
+        The first copy of ``key`` whose outputs are still intact, unless
+        that is ``subfile`` in ``directory`` itself.
+        """
+        entry = self.originals.get(key)
+        if entry is None:
+            return None
+        if entry["directory"] == directory and entry["subfile"] == subfile:
+            return None
+        if key not in self._verified:
+            base = self.root / entry["directory"]
+            for name, record in entry["outputs"].items():
+                if file_hash(base / name) != record["hash"]:
+                    del self.originals[key]
+                    return None
+            self._verified.add(key)
+        return entry
+
+    def add(
+        self,
+        key: str,
+        directory: str,
+        subfile: int,
+        outputs: Dict[str, dict],
+        seconds: float = None,
+    ):
+        """
+        Remember ``outputs`` ({name: output record}) of ``subfile``,
+        written to ``directory`` under the root, as the first copy of
+        ``key``.
+        """
+        if seconds is None:
+            seconds = self._seconds.pop(key, 0)
+        self.originals[key] = {
+            "directory": directory,
+            "subfile": subfile,
+            "outputs": outputs,
+            "seconds": seconds,
+        }
+        self._verified.add(key)
+
+    def materialize(
+        self, key: str, directory: Optional[Path], subfile: int
+    ) -> Tuple[Dict[str, dict], Dict[str, str]]:
+        """
+        Give ``subfile`` the outputs of the first copy of ``key``, which
+        must exist. Returns ({name: record} of outputs linked into
+        ``directory``, {name: reference} of the rest); references are
+        paths under the root, or names in the same archive if
+        ``directory`` is None.
+        """
+        entry = self.originals[key]
+        linked = {}
+        references = {}
+        for name, record in entry["outputs"].items():
+            target = rename_output(name, entry["subfile"], subfile)
+            if directory is not None and self.root is not None:
+                original = self.root / entry["directory"] / name
+                if link_output(original, directory / target):
+                    linked[target] = record
+                    continue
+                references[target] = f"{entry['directory']}/{name}"
+            else:
+                references[target] = name
+        self.duplicates += 1
+        self.linked += len(linked)
+        self.referenced += len(references)
+        saved = sum(r["size"] for r in entry["outputs"].values())
+        self.bytes_saved += saved
+        self.seconds_saved += entry["seconds"]
+        if stats.enabled:
+            stats.count("dedup.duplicates")
+            stats.count("dedup.bytes_saved", saved)
+        return linked, references
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(
+                {"version": DEDUP_VERSION, "originals": self.originals},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, self.path)
+
+    def summary(self) -> str:
+        return (
+            f"Deduplicated {self.duplicates} subfiles ({self.linked} outputs "
+            f"linked, {self.referenced} referenced), saving "
+            f"{self.bytes_saved} bytes and {self.seconds_saved:.2f}s of "
+            f"decoding."
+        )
@@ -0,0 +1,130 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Structural diff of two CPAC files.
+
+Subarchives are matched by index and compared byte for byte, so
+unchanged ones aren't even parsed. Within changed subarchives, subfiles
+are compared by the hash of their stored bytes; only those that differ
+are decompressed, to tell changed content from mere recompression.
+"""
+import logging
+from collections import namedtuple
+from typing import Iterator, List, Optional, Tuple
+
+from . import stats
+from .archive import Archive
+from .common import content_hash, read_error
+
+log = logging.getLogger(__name__)
+
+# status is "added", "removed", "changed" or "recompressed" (stored
+# bytes differ, decompressed ones don't). Subarchives that only one side
+# has are listed subfile by subfile, like changed ones. subfile is None
+# only for a subarchive that fails to parse on either side, which is
+# compared as a whole; its hashes and sizes are of the subarchive.
+Change = namedtuple(
+    "Change",
+    (
+        "status",
+        "subarchive",
+        "subfile",
+        "old_hash",
+        "new_hash",
+        "old_size",
+        "new_size",
+    ),
+)
+
+
+def _stored_hashes(
+    archive: Archive, i: int
+) -> Optional[List[Tuple[str, int]]]:
+    """
+    (hash, size) of the stored bytes of every subfile of subarchive
+    ``i``, an empty list if the archive has no such subarchive, or None
+    if it fails to parse.
+    """
+    if i >= len(archive.cpac.subarchives):
+        return []
+    try:
+        subarchive = archive.subarchive(i)
+    except (ValueError, IndexError, read_error) as e:
+        log.warning("Subarchive %d of %s doesn't parse: %s", i,
+                    archive.cpac.cpac_path, e)
+        return None
+    out = []
+    for j in range(len(subarchive.subfiles)):
+        data = subarchive.open(j, skip_decompression=True)
+        out.append((content_hash(data), len(data)))
+    return out
+
+
+def _hash(data) -> Optional[str]:
+    return None if data is None else content_hash(data)
+
+
+def _size(data) -> Optional[int]:
+    return None if data is None else len(data)
+
+
+def _content_changed(old: Archive, new: Archive, i: int, j: int) -> bool:
+    try:
+        return old.read(i, j) != new.read(i, j)
+    except (ValueError, IndexError):
+        return True
+
+
+def diff_archives(old: Archive, new: Archive) -> Iterator[Change]:
+    old_count = len(old.cpac.subarchives)
+    new_count = len(new.cpac.subarchives)
+    for i in range(max(old_count, new_count)):
+        if i < old_count and i < new_count:
+            with stats.timer("diff.compare"):
+                identical = bytes(old.cpac.open(i)) == bytes(
+                    new.cpac.open(i)
+                )
+            if identical:
+                if stats.enabled:
+                    stats.count("diff.identical_subarchives")
+                continue
+        with stats.timer("diff.hash"):
+            old_subfiles = _stored_hashes(old, i)
+            new_subfiles = _stored_hashes(new, i)
+        if old_subfiles is None or new_subfiles is None:
+            # Nothing to match subfiles against; compare whole
+            # subarchives.
+            old_data = old.cpac.open(i) if i < old_count else None
+            new_data = new.cpac.open(i) if i < new_count else None
+            if old_data is None:
+                status = "added"
+            elif new_data is None:
+                status = "removed"
+            else:
+                status = "changed"
+            yield Change(
+                status, i, None, _hash(old_data), _hash(new_data),
+                _size(old_data), _size(new_data),
+            )
+            continue
+        for j in range(max(len(old_subfiles), len(new_subfiles))):
+            old_hash, old_size = (
+                old_subfiles[j] if j < len(old_subfiles) else (None, None)
+            )
+            new_hash, new_size = (
+                new_subfiles[j] if j < len(new_subfiles) else (None, None)
+            )
+            if old_hash == new_hash:
+                continue
+            if old_hash is None:
+                status = "added"
+            elif new_hash is None:
+                status = "removed"
+            elif _content_changed(old, new, i, j):
+                status = "changed"
+            else:
+                status = "recompressed"
+            yield Change(
+                status, i, j, old_hash, new_hash, old_size, new_size
+            )
@@ -0,0 +1,370 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Compressors for the formats stock_decompress reads.
+"""
+import heapq
+import struct
+from collections import Counter
+from typing import Optional
+
+from . import stats
+
+LZ77_MAX_DISTANCE = 0x1000
+LZ77_MIN_LENGTH = 3
+LZ77_MAX_LENGTH = 18
+LZ77_LONG_MAX_LENGTH = 0x10110
+# How many earlier occurrences of a 3-byte prefix the match finder tries
+LZ77_MAX_CHAIN = 64
+
+
+def _header(typ: int, variant: int, length: int) -> bytearray:
+    if length >= 1 << 24:
+        raise ValueError("Data too large to compress")
+    return bytearray(struct.pack("<I", (typ << 4) | variant | (length << 8)))
+
+
+def _match_length(data: bytes, candidate: int, pos: int, limit: int) -> int:
+    # Compare in growing slices, which is much faster in Python than
+    # comparing byte by byte.
+    length = 0
+    step = 8
+    while length < limit:
+        chunk = min(step, limit - length)
+        if (
+            data[candidate + length:candidate + length + chunk]
+            == data[pos + length:pos + length + chunk]
+        ):
+            length += chunk
+            step <<= 1
+        elif chunk == 1:
+            break
+        else:
+            step = chunk >> 1
+    return length
+
+
+class _MatchFinder:
+    """
+    Hash-chain match finder over 3-byte prefixes.
+    """
+
+    def __init__(self, data: bytes, max_length: int):
+        self.data = data
+        self.max_length = max_length
+        self.head = {}
+        self.prev = [-1] * len(data)
+        self.inserted = 0
+
+    def insert_until(self, pos: int):
+        data = self.data
+        head = self.head
+        prev = self.prev
+        for i in range(self.inserted, min(pos, len(data) - 2)):
+            key = data[i:i + 3]
+            prev[i] = head.get(key, -1)
+            head[key] = i
+        self.inserted = max(self.inserted, pos)
+
+    def find(self, pos: int):
+        """
+        Return ``(length, distance)`` of the longest match at ``pos``.
+        """
+        data = self.data
+        limit = min(self.max_length, len(data) - pos)
+        if limit < LZ77_MIN_LENGTH:
+            return 0, 0
+        self.insert_until(pos)
+        candidate = self.head.get(data[pos:pos + 3], -1)
+        best_length = 0
+        best_distance = 0
+        chain = LZ77_MAX_CHAIN
+        prev = self.prev
+        while candidate >= 0 and chain:
+            distance = pos - candidate
+            if distance > LZ77_MAX_DISTANCE:
+                break
+            # Cheap reject: a longer match must agree at best_length.
+            if data[candidate + best_length] == data[pos + best_length]:
+                length = _match_length(data, candidate, pos, limit)
+                if length > best_length:
+                    best_length = length
+                    best_distance = distance
+                    if length == limit:
+                        break
+            candidate = prev[candidate]
+            chain -= 1
+        return best_length, best_distance
+
+
+def lz77_encode(data: bytes, longlengths: bool = False) -> bytes:
+    """
+    Compress with LZ77 (type 0x10, or 0x11 with ``longlengths``).
+
+    Uses a hash-chain match finder with one step of lazy matching: a match
+    is emitted only if the match starting one byte later isn't longer.
+    """
+    data = bytes(data)
+    max_length = LZ77_LONG_MAX_LENGTH if longlengths else LZ77_MAX_LENGTH
+    out = _header(1, 1 if longlengths else 0, len(data))
+    finder = _MatchFinder(data, max_length)
+    pos = 0
+    pending = None
+    while pos < len(data):
+        flag_pos = len(out)
+        out.append(0)
+        for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if pos >= len(data):
+                break
+            if pending is not None:
+                length, distance = pending
+                pending = None
+            else:
+                length, distance = finder.find(pos)
+            if length >= LZ77_MIN_LENGTH and length < max_length:
+                next_match = finder.find(pos + 1)
+                if next_match[0] > length + 1:
+                    # Emit a literal and take the longer match next.
+                    length = 0
+                    pending = next_match
+            if length < LZ77_MIN_LENGTH:
+                out.append(data[pos])
+                pos += 1
+                continue
+            out[flag_pos] |= bit
+            d = distance - 1
+            if not longlengths:
+                out.append(((length - 3) << 4) | (d >> 8))
+            elif length <= 0x10:
+                out.append(((length - 1) << 4) | (d >> 8))
+            elif length <= 0x110:
+                length_bits = length - 0x11
+                out.append(length_bits >> 4)
+                out.append(((length_bits & 0xF) << 4) | (d >> 8))
+            else:
+                length_bits = length - 0x111
+                out.append(0x10 | (length_bits >> 12))
+                out.append((length_bits >> 4) & 0xFF)
+                out.append(((length_bits & 0xF) << 4) | (d >> 8))
+            out.append(d & 0xFF)
+            pos += length
+    return bytes(out)
+
+
+def rle_encode(data: bytes) -> bytes:
+    """
+    Compress with BIOS RLE (type 0x30).
+    """
+    data = bytes(data)
+    out = _header(3, 0, len(data))
+    literal_start = 0
+    pos = 0
+    n = len(data)
+
+    def flush_literals(end):
+        for start in range(literal_start, end, 0x80):
+            chunk = data[start:min(start + 0x80, end)]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+
+    while pos < n:
+        byte = data[pos]
+        run_end = pos + 1
+        limit = min(n, pos + 0x82)
+        while run_end < limit and data[run_end] == byte:
+            run_end += 1
+        if run_end - pos >= 3:
+            flush_literals(pos)
+            out.append(0x80 | (run_end - pos - 3))
+            out.append(byte)
+            literal_start = pos = run_end
+        else:
+            pos = run_end
+    flush_literals(n)
+    return bytes(out)
+
+
+def _huffman_tree(symbols):
+    counts = Counter(symbols)
+    # A tree needs at least two leaves.
+    for filler in (0, 1):
+        if len(counts) < 2 and filler not in counts:
+            counts[filler] = 0
+    heap = [(count, i, symbol) for i, (symbol, count) in
+            enumerate(sorted(counts.items()))]
+    heapq.heapify(heap)
+    tiebreak = len(heap)
+    while len(heap) > 1:
+        count0, _, node0 = heapq.heappop(heap)
+        count1, _, node1 = heapq.heappop(heap)
+        heapq.heappush(heap, (count0 + count1, tiebreak, (node0, node1)))
+        tiebreak += 1
+    return heap[0][2]
+
+
+# Child pairs must lie within this many pairs after their parent's pair.
+HUFFMAN_MAX_OFFSET = 0x3F
+
+
+def _internal_counts(root) -> dict:
+    """
+    Map id() of every internal node to the number of internal nodes in
+    its subtree.
+    """
+    counts = {}
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        if done:
+            counts[id(node)] = 1 + sum(
+                counts[id(child)] for child in node
+                if isinstance(child, tuple)
+            )
+            continue
+        stack.append((node, True))
+        stack.extend(
+            (child, False) for child in node if isinstance(child, tuple)
+        )
+    return counts
+
+
+def _huffman_layout(root) -> list:
+    """
+    Order the child pairs of the tree's internal nodes so that each lies
+    within HUFFMAN_MAX_OFFSET pairs of its parent's pair, returning the
+    nodes in the order of their child pairs. The root is in pair -1.
+
+    Nodes whose subtrees are smallest have their children placed first,
+    which finishes subtrees early and keeps few nodes waiting; a node is
+    only placed out of that order when its children are about to fall
+    out of reach.
+    """
+    counts = _internal_counts(root)
+    layout = []
+    # (parent pair + HUFFMAN_MAX_OFFSET + 1, node): the deadline by
+    # which the node's children must be placed
+    waiting = [(HUFFMAN_MAX_OFFSET, root)]
+    while waiting:
+        pair = len(layout)
+        waiting.sort(key=lambda entry: entry[0])
+        slack = min(
+            deadline - pair - i for i, (deadline, _) in enumerate(waiting)
+        )
+        if slack < 0:
+            raise ValueError("Huffman tree too wide for the BIOS format")
+        if slack == 0:
+            pick = 0
+        else:
+            pick = min(
+                range(len(waiting)),
+                key=lambda i: counts[id(waiting[i][1])],
+            )
+        deadline, node = waiting.pop(pick)
+        layout.append(node)
+        for child in node:
+            if isinstance(child, tuple):
+                waiting.append((pair + HUFFMAN_MAX_OFFSET + 1, child))
+    return layout
+
+
+def huffman_encode(data: bytes, symbol_bits: int = 8) -> bytes:
+    """
+    Compress with BIOS Huffman (type 0x24 or 0x28).
+
+    The tree's 6-bit child offsets can't address every layout; see
+    _huffman_layout. ValueError is raised for the rare tree that still
+    doesn't fit.
+    """
+    if symbol_bits not in (4, 8):
+        raise ValueError(f"Unsupported Huffman data size: {symbol_bits}")
+    data = bytes(data)
+    if symbol_bits == 8:
+        symbols = data
+    else:
+        symbols = [n for byte in data for n in (byte & 0xF, byte >> 4)]
+    root = _huffman_tree(symbols)
+
+    # Tree table, indexed by address within the compressed data. The
+    # tree size byte is at 4 and the root at 5; child pairs start at 6.
+    tree = {}
+    codes = {}
+    # id() of internal node -> (address, code)
+    nodes = {id(root): (5, "")}
+    for pair, node in enumerate(_huffman_layout(root)):
+        addr, code = nodes[id(node)]
+        child_addr = 6 + pair * 2
+        flags = 0
+        for bit, child in enumerate(node):
+            if isinstance(child, tuple):
+                nodes[id(child)] = (child_addr + bit, code + str(bit))
+            else:
+                flags |= 0x80 >> bit
+                tree[child_addr + bit] = child
+                codes[child] = code + str(bit)
+        tree[addr] = flags | ((child_addr - (addr & ~1) - 2) // 2)
+    # The bitstream is read in 32-bit words, aligned like the tree.
+    tree_end = 6 + len(nodes) * 2
+    tree_end += -tree_end % 4
+
+    out = _header(2, symbol_bits, len(data))
+    out.append((tree_end - 4) // 2 - 1)
+    out.extend(tree.get(addr, 0) for addr in range(5, tree_end))
+    bits = "".join(codes[symbol] for symbol in symbols)
+    bits += "0" * (-len(bits) % 32)
+    out += struct.pack(
+        f"<{len(bits) // 32}I",
+        *(int(bits[i:i + 32], 2) for i in range(0, len(bits), 32)),
+    )
+    return bytes(out)
+
+
+COMPRESSORS = {
+    "lz77": lambda data: lz77_encode(data, False),
+    "lz77-long": lambda data: lz77_encode(data, True),
+    "rle": rle_encode,
+    "huffman4": lambda data: huffman_encode(data, 4),
+    "huffman8": lambda data: huffman_encode(data, 8),
+}
+
+# Compression header byte for each method
+METHOD_HEADERS = {
+    "lz77": 0x10,
+    "lz77-long": 0x11,
+    "rle": 0x30,
+    "huffman4": 0x24,
+    "huffman8": 0x28,
+}
+
+
+def method_for_header(header: int) -> Optional[str]:
+    for method, value in METHOD_HEADERS.items():
+        if value == header:
+            return method
+    return None
+
+
+def stock_compress(data: bytes, method: str = "lz77") -> bytes:
+    """
+    Compress ``data`` with the given method, or with whichever method
+    gives the smallest output if ``method`` is "best".
+    """
+    with stats.timer("compress"):
+        if method == "best":
+            candidates = []
+            for compress in COMPRESSORS.values():
+                try:
+                    candidates.append(compress(data))
+                except ValueError:
+                    continue
+            out = min(candidates, key=len)
+        else:
+            try:
+                compress = COMPRESSORS[method]
+            except KeyError:
+                raise ValueError(f"Unknown compression method: {method}")
+            out = compress(data)
+    if stats.enabled:
+        stats.count("compress.bytes_in", len(data))
+        stats.count("compress.bytes_out", len(out))
+    return out
@@ -0,0 +1,187 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Columnar CPAC header and YEKB/YEKP tables.
+
+Tables are read in one go with ``np.frombuffer`` and kept as NumPy
+columns. Indexing a table builds the row object (a SubarchivePointer or
+SubfileEntry) on demand, so large subarchives don't carry one Python
+object per subfile.
+"""
+from collections.abc import Sequence
+
+import numpy as np
+
+from .common import read_error, read_type
+from .cpac import SubarchivePointer
+from .subarchive import SubfileEntry
+
+FLAG = 0x80000000
+POINTER_DTYPE = np.dtype([("offset", "<u4"), ("size", "<u4")])
+YEKB_DTYPE = np.dtype([("mixed1", "<u4"), ("mixed2", "<u4")])
+YEKP_DTYPE = np.dtype("<u4")
+# Stored in the size column for YEKP entries readYEKP leaves unsized
+NO_SIZE = -1
+
+
+class PointerTable(Sequence):
+    def __init__(
+        self, offsets: np.ndarray, sizes: np.ndarray, row=SubarchivePointer
+    ):
+        self.offsets = offsets
+        self.sizes = sizes
+        # (offset, size) namedtuple rows are built as
+        self.row = row
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PointerTable(self.offsets[i], self.sizes[i], self.row)
+        return self.row(int(self.offsets[i]), int(self.sizes[i]))
+
+    def __iter__(self):
+        return map(self.row, self.offsets.tolist(), self.sizes.tolist())
+
+
+class SubfileTable(Sequence):
+    def __init__(
+        self,
+        offsets: np.ndarray,
+        sizes: np.ndarray,
+        compressed: np.ndarray,
+        unknown_flags: np.ndarray,
+    ):
+        self.offsets = offsets
+        self.sizes = sizes
+        self.compressed = compressed
+        self.unknown_flags = unknown_flags
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return SubfileTable(
+                self.offsets[i],
+                self.sizes[i],
+                self.compressed[i],
+                self.unknown_flags[i],
+            )
+        size = int(self.sizes[i])
+        return SubfileEntry(
+            offset=int(self.offsets[i]),
+            size=None if size == NO_SIZE else size,
+            compressed=bool(self.compressed[i]),
+            unknown_flag=bool(self.unknown_flags[i]),
+        )
+
+    def __iter__(self):
+        for offset, size, compressed, unknown_flag in zip(
+            self.offsets.tolist(),
+            self.sizes.tolist(),
+            self.compressed.tolist(),
+            self.unknown_flags.tolist(),
+        ):
+            yield SubfileEntry(
+                offset, None if size == NO_SIZE else size, compressed,
+                unknown_flag,
+            )
+
+
+def _read_records(stream, dtype: np.dtype, count: int) -> np.ndarray:
+    raw = stream.read(count * dtype.itemsize)
+    if len(raw) < count * dtype.itemsize:
+        raise ValueError("Table is truncated")
+    return np.frombuffer(raw, dtype, count)
+
+
+def _record_count(start: int, end: int, itemsize: int) -> int:
+    # Tables run up to ``end``, but always hold at least one record.
+    return max(1, -(-(end - start) // itemsize))
+
+
+def read_pointers(
+    stream, row=SubarchivePointer, data_size: int = None
+) -> PointerTable:
+    """
+    Read the CPAC header (or a split archive's table): (offset, size)
+    pairs up to the first entry. If ``data_size`` is given, entries must
+    lie between the end of the table and ``data_size``.
+    """
+    start = stream.tell()
+    try:
+        first_offset, first_size = read_type(stream, "II")
+    except read_error:
+        raise ValueError("Table is truncated") from None
+    rest = _record_count(start, first_offset, POINTER_DTYPE.itemsize) - 1
+    records = _read_records(stream, POINTER_DTYPE, rest)
+    offsets = np.empty(rest + 1, np.int64)
+    sizes = np.empty(rest + 1, np.int64)
+    offsets[0], sizes[0] = first_offset, first_size
+    offsets[1:] = records["offset"]
+    sizes[1:] = records["size"]
+    if data_size is not None:
+        table_end = start + len(offsets) * POINTER_DTYPE.itemsize
+        bad = np.flatnonzero(
+            (offsets < table_end) | (offsets + sizes > data_size)
+        )
+        if len(bad):
+            i = bad[0]
+            raise ValueError(
+                f"Entry {i} (offset {offsets[i]}, size {sizes[i]}) lies "
+                f"outside the {table_end}-{data_size} data region"
+            )
+    return PointerTable(offsets, sizes, row)
+
+
+def read_yekb(stream, start: int, data_base_offset: int) -> SubfileTable:
+    stream.seek(start)
+    records = _read_records(
+        stream,
+        YEKB_DTYPE,
+        _record_count(start, data_base_offset, YEKB_DTYPE.itemsize),
+    )
+    mixed1 = records["mixed1"]
+    mixed2 = records["mixed2"]
+    sizes = (mixed2 & ~np.uint32(FLAG)).astype(np.int64)
+    # Zero-sized entries are padding.
+    keep = sizes != 0
+    return SubfileTable(
+        (mixed1[keep] & ~np.uint32(FLAG)).astype(np.int64),
+        sizes[keep],
+        (mixed2[keep] & FLAG) != 0,
+        (mixed1[keep] & FLAG) != 0,
+    )
+
+
+def read_yekp(
+    stream, start: int, data_base_offset: int, data_size: int
+) -> SubfileTable:
+    stream.seek(start)
+    records = _read_records(
+        stream,
+        YEKP_DTYPE,
+        _record_count(start, data_base_offset, YEKP_DTYPE.itemsize),
+    )
+    offsets = (records & ~np.uint32(FLAG)).astype(np.int64)
+    # Each entry's size runs up to the next offset. The last three
+    # entries (every entry, in tables that short) are left unsized.
+    sized = max(len(offsets) - 3, 0)
+    sizes = np.full(len(offsets), NO_SIZE, np.int64)
+    sizes[:sized] = np.diff(offsets)[:sized]
+    overruns = np.flatnonzero(sizes[:sized] + offsets[:sized] >= data_size)
+    if len(overruns):
+        i = overruns[0]
+        raise ValueError(
+            f"YEKP entry {i} (offset {offsets[i]}, size {sizes[i]}) runs "
+            f"past the end of the {data_size}-byte subarchive"
+        )
+    return SubfileTable(
+        offsets,
+        sizes,
+        (records & FLAG) != 0,
+        np.zeros(len(offsets), bool),
+    )
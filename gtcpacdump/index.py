@@ -0,0 +1,283 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Persistent index of a CPAC file's layout.
+
+The index records every subarchive pointer, each subarchive's data base
+offset and table of subfiles, so listing and reading single subfiles
+doesn't need to parse anything. It is stored as JSON next to the CPAC
+file and is keyed by the file's size, mtime and a content hash.
+
+Loading an index only needs the standard library; PIL and NumPy are
+only pulled in when the index has to be rebuilt.
+"""
+import copy
+import hashlib
+import json
+import logging
+import os
+from collections import namedtuple
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from .common import read_error
+from .compression import stock_decompress
+from .cpac import SubarchivePointer
+
+log = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".index.json"
+
+IndexedSubfile = namedtuple(
+    "IndexedSubfile", ("offset", "size", "compressed", "unknown_flag")
+)
+
+
+class IndexedSubarchive:
+    def __init__(
+        self,
+        pointer: SubarchivePointer,
+        data_base_offset: int = 0,
+        subfiles: List[IndexedSubfile] = None,
+        error: str = None,
+    ):
+        self.pointer = pointer
+        self.data_base_offset = data_base_offset
+        self.subfiles = subfiles or []
+        # Set if the subarchive couldn't be parsed when indexing.
+        self.error = error
+
+    def to_json(self) -> dict:
+        out = {
+            "offset": self.pointer.offset,
+            "size": self.pointer.size,
+            "data_base_offset": self.data_base_offset,
+            "subfiles": [list(sf) for sf in self.subfiles],
+        }
+        if self.error is not None:
+            out["error"] = self.error
+        return out
+
+    @classmethod
+    def from_json(cls, data: dict) -> "IndexedSubarchive":
+        return cls(
+            SubarchivePointer(data["offset"], data["size"]),
+            data["data_base_offset"],
+            [IndexedSubfile(*sf) for sf in data["subfiles"]],
+            data.get("error"),
+        )
+
+
+def file_hash(path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def default_index_path(cpac_path: Path) -> Path:
+    return cpac_path.with_name(cpac_path.name + INDEX_SUFFIX)
+
+
+class CPACIndex:
+    def __init__(
+        self,
+        cpac_path: Path,
+        subarchives: List[IndexedSubarchive],
+        size: int = 0,
+        mtime_ns: int = 0,
+        content_hash: str = "",
+    ):
+        self.cpac_path = cpac_path
+        self.subarchives = subarchives
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.content_hash = content_hash
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def reader(self) -> "CPACIndex":
+        """
+        A copy of the index with its own file handle, so that another
+        thread can read subfiles alongside this one. Close it when done.
+        """
+        reader = copy.copy(self)
+        reader._file = None
+        return reader
+
+    @property
+    def pointers(self) -> List[SubarchivePointer]:
+        return [sa.pointer for sa in self.subarchives]
+
+    @classmethod
+    def build(cls, cpac_path: Path) -> "CPACIndex":
+        # Deferred: parsing subarchives imports the image code.
+        from .cpac import CPAC
+        from .subarchive import SubArchive
+
+        log.info("Building index of %s...", cpac_path)
+        st = cpac_path.stat()
+        content_hash = file_hash(cpac_path)
+        subarchives = []
+        with CPAC(cpac_path, use_mmap=True) as cpac:
+            cpac.parse_subfiles()
+            for i, pointer in enumerate(cpac.subarchives):
+                try:
+                    subarchive = SubArchive(cpac.open(i))
+                    subarchive.parse()
+                except (ValueError, IndexError, read_error) as e:
+                    subarchives.append(
+                        IndexedSubarchive(pointer, error=str(e))
+                    )
+                    continue
+                subarchives.append(
+                    IndexedSubarchive(
+                        pointer,
+                        subarchive.data_base_offset,
+                        [
+                            IndexedSubfile(
+                                sf.offset,
+                                sf.size,
+                                sf.compressed,
+                                sf.unknown_flag,
+                            )
+                            for sf in subarchive.subfiles
+                        ],
+                    )
+                )
+        return cls(
+            cpac_path, subarchives, st.st_size, st.st_mtime_ns, content_hash
+        )
+
+    @classmethod
+    def load(cls, cpac_path: Path, index_path: Path) -> "CPACIndex":
+        with index_path.open("r") as f:
+            data = json.load(f)
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError("Unsupported index version")
+        return cls(
+            cpac_path,
+            [IndexedSubarchive.from_json(sa) for sa in data["subarchives"]],
+            data["size"],
+            data["mtime_ns"],
+            data["hash"],
+        )
+
+    def save(self, index_path: Path):
+        data = {
+            "version": INDEX_VERSION,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "hash": self.content_hash,
+            "subarchives": [sa.to_json() for sa in self.subarchives],
+        }
+        tmp_path = index_path.with_name(index_path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, index_path)
+
+    def is_fresh(self) -> bool:
+        """
+        Check the index against the CPAC file, refreshing the stored mtime
+        if only that changed.
+        """
+        st = self.cpac_path.stat()
+        if st.st_size != self.size:
+            return False
+        if st.st_mtime_ns == self.mtime_ns:
+            return True
+        if file_hash(self.cpac_path) != self.content_hash:
+            return False
+        self.mtime_ns = st.st_mtime_ns
+        return True
+
+    @classmethod
+    def open(
+        cls, cpac_path: Path, index_path: Optional[Path] = None
+    ) -> "CPACIndex":
+        """
+        Load the index for ``cpac_path``, rebuilding and saving it if it is
+        missing or stale.
+        """
+        if index_path is None:
+            index_path = default_index_path(cpac_path)
+        index = None
+        try:
+            index = cls.load(cpac_path, index_path)
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("Ignoring unreadable index %s: %s", index_path, e)
+
+        mtime_ns = index.mtime_ns if index is not None else None
+        if index is None or not index.is_fresh():
+            index = cls.build(cpac_path)
+        elif index.mtime_ns == mtime_ns:
+            log.debug("Using index %s.", index_path)
+            return index
+        try:
+            index.save(index_path)
+        except OSError as e:
+            log.warning("Couldn't save index to %s: %s", index_path, e)
+        return index
+
+    def locate(self, subarchive: int, subfile: int):
+        """
+        Return the absolute offset and size of a subfile, and its entry.
+        """
+        sa = self.subarchives[subarchive]
+        if sa.error is not None:
+            raise ValueError(sa.error)
+        entry = sa.subfiles[subfile]
+        if entry.size is None:
+            # Trailing YEKP entries have no known size; read to the end of
+            # the subarchive, like SubArchive.open does.
+            size = sa.pointer.size - sa.data_base_offset - entry.offset
+        else:
+            size = entry.size
+        offset = sa.pointer.offset + sa.data_base_offset + entry.offset
+        return offset, size, entry
+
+    def _seek(self, offset: int):
+        if self._file is None:
+            self._file = self.cpac_path.open("rb")
+        self._file.seek(offset)
+
+    def read_subfile(
+        self, subarchive: int, subfile: int, decompress: bool = False
+    ) -> bytes:
+        offset, size, entry = self.locate(subarchive, subfile)
+        self._seek(offset)
+        out = self._file.read(size)
+        if entry.compressed and decompress:
+            out = stock_decompress(out)
+        return out
+
+    def iter_subfile(
+        self, subarchive: int, subfile: int, chunk_size: int = 1 << 16
+    ) -> Iterator[bytes]:
+        """
+        Yield a subfile's raw (compressed) bytes in chunks.
+        """
+        offset, size, _ = self.locate(subarchive, subfile)
+        while size > 0:
+            self._seek(offset)
+            chunk = self._file.read(min(chunk_size, size))
+            if not chunk:
+                break
+            yield chunk
+            offset += len(chunk)
+            size -= len(chunk)
@@ -0,0 +1,150 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Manifests of previously extracted outputs, for incremental re-extraction.
+
+Each output directory gets one manifest per command. An entry records
+where a subfile came from, the hash of its compressed bytes, the
+settings it was extracted with and the files written for it, so later
+runs can skip subfiles whose inputs and settings are unchanged.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+from .common import content_hash
+
+log = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def output_record(data) -> dict:
+    return {"hash": content_hash(data), "size": len(data)}
+
+
+def make_entry(
+    source: Tuple[int, int],
+    source_hash: str,
+    settings: dict,
+    outputs: Dict[str, Union[bytes, dict]],
+) -> dict:
+    """
+    Build a manifest entry. ``outputs`` maps file names to the data
+    written, or to an already computed output_record for streamed
+    outputs.
+    """
+    return {
+        "source": list(source),
+        "source_hash": source_hash,
+        "settings": settings,
+        "outputs": {
+            name: data if isinstance(data, dict) else output_record(data)
+            for name, data in outputs.items()
+        },
+    }
+
+
+def entry_is_current(
+    entry: Optional[dict], directory: Path, source_hash: str, settings: dict
+) -> bool:
+    """
+    Check a manifest entry against a subfile's current hash and settings,
+    and that the outputs it lists are still on disk.
+    """
+    if entry is None:
+        return False
+    if entry["source_hash"] != source_hash or entry["settings"] != settings:
+        return False
+    for name, output in entry["outputs"].items():
+        try:
+            if (directory / name).stat().st_size != output["size"]:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+class Manifest:
+    def __init__(self, directory: Path, name: str):
+        self.directory = directory
+        self.path = directory / f".manifest-{name}.json"
+        self.entries = {}
+        self._seen = set()
+        try:
+            with self.path.open("r") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data["entries"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            log.warning("Ignoring unreadable manifest %s: %s", self.path, e)
+
+    def get(self, subfile: int) -> Optional[dict]:
+        return self.entries.get(str(subfile))
+
+    def mark_seen(self, subfile: int):
+        self._seen.add(str(subfile))
+
+    def is_current(
+        self, subfile: int, source_hash: str, settings: dict
+    ) -> bool:
+        self.mark_seen(subfile)
+        return entry_is_current(
+            self.get(subfile), self.directory, source_hash, settings
+        )
+
+    def set_entry(self, subfile: int, entry: dict):
+        """
+        Replace a subfile's entry, removing outputs it no longer lists.
+        """
+        key = str(subfile)
+        self._seen.add(key)
+        old = self.entries.get(key)
+        if old is not None:
+            self._remove_outputs(old, keep=entry["outputs"])
+        self.entries[key] = entry
+
+    def record(
+        self,
+        subfile: int,
+        source: Tuple[int, int],
+        source_hash: str,
+        settings: dict,
+        outputs: Dict[str, Union[bytes, dict]],
+    ):
+        self.set_entry(
+            subfile, make_entry(source, source_hash, settings, outputs)
+        )
+
+    def _remove_outputs(self, entry: dict, keep=()):
+        for name in entry["outputs"]:
+            if name in keep:
+                continue
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+
+    def prune(self) -> int:
+        """
+        Drop entries, and their outputs, for subfiles not seen in this run.
+        """
+        stale = [key for key in self.entries if key not in self._seen]
+        for key in stale:
+            self._remove_outputs(self.entries.pop(key))
+        return len(stale)
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(
+                {"version": MANIFEST_VERSION, "entries": self.entries},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,285 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Output sinks and a background writer.
+
+Outputs go either to a directory, one file each, or into a single zip or
+tar file written sequentially. BackgroundWriter runs the sink (and any
+deferred work such as PNG encoding) on its own thread behind a bounded
+queue, so decoding the next subfile overlaps with writing the last one.
+"""
+import logging
+import queue
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Iterable, List, Union
+
+from . import stats
+from .common import content_hasher
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_FORMATS = ("zip", "tar")
+# Zip members larger than this are staged on disk rather than in memory
+ZIP_SPOOL_SIZE = 16 * 1024 * 1024
+# Extensions of outputs that are already compressed
+STORED_EXTENSIONS = (".png",)
+
+
+# Image output format -> file extension
+IMAGE_FORMATS = {
+    "png": "png",
+    "indexed": "png",
+    "raw": "rgba",
+    "npy": "npy",
+}
+
+
+def encode_png(im, level: int = None) -> bytes:
+    """
+    Encode a PIL image as PNG, with Pillow's default zlib level unless
+    ``level`` is given.
+    """
+    with stats.timer("png.write"):
+        buf = BytesIO()
+        if level is None:
+            im.save(buf, "PNG")
+        else:
+            im.save(buf, "PNG", compress_level=level)
+    if stats.enabled:
+        stats.count("png.written")
+    return buf.getvalue()
+
+
+def image_file_name(stem: str, image, image_format: str) -> str:
+    if image_format == "raw":
+        # Raw pixels carry no header, so the size goes in the name.
+        return f"{stem}.{image.width}x{image.height}.rgba"
+    return f"{stem}.{IMAGE_FORMATS[image_format]}"
+
+
+def encode_image(
+    image,
+    image_format: str = "png",
+    png_level: int = None,
+    transparent: bool = False,
+    palette_offset: int = 0,
+    palette=None,
+) -> bytes:
+    """
+    Encode a parsed TiledImage as an RGBA PNG ("png"), a paletted PNG
+    ("indexed"), bare RGBA bytes ("raw") or a (height, width, 4) NumPy
+    array ("npy"). ``palette`` and ``palette_offset`` are passed on to
+    the TiledImage.
+    """
+    if image_format == "png":
+        return encode_png(
+            image.dump(transparent, palette_offset, palette), png_level
+        )
+    if image_format == "indexed":
+        return encode_png(
+            image.dump_indexed(transparent, palette_offset, palette),
+            png_level,
+        )
+    if image_format == "raw":
+        return image.rgba(transparent, palette_offset, palette).tobytes()
+    if image_format == "npy":
+        # Deferred: the rest of this module doesn't need NumPy.
+        import numpy as np
+
+        buf = BytesIO()
+        np.save(buf, image.rgba(transparent, palette_offset, palette))
+        return buf.getvalue()
+    raise ValueError(f"Invalid image format: {image_format}")
+
+
+def open_new(path: Path):
+    """
+    Open ``path`` for writing as a new file, so that other names
+    hardlinked to the old one keep their contents.
+    """
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    return path.open("wb")
+
+
+class DirectoryOutput:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+
+    def write(self, name: str, chunks: Iterable[bytes]) -> dict:
+        """
+        Write ``chunks`` to ``name``, returning the manifest record of the
+        output.
+        """
+        hasher = content_hasher()
+        size = 0
+        path = self.directory / name
+        try:
+            with open_new(path) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+        except BaseException:
+            if path.exists():
+                path.unlink()
+            raise
+        return {"hash": hasher.hexdigest(), "size": size}
+
+    def close(self):
+        pass
+
+
+class ZipOutput:
+    def __init__(self, path: Path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, "w")
+
+    def write(self, name: str, chunks: Iterable[bytes]) -> dict:
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        if name.endswith(STORED_EXTENSIONS):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        hasher = content_hasher()
+        size = 0
+        # Stage the data first: a member can't be taken back out of the
+        # zip if the chunks fail partway.
+        with tempfile.SpooledTemporaryFile(ZIP_SPOOL_SIZE) as staged:
+            for chunk in chunks:
+                staged.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+            staged.seek(0)
+            with self._zip.open(info, "w", force_zip64=True) as f:
+                shutil.copyfileobj(staged, f)
+        return {"hash": hasher.hexdigest(), "size": size}
+
+    def close(self):
+        self._zip.close()
+
+
+class TarOutput:
+    def __init__(self, path: Path):
+        self.path = path
+        # Stream mode: members are written strictly sequentially.
+        self._tar = tarfile.open(path, "w|")
+
+    def write(self, name: str, chunks: Iterable[bytes]) -> dict:
+        # Tar headers come first and hold the size, so join the chunks.
+        data = b"".join(chunks)
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, BytesIO(data))
+        hasher = content_hasher()
+        hasher.update(data)
+        return {"hash": hasher.hexdigest(), "size": len(data)}
+
+    def close(self):
+        self._tar.close()
+
+
+def open_output(
+    directory: Path, name: str, kind: str, archive_format: str = None
+):
+    """
+    Open ``directory/name/``, or ``directory/name-kind.zip``/``.tar`` if
+    ``archive_format`` is given. ``kind`` keeps archives written by
+    different commands apart.
+    """
+    if archive_format is None:
+        return DirectoryOutput(directory / name)
+    directory.mkdir(parents=True, exist_ok=True)
+    if archive_format == "zip":
+        return ZipOutput(directory / f"{name}-{kind}.zip")
+    if archive_format == "tar":
+        return TarOutput(directory / f"{name}-{kind}.tar")
+    raise ValueError(f"Invalid archive format: {archive_format}")
+
+
+# A job's payload is either the chunks to write or a callable producing
+# them on the writer thread.
+Payload = Union[Iterable[bytes], Callable[[], Iterable[bytes]]]
+
+
+class BackgroundWriter:
+    def __init__(self, output, queue_size: int = 32, keep_going=False):
+        self.output = output
+        # (key, name, record) of every output written, in order
+        self.records = []
+        # With keep_going, failed jobs are collected as (key, name,
+        # exception) instead of stopping the writer.
+        self.keep_going = keep_going
+        self.errors = []
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name="output-writer", daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(raise_errors=exc_type is None)
+
+    def submit(self, key, name: str, payload: Payload):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((key, name, payload))
+
+    def flush(self):
+        """
+        Wait until every job submitted so far has been written.
+        """
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._write(*job)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, key, name: str, payload: Payload):
+        if self._error is not None:
+            # Keep draining so submit() doesn't block forever.
+            return
+        try:
+            chunks = payload() if callable(payload) else payload
+            record = self.output.write(name, chunks)
+        except Exception as e:
+            log.error("ERROR: writing %s: %s.", name, e)
+            if self.keep_going:
+                self.errors.append((key, name, e))
+            else:
+                self._error = e
+            return
+        except BaseException as e:
+            self._error = e
+            return
+        self.records.append((key, name, record))
+
+    def close(self, raise_errors: bool = True) -> List[tuple]:
+        self._queue.put(None)
+        self._thread.join()
+        self.output.close()
+        if raise_errors and self._error is not None:
+            raise self._error
+        return self.records
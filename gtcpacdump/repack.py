@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Rebuilding subarchives and CPAC files.
+
+``unpack_subarchive`` writes every subfile of a subarchive, decompressed,
+to a directory along with a ``layout.json`` describing the table type and
+per-subfile flags. ``pack_directory`` turns such a directory back into a
+subarchive, recompressing edited files and reusing the original
+compressed bytes of untouched ones, and ``build_cpac`` assembles
+subarchives into a CPAC file.
+"""
+import json
+import logging
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .common import content_hash
+from .compression import stock_decompress
+from .encoders import method_for_header, stock_compress
+from .subarchive import SubArchive
+
+log = logging.getLogger(__name__)
+
+LAYOUT_FILE = "layout.json"
+LAYOUT_VERSION = 1
+# Alignment of subfiles within a subarchive and of subarchives within
+# the CPAC file
+SUBFILE_ALIGNMENT = 4
+SUBARCHIVE_ALIGNMENT = 16
+
+
+@dataclass
+class RepackEntry:
+    # Data as it is stored, i.e. already compressed if ``compressed``
+    data: bytes
+    compressed: bool = False
+    unknown_flag: bool = False
+
+
+def _pad(data: bytearray, alignment: int):
+    data += bytes(-len(data) % alignment)
+
+
+def build_subarchive(
+    entries: List[RepackEntry], yekp: bool = False, yekp_trailer: int = 3
+) -> bytes:
+    """
+    Build a subarchive with a YEKB (offset/size pairs) or YEKP (offsets
+    only) table followed by the TADB/TADP data section.
+
+    YEKP tables end with ``yekp_trailer`` entries pointing at the end of
+    the data, which readYEKP leaves unsized.
+    """
+    table = bytearray()
+    data = bytearray()
+    for entry in entries:
+        if len(data) >= 0x80000000 or len(entry.data) >= 0x80000000:
+            raise ValueError("Subarchive too large")
+        compressed = 0x80000000 if entry.compressed else 0
+        unknown = 0x80000000 if entry.unknown_flag else 0
+        if yekp:
+            table += struct.pack("<I", len(data) | compressed)
+        else:
+            table += struct.pack(
+                "<II", len(data) | unknown, len(entry.data) | compressed
+            )
+        data += entry.data
+        # YEKP sizes are derived from the following offset, so padding
+        # uncompressed files there would change their contents.
+        if entry.compressed or not yekp:
+            _pad(data, SUBFILE_ALIGNMENT)
+    if yekp:
+        table += struct.pack("<I", len(data)) * yekp_trailer
+
+    if yekp:
+        table_name, data_name = b"YEKP", b"TADP"
+    else:
+        table_name, data_name = b"YEKB", b"TADB"
+    table_offset = 8 + 2 * 8
+    if not yekp:
+        # Zero-sized YEKB entries are skipped on read; readYEKP would
+        # pick up padding as extra entries.
+        _pad(table, 16)
+    data_base_offset = table_offset + len(table)
+    total = data_base_offset + len(data)
+    header = struct.pack("<II", total, 2)
+    header += table_name + struct.pack("<I", table_offset)
+    header += data_name + struct.pack("<I", data_base_offset)
+    return header + bytes(table) + bytes(data)
+
+
+def build_cpac(subarchives: List[bytes]) -> bytes:
+    header = bytearray()
+    body = bytearray()
+    base = 8 * len(subarchives)
+    for subarchive in subarchives:
+        header += struct.pack("<II", base + len(body), len(subarchive))
+        body += subarchive
+        _pad(body, SUBARCHIVE_ALIGNMENT)
+    return bytes(header + body)
+
+
+def unpack_subarchive(
+    subarchive: SubArchive, subarchive_index: int, directory: Path
+):
+    """
+    Write every subfile of ``subarchive`` decompressed into ``directory``,
+    with a layout.json that pack_directory reads back.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    yekp = subarchive.table_type == b"YEKP"
+    subfiles = []
+    trailer = 0
+    for i, entry in enumerate(subarchive.subfiles):
+        if yekp and entry.size is None:
+            trailer += 1
+            continue
+        raw = subarchive.open(i, skip_decompression=True)
+        method = None
+        data = raw
+        if entry.compressed:
+            method = method_for_header(raw[0])
+            data = stock_decompress(raw)
+        name = f"{i}.bin"
+        (directory / name).write_bytes(data)
+        subfiles.append(
+            {
+                "file": name,
+                "compressed": entry.compressed,
+                "unknown_flag": entry.unknown_flag,
+                "method": method,
+                "hash": content_hash(data),
+            }
+        )
+    layout = {
+        "version": LAYOUT_VERSION,
+        "subarchive": subarchive_index,
+        "table": "YEKP" if yekp else "YEKB",
+        "yekp_trailer": trailer,
+        "subfiles": subfiles,
+    }
+    with (directory / LAYOUT_FILE).open("w") as f:
+        json.dump(layout, f, indent=2)
+
+
+def _compress(data: bytes, method: str, directory: Path) -> bytes:
+    try:
+        return stock_compress(data, method)
+    except ValueError as e:
+        # Only the Huffman encoder refuses input (trees too wide for its
+        # 6-bit child offsets); LZ77 always works.
+        log.warning("  %s: %s, falling back to LZ77.", directory, e)
+        return stock_compress(data, "lz77")
+
+
+def pack_directory(
+    directory: Path,
+    original: Optional[SubArchive] = None,
+    method: str = "lz77",
+) -> bytes:
+    """
+    Build a subarchive from a directory written by unpack_subarchive.
+
+    Files whose contents still match the hash in layout.json reuse the
+    compressed bytes from ``original`` if given. Others are compressed
+    with the method they originally used, or ``method`` if that isn't
+    known.
+    """
+    with (directory / LAYOUT_FILE).open() as f:
+        layout = json.load(f)
+    if layout.get("version") != LAYOUT_VERSION:
+        raise ValueError(f"Unsupported layout version in {directory}")
+    entries = []
+    reused = 0
+    for i, subfile in enumerate(layout["subfiles"]):
+        data = (directory / subfile["file"]).read_bytes()
+        if not subfile["compressed"]:
+            entries.append(RepackEntry(data, False, subfile["unknown_flag"]))
+            continue
+        if original is not None and content_hash(data) == subfile["hash"]:
+            stored = bytes(original.open(i, skip_decompression=True))
+            reused += 1
+        else:
+            stored = _compress(data, subfile["method"] or method, directory)
+        entries.append(RepackEntry(stored, True, subfile["unknown_flag"]))
+    log.info(
+        "  Packed %d subfiles from %s (%d reused unchanged).",
+        len(entries), directory, reused,
+    )
+    return build_subarchive(
+        entries, layout["table"] == "YEKP", layout["yekp_trailer"]
+    )
+
+
+def repack_cpac(cpac, replacements: Dict[int, bytes], output: Path):
+    """
+    Write a copy of ``cpac`` to ``output`` with the subarchives in
+    ``replacements`` swapped out.
+    """
+    subarchives = [
+        replacements[i] if i in replacements else bytes(cpac.open(i))
+        for i in range(len(cpac.subarchives))
+    ]
+    output.write_bytes(build_cpac(subarchives))
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Structured failure reports for batch runs.
+
+Each failure records where it happened (subarchive, subfile, and the
+absolute byte offset and size of the data in the CPAC file), the stage
+that failed and the exception. Reports are saved as JSON, and a later
+run can retry just the subfiles a report lists.
+"""
+import json
+import logging
+import os
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+log = logging.getLogger(__name__)
+
+REPORT_VERSION = 1
+
+Failure = namedtuple(
+    "Failure",
+    ("subarchive", "subfile", "stage", "error", "offset", "size"),
+)
+
+
+def describe_error(error) -> str:
+    if isinstance(error, BaseException):
+        return f"{type(error).__name__}: {error}"
+    return str(error)
+
+
+class FailureReport:
+    def __init__(self, failures=None):
+        self.failures = list(failures or [])
+
+    def __len__(self):
+        return len(self.failures)
+
+    def __iter__(self):
+        return iter(sorted(
+            self.failures, key=lambda f: (f.subarchive, f.subfile or -1)
+        ))
+
+    def add(
+        self,
+        subarchive: int,
+        subfile: Optional[int],
+        stage: str,
+        error,
+        offset: int = None,
+        size: int = None,
+    ):
+        failure = Failure(
+            subarchive, subfile, stage, describe_error(error), offset, size
+        )
+        log.debug("Failure: %s", failure)
+        self.failures.append(failure)
+
+    def selection(self) -> Dict[int, Optional[Set[int]]]:
+        """
+        Map each subarchive with failures to the subfiles to retry, or to
+        None if the whole subarchive failed.
+        """
+        out = {}
+        for failure in self.failures:
+            if failure.subfile is None:
+                out[failure.subarchive] = None
+            elif out.get(failure.subarchive, set()) is not None:
+                out.setdefault(failure.subarchive, set()).add(
+                    failure.subfile
+                )
+        return out
+
+    def save(self, path: Path):
+        data = {
+            "version": REPORT_VERSION,
+            "failures": [failure._asdict() for failure in self],
+        }
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "FailureReport":
+        with path.open("r") as f:
+            data = json.load(f)
+        if data.get("version") != REPORT_VERSION:
+            raise ValueError(f"Unsupported report version in {path}")
+        return cls(Failure(**failure) for failure in data["failures"])
+
+
+def wanted(selection, subarchive: int, subfile: int = None) -> bool:
+    """
+    Check a subarchive, or one of its subfiles, against a retry
+    selection; a None selection means everything.
+    """
+    if selection is None:
+        return True
+    if subarchive not in selection:
+        return False
+    subfiles = selection[subarchive]
+    return subfile is None or subfiles is None or subfile in subfiles
@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Local HTTP server over an Archive.
+
+    GET /                     JSON list of subarchives
+    GET /<sa>/                JSON list of the subarchive's subfiles
+    GET /<sa>/<sf>.bin        decompressed subfile
+    GET /<sa>/<sf>.raw        subfile as stored
+    GET /<sa>/<sf>.png        rendered image, ?mode=ios for iOS tiles
+
+ETags are derived from the hash of the stored subfile bytes, so clients
+can revalidate with If-None-Match and get a 304 without anything being
+decompressed or rendered.
+"""
+import json
+import logging
+import re
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+from . import stats
+from .archive import Archive
+from .common import read_error
+
+log = logging.getLogger(__name__)
+
+SUBFILE_PATH = re.compile(r"^/(\d+)/(\d+)\.(bin|raw|png)$")
+SUBARCHIVE_PATH = re.compile(r"^/(\d+)/?$")
+CONTENT_TYPES = {
+    "bin": "application/octet-stream",
+    "raw": "application/octet-stream",
+    "png": "image/png",
+}
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Check whether an If-None-Match header lists ``etag``, comparing
+    weakly as RFC 7232 specifies for it.
+    """
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", etag):
+            return True
+    return False
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    archive: Archive = None
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+    def send_body(self, body: bytes, content_type: str, etag: str = None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data).encode(), "application/json")
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if stats.enabled:
+            stats.count("server.requests")
+        url = urlsplit(self.path)
+        try:
+            if url.path == "/":
+                self.send_json(
+                    [
+                        {"offset": offset, "size": size}
+                        for offset, size in self.archive.cpac.subarchives
+                    ]
+                )
+                return
+            match = SUBARCHIVE_PATH.match(url.path)
+            if match:
+                self.send_subarchive(int(match.group(1)))
+                return
+            match = SUBFILE_PATH.match(url.path)
+            if match:
+                mode = parse_qs(url.query).get("mode", ["nds"])[0]
+                self.send_subfile(
+                    int(match.group(1)), int(match.group(2)),
+                    match.group(3), mode,
+                )
+                return
+            self.send_error(404)
+        except IndexError:
+            self.send_error(404)
+        except (ValueError, read_error) as e:
+            # Corrupt tables and compressed data
+            self.send_error(422, str(e))
+
+    def send_subarchive(self, i: int):
+        subarchive = self.archive.subarchive(i)
+        self.send_json(
+            [
+                {
+                    "offset": sf.offset,
+                    "size": sf.size,
+                    "compressed": sf.compressed,
+                    "unknown_flag": sf.unknown_flag,
+                }
+                for sf in subarchive.subfiles
+            ]
+        )
+
+    def send_subfile(self, sa: int, sf: int, kind: str, mode: str):
+        if kind == "png" and mode not in ("nds", "ios"):
+            self.send_error(400, "mode must be nds or ios")
+            return
+        etag = f'"{self.archive.content_hash(sa, sf)}-{kind}'
+        etag += f'-{mode}"' if kind == "png" else '"'
+        if etag_matches(self.headers.get("If-None-Match", ""), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        if kind == "png":
+            body = self.archive.png(sa, sf, mode)
+            if body is None:
+                self.send_error(404, "Subfile is not an image")
+                return
+        else:
+            body = self.archive.read(sa, sf, decompress=kind == "bin")
+        self.send_body(body, CONTENT_TYPES[kind], etag)
+
+
+class ArchiveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(archive: Archive, host: str, port: int) -> ArchiveServer:
+    handler = type(
+        "BoundArchiveRequestHandler",
+        (ArchiveRequestHandler,),
+        {"archive": archive},
+    )
+    return ArchiveServer((host, port), handler)
@@ -1,28 +1,88 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Split archives: a table of (offset, size) pairs running up to the first
+entry, followed by the entries, each starting with a compression header.
+
+The table is read in one go, like the CPAC header. Entries are only read
+and decompressed when opened, so nested split archives can be walked
+without decoding their siblings.
+"""
+import logging
 from collections import namedtuple
-from io import BytesIO
-from .common import read_type, read_error
+
+from . import stats
+from .common import BufferReader
 from .compression import stock_decompress
 
+log = logging.getLogger(__name__)
+
 Subfile = namedtuple("Subfile", ("offset", "size"))
 
 
 class SplitArchive:
-    def __init__(self, data: bytes):
-        self._data = BytesIO(data)
+    def __init__(self, data, cache=None):
+        self._data = BufferReader(data)
         self.entries = []
+        # Optional DecompressionCache
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.entries)
 
     def parse(self):
-        self.entries = []
-        while True:
-            try:
-                (offset, length,) = read_type(self._data, "II")
-                self.entries.append(Subfile(offset, length))
-            except read_error:
-                break
-
-    def open(self, id_: int) -> bytes:
+        # Deferred like SubArchive's tables, so that importing this
+        # module doesn't import NumPy.
+        from .entrytable import read_pointers
+
+        with stats.timer("splitarchive.parse"):
+            self._data.seek(0)
+            self.entries = read_pointers(
+                self._data, Subfile, len(self._data)
+            )
+        log.debug("  Found %d split archive entries.", len(self.entries))
+
+    def open(self, id_: int, skip_decompression=False):
         self._data.seek(self.entries[id_].offset)
-        return stock_decompress(self._data.read(self.entries[id_].size))
+        data = self._data.read(self.entries[id_].size)
+        if skip_decompression:
+            return data
+        if self.cache is not None:
+            return self.cache.decompress(data)
+        return stock_decompress(data)
+
+    def open_split(self, id_: int) -> "SplitArchive":
+        """
+        Parse entry ``id_`` as a nested split archive.
+        """
+        split = SplitArchive(self.open(id_), cache=self.cache)
+        split.parse()
+        return split
+
+    def classify(self, id_: int, mode='nds'):
+        """
+        Classify entry ``id_`` from its headers alone; see
+        gtcpacdump.classify.
+        """
+        from .classify import TILE_SIZES, classify
+
+        return classify(
+            self.open(id_, skip_decompression=True), True,
+            TILE_SIZES[mode.lower()],
+        )
+
+    def load_image(self, id_: int, mode='nds'):
+        """
+        Parse entry ``id_`` as a TiledImage, or return None if it is
+        empty.
+        """
+        from .classify import TILE_SIZES
+        from .tiledimage import TiledImage
+
+        data = self.open(id_)
+        if not data:
+            return None
+        image = TiledImage(data, TILE_SIZES[mode.lower()])
+        image.parse()
+        return image
@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+Process-wide counters and per-stage timers.
+
+Collection is off by default. Call sites guard counters with
+``if stats.enabled:`` and ``timer`` hands out a shared no-op context
+manager while disabled, so instrumentation costs next to nothing unless
+a report was asked for.
+"""
+from collections import defaultdict
+from contextlib import nullcontext
+from time import perf_counter
+
+enabled = False
+counters = defaultdict(int)
+timers = defaultdict(float)
+timer_calls = defaultdict(int)
+
+_null_timer = nullcontext()
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        timers[self.name] += perf_counter() - self.start
+        timer_calls[self.name] += 1
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def count(name: str, n: int = 1):
+    counters[name] += n
+
+
+def timer(name: str):
+    if not enabled:
+        return _null_timer
+    return _Timer(name)
+
+
+def reset():
+    counters.clear()
+    timers.clear()
+    timer_calls.clear()
+
+
+def report() -> dict:
+    return {
+        "counters": dict(sorted(counters.items())),
+        "timers": {
+            name: {"seconds": timers[name], "calls": timer_calls[name]}
+            for name in sorted(timers)
+        },
+    }
+
+
+def take() -> dict:
+    """
+    Return the current report and reset, for shipping worker-side stats
+    back to the parent process.
+    """
+    out = report()
+    reset()
+    return out
+
+
+def merge(other: dict):
+    for name, n in other["counters"].items():
+        counters[name] += n
+    for name, timing in other["timers"].items():
+        timers[name] += timing["seconds"]
+        timer_calls[name] += timing["calls"]
+
+
+def format_report(rep: dict) -> str:
+    lines = ["Counters:"]
+    for name, n in rep["counters"].items():
+        lines.append(f"  {name:<24} {n}")
+    lines.append("Timers:")
+    for name, timing in rep["timers"].items():
+        lines.append(
+            f"  {name:<24} {timing['seconds']:10.3f}s "
+            f"({timing['calls']} calls)"
+        )
+    return "\n".join(lines)
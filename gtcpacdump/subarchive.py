@@ -1,13 +1,14 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import logging
 from dataclasses import dataclass
-from io import BytesIO
 
-from gtcpacdump.common import OKBLUE, OKGREEN, WARNING, ENDC
-from .common import read_type
+from . import stats
+from .common import read_type, BufferReader
 from .compression import stock_decompress
-from .tiledimage import TiledImage
+
+log = logging.getLogger(__name__)
 
 
 @dataclass
@@ -18,26 +19,38 @@ class SubfileEntry:
     unknown_flag: bool = False
 
 
-def read_section_table(stream: BytesIO,) -> dict:
+def read_section_table(stream: BufferReader,) -> dict:
     section_table = {}
 
     size, sections = read_type(stream, "II")
 
     for i in range(sections):
-        section_name = stream.read(4)
+        section_name = bytes(stream.read(4))
         section_table[section_name] = read_type(stream, "I")
 
     return section_table
 
 
 class SubArchive:
-    def __init__(self, data: bytes):
-        self._data = BytesIO(data)
+    def __init__(self, data, cache=None):
+        self._data = BufferReader(data)
         self.subfiles = []
         self.data_base_offset = 0
-
-    def dump_image(self, idx, mode='nds'):
-        image = self.open(idx)
+        # b"YEKB" or b"YEKP", set by parse()
+        self.table_type = None
+        # Optional DecompressionCache
+        self.cache = cache
+
+    def load_image(self, idx, mode='nds', data=None):
+        """
+        Parse subfile ``idx`` (or its already decompressed ``data``) as a
+        TiledImage, or return None if it is empty.
+        """
+        # Deferred so that listing and raw dumps don't pay for importing
+        # PIL and NumPy.
+        from .tiledimage import TiledImage
+
+        image = self.open(idx) if data is None else data
         if not image:
             return None
         if mode.lower() == 'nds':
@@ -48,109 +61,109 @@ class SubArchive:
             raise ValueError(f'Invalid mode: {mode}')
         image = TiledImage(image, tile_size)
         image.parse()
-        return image.dump(False)
+        return image
+
+    def location(self, idx):
+        """
+        Offset of subfile ``idx`` from the start of the subarchive, and
+        its stored size.
+        """
+        entry = self.subfiles[idx]
+        offset = self.data_base_offset + entry.offset
+        if entry.size is None:
+            # Unsized entries are read to the end of the subarchive.
+            return offset, len(self._data) - offset
+        return offset, entry.size
+
+    def classify(self, idx, mode='nds'):
+        """
+        Classify subfile ``idx`` from its headers alone; see
+        gtcpacdump.classify.
+        """
+        from .classify import TILE_SIZES, classify
+
+        self._data.seek(self.subfiles[idx].offset + self.data_base_offset)
+        data = self._data.read(self.subfiles[idx].size)
+        return classify(
+            data, self.subfiles[idx].compressed, TILE_SIZES[mode.lower()]
+        )
+
+    def dump_image(
+        self, idx, mode='nds', transparent=False, palette_offset=0,
+        palette=None, data=None,
+    ):
+        """
+        Render subfile ``idx`` as an RGBA image. ``palette`` replaces the
+        image's own (N, 4) RGBA palette, and ``palette_offset`` selects a
+        16-color bank of it. ``data`` is as for load_image.
+        """
+        image = self.load_image(idx, mode, data)
+        if image is None:
+            return None
+        return image.dump(transparent, palette_offset, palette)
 
     def readYEKB(self, start, data_base_offset):
-        print(
-            f"    {OKBLUE}Reading YEKB section{ENDC}...", end="",
-        )
-        self._data.seek(start)
-
-        subfiles = []
-        while True:
-            mixed1, mixed2 = read_type(self._data, "II")
-            compressed = bool(mixed2 & 0x80000000)
-            unknown_flag = bool(mixed1 & 0x80000000)
-            size = mixed2 & ~0x80000000
-            offset = mixed1 & ~0x80000000
-            if size != 0:
-                subfiles.append(
-                    SubfileEntry(
-                        offset=offset,
-                        size=size,
-                        compressed=compressed,
-                        unknown_flag=unknown_flag,
-                    )
-                )
-            if self._data.tell() >= data_base_offset:
-                break
-        print(
-            f"{OKGREEN}OK!\n    "
-            f"Found {WARNING}{len(subfiles)}{OKGREEN} subfiles.{ENDC}"
-        )
-        self.subfiles = subfiles
+        # Deferred like the image code, so that listing from the index
+        # doesn't import NumPy.
+        from .entrytable import read_yekb
+
+        log.debug("    Reading YEKB section...")
+        self.subfiles = read_yekb(self._data, start, data_base_offset)
+        log.info("    Found %d subfiles.", len(self.subfiles))
 
     def readYEKP(self, start, data_base_offset):
-        print(
-            f"    {OKBLUE}Reading YEKP section{ENDC}...", end="",
-        )
-        self._data.seek(start)
-
-        subfiles = []
-        while True:
-            mixed = read_type(self._data, "I")
-            compressed = bool(mixed & 0x80000000)
-            offset = mixed & ~0x80000000
-            subfiles.append(
-                SubfileEntry(offset=offset, compressed=compressed,)
-            )
-            if self._data.tell() >= data_base_offset:
-                break
-
-        stop = len(subfiles) - 3  # skip last
-        for i, subfile in enumerate(subfiles[:stop]):
-            subfile.size = subfiles[i + 1].offset - subfile.offset
-            if subfile.size + subfile.offset >= len(self._data.getvalue()):
-                raise ValueError("bork")
-
-        print(
-            f"{OKGREEN}OK!\n    "
-            f"Found {WARNING}{len(subfiles)}{OKGREEN} subfiles.{ENDC}"
+        from .entrytable import read_yekp
+
+        log.debug("    Reading YEKP section...")
+        self.subfiles = read_yekp(
+            self._data, start, data_base_offset, len(self._data)
         )
-        self.subfiles = subfiles
+        log.info("    Found %d subfiles.", len(self.subfiles))
 
     def parse(self):
-        print(f"  {OKBLUE}Parsing subarchive...{ENDC}")
+        log.info("  Parsing subarchive...")
+        with stats.timer("subarchive.parse"):
+            self._parse()
+
+    def _parse(self):
         section_table = read_section_table(self._data)
         if b"TADB" in section_table:
-            print(
-                f"  {OKGREEN}Found {ENDC}TADB{OKGREEN} "
-                f"data base section.{ENDC}"
-            )
+            log.debug("  Found TADB data base section.")
             self.data_base_offset = section_table[b"TADB"]
         elif b"TADP" in section_table:
-            print(
-                f"  {OKGREEN}Found {ENDC}TADP{OKGREEN} "
-                f"data base section.{ENDC}"
-            )
+            log.debug("  Found TADP data base section.")
             self.data_base_offset = section_table[b"TADP"]
         else:
             raise ValueError("File has no data base section")
 
         if b"YEKB" in section_table:
-            print(
-                f"  {OKGREEN}Found {ENDC}YEKB{OKGREEN} "
-                f"table base section.{ENDC}"
-            )
+            log.debug("  Found YEKB table base section.")
+            self.table_type = b"YEKB"
             self.readYEKB(
                 section_table[b"YEKB"], self.data_base_offset,
             )
         elif b"YEKP" in section_table:
-            print(
-                f"  {OKGREEN}Found {ENDC}YEKP{OKGREEN} "
-                f"table base section.{ENDC}"
-            )
+            log.debug("  Found YEKP table base section.")
+            self.table_type = b"YEKP"
             self.readYEKP(
                 section_table[b"YEKP"], self.data_base_offset,
             )
         else:
             raise ValueError("File has no table base section")
 
-    def open(self, id_: int, skip_decompression=False) -> bytes:
-        print(f"  {OKBLUE}Reading file {ENDC}{id_}{OKBLUE}.{ENDC}")
+    def open(self, id_: int, skip_decompression=False):
+        # Uncompressed (or skip_decompression) reads return a memoryview
+        # into the subarchive buffer rather than a copy.
+        log.debug("  Reading file %d.", id_)
         self._data.seek(self.subfiles[id_].offset + self.data_base_offset)
         out = self._data.read(self.subfiles[id_].size)
+        if stats.enabled:
+            stats.count("subfiles.read")
+            stats.count("subfiles.bytes_read", len(out))
         if self.subfiles[id_].compressed and not skip_decompression:
-            print(f"    {OKBLUE}Decompressing file {ENDC}{id_}{OKBLUE}.{ENDC}")
-            out = stock_decompress(out)
+            log.debug("    Decompressing file %d.", id_)
+            if self.cache is not None:
+                out = self.cache.decompress(out)
+            else:
+                out = stock_decompress(out)
         return out
@@ -1,29 +1,50 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
-from PIL import Image
-from io import BytesIO
-from .common import read_type
+import logging
+from typing import List, Tuple
 
-from gtcpacdump.common import OKBLUE, OKGREEN, ENDC
+import numpy as np
+from PIL import Image
+from . import stats
+from .common import read_type, BufferReader
 from .tileutils import (
-    read_rgb555_palette,
-    read_tile,
-    dump_tile,
+    TRANSPARENT_RGBA,
+    read_rgb555_palette_lut,
+    read_tiles,
+    arrange_tiles,
+    dedup_tiles,
+    render_indices,
 )
 
+log = logging.getLogger(__name__)
+
 
 class TiledImage:
-    def __init__(self, data: bytes, tile_size=(8,8)):
-        self._data = BytesIO(data)
+    def __init__(self, data, tile_size=(8,8)):
+        self._data = BufferReader(data)
         self.width = 0
         self.height = 0
         self.tile_size = tile_size
-        self.tiles = []
+        self.bpp = 8
+        # (tile_count, tile height, tile width) array of palette indices
+        self.tiles = None
+        # (N, 4) RGBA lookup table
         self.palette = None
+        # arrange_tiles() output, kept so rendering against several
+        # palettes only costs a LUT lookup each
+        self._arranged = None
+        # unique_tiles() output
+        self._unique = None
 
     def parse(self):
-        print(f"  {OKBLUE}Loading image.{ENDC}")
+        log.debug("  Loading image.")
+        with stats.timer("image.parse"):
+            self._parse()
+
+    def _parse(self):
+        self._arranged = None
+        self._unique = None
         self._data.seek(0)
         self.width, flags = read_type(self._data, "HH")
         self.height = flags & ~0x00008000
@@ -39,52 +60,201 @@ class TiledImage:
                 "The height has to be evenly divideable " "by the tile height!"
             )
         bpp = 4 if nibbles else 8
+        self.bpp = bpp
+        # 4bpp images carry a single 16-color bank, right ahead of the
+        # tiles; other banks can only come from a borrowed palette.
         self._data.seek(512)
-        self.palette = read_rgb555_palette(self._data, bpp)
+        self.palette = read_rgb555_palette_lut(self._data, bpp)
 
         tile_count = (self.width // self.tile_size[0]) * (self.height // self.tile_size[1])
-        self.tiles = []
-        for i in range(tile_count):
-            self.tiles.append(read_tile(bpp, self._data, self.tile_size))
-        print(
-            f"  {OKGREEN}Loaded {ENDC}{tile_count}{OKGREEN}-tile, "
-            f"{ENDC}{self.width}x{self.height}{OKGREEN}px image.{ENDC}"
+        self.tiles = read_tiles(bpp, self._data, tile_count, self.tile_size)
+        if stats.enabled:
+            stats.count("image.tiles_decoded", tile_count)
+        log.debug(
+            "  Loaded %d-tile, %dx%dpx image.",
+            tile_count, self.width, self.height,
         )
 
-    def dump(self, transparent: bool) -> Image:
-        print(f"  {OKBLUE}Dumping image.{ENDC}")
-        image = Image.new("RGBA", (self.width, self.height),)
-        xtiles = self.width // self.tile_size[0]
-        ytiles = self.height // self.tile_size[1]
-
-        bigtileheight = 2
-        bigtilewidth = 2
-        bigtilearea = bigtilewidth * bigtileheight
-        bigxtiles = xtiles // bigtilewidth
-        bigytiles = ytiles // bigtileheight
-
-        for bigypos in range(bigytiles):
-            for bigxpos in range(bigxtiles):
-                for smallypos in range(bigtileheight):
-                    totalypos = (bigypos * bigtileheight) + smallypos
-                    dest_y = totalypos * self.tile_size[1]
-                    for smallxpos in range(bigtilewidth):
-                        totalxpos = (bigxpos * bigtilewidth) + smallxpos
-                        dest_x = totalxpos * self.tile_size[0]
-
-                        tile_index = (
-                            bigtilearea * (bigxpos + (bigypos * bigxtiles))
-                        ) + (smallxpos + (smallypos * bigtilewidth))
-                        tile = dump_tile(
-                            self.tiles[tile_index],
-                            self.palette,
-                            0,
-                            transparent,
-                            self.tile_size
-                        )
-                        image.paste(
-                            tile, (dest_x, dest_y,),
-                        )
-
-        print(f"  {OKGREEN}Done.{ENDC}")
+    @property
+    def palette_banks(self) -> int:
+        """
+        Number of 16-color banks in the image's own palette.
+        """
+        return len(self.palette) // 16
+
+    def arranged(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._arranged is None:
+            self._arranged = arrange_tiles(
+                self.tiles, self.width, self.height
+            )
+        return self._arranged
+
+    def unique_tiles(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Deduplicate the tiles shown in the image, flipped copies included.
+
+        Returns the unique tiles, and (rows, columns) arrays of the unique
+        tile index and flips (see dedup_tiles) at each tile position, -1
+        and 0 where arrange_tiles leaves the position out.
+        """
+        if self._unique is None:
+            with stats.timer("image.dedup_tiles"):
+                self._unique = self._dedup_tiles()
+            if stats.enabled:
+                stats.count("image.unique_tiles", len(self._unique[0]))
+        return self._unique
+
+    def _dedup_tiles(self):
+        tile_w, tile_h = self.tile_size
+        columns = self.width // tile_w
+        rows = self.height // tile_h
+        # Lay out tile numbers like pixels to find the tile shown at
+        # each position.
+        numbers = np.arange(len(self.tiles)).reshape(-1, 1, 1)
+        positions, shown = arrange_tiles(numbers, columns, rows)
+        unique, index, flips = dedup_tiles(self.tiles[positions[shown]])
+        tilemap = np.full((rows, columns), -1, dtype="intp")
+        tilemap[shown] = index
+        flipmap = np.zeros((rows, columns), dtype="uint8")
+        flipmap[shown] = flips
+        return unique, tilemap, flipmap
+
+    def _sheet_columns(self, columns: int) -> int:
+        return max(1, min(columns, len(self.unique_tiles()[0])))
+
+    def tile_sheet(self, columns: int = 32) -> "TiledImage":
+        """
+        The unique tiles laid out ``columns`` to a row, as an image that
+        renders like this one.
+        """
+        unique = self.unique_tiles()[0]
+        columns = self._sheet_columns(columns)
+        rows = max(1, -(-len(unique) // columns))
+        tile_w, tile_h = self.tile_size
+        slots = np.zeros((rows * columns, tile_h, tile_w), unique.dtype)
+        slots[:len(unique)] = unique
+        filled = np.arange(rows * columns) < len(unique)
+        sheet = TiledImage(b"", self.tile_size)
+        sheet.width = columns * tile_w
+        sheet.height = rows * tile_h
+        sheet.bpp = self.bpp
+        sheet.tiles = unique
+        sheet.palette = self.palette
+        sheet._arranged = (
+            slots.reshape(rows, columns, tile_h, tile_w)
+            .transpose(0, 2, 1, 3)
+            .reshape(sheet.height, sheet.width),
+            filled.reshape(rows, columns)
+            .repeat(tile_h, axis=0)
+            .repeat(tile_w, axis=1),
+        )
+        return sheet
+
+    def tilemap(self, columns: int = 32) -> dict:
+        """
+        Describe the image as tile_sheet(columns) plus the sheet tile
+        (numbered row by row, -1 for none) and flips at each tile
+        position.
+        """
+        unique, tilemap, flipmap = self.unique_tiles()
+        return {
+            "width": self.width,
+            "height": self.height,
+            "tile_size": list(self.tile_size),
+            "tiles": len(unique),
+            "sheet_columns": self._sheet_columns(columns),
+            "map": tilemap.tolist(),
+            "flips": flipmap.tolist(),
+        }
+
+    def bank_lut(
+        self, palette: np.ndarray = None, palette_offset: int = 0
+    ) -> np.ndarray:
+        """
+        Slice of ``palette`` (by default the image's own) starting at
+        16-color bank ``palette_offset``.
+        """
+        if palette is None:
+            palette = self.palette
+        lut = palette[palette_offset * 16:]
+        needed = 16 if self.bpp == 4 else 256
+        if palette_offset < 0 or len(lut) < needed:
+            raise ValueError(
+                f"Palette bank {palette_offset} is out of range for a "
+                f"{len(palette)}-color palette"
+            )
+        return lut
+
+    def rgba(
+        self,
+        transparent: bool,
+        palette_offset: int = 0,
+        palette: np.ndarray = None,
+    ) -> np.ndarray:
+        """
+        Render the image as a (height, width, 4) RGBA array, optionally
+        against another (N, 4) RGBA ``palette`` and from 16-color bank
+        ``palette_offset``.
+        """
+        indices, mask = self.arranged()
+        lut = self.bank_lut(palette, palette_offset)
+        return render_indices(indices, lut, 0, transparent, mask)
+
+    def render_palettes(
+        self, palettes: List[np.ndarray], transparent: bool
+    ) -> List[np.ndarray]:
+        """
+        Render the same tiles against each of ``palettes``.
+        """
+        with stats.timer("image.dump"):
+            return [
+                self.rgba(transparent, palette=palette)
+                for palette in palettes
+            ]
+
+    def dump(
+        self,
+        transparent: bool,
+        palette_offset: int = 0,
+        palette: np.ndarray = None,
+    ) -> Image:
+        log.debug("  Dumping image.")
+        with stats.timer("image.dump"):
+            image = Image.fromarray(
+                self.rgba(transparent, palette_offset, palette)
+            )
+        return image
+
+    def dump_indexed(
+        self,
+        transparent: bool,
+        palette_offset: int = 0,
+        palette: np.ndarray = None,
+    ) -> Image:
+        """
+        Dump the image as a paletted ("P") image using the decoded
+        palette, without expanding it to RGBA.
+
+        Pixels left out by arrange_tiles get an extra fully transparent
+        palette entry. 8bpp palettes have no room for one, so images with
+        such pixels are dumped as RGBA instead.
+        """
+        log.debug("  Dumping indexed image.")
+        with stats.timer("image.dump"):
+            indices, mask = self.arranged()
+            needed = 16 if self.bpp == 4 else 256
+            lut = self.bank_lut(palette, palette_offset)[:needed]
+            if transparent:
+                lut = lut.copy()
+                lut[0] = TRANSPARENT_RGBA
+            if not mask.all():
+                if len(lut) >= 256:
+                    return self.dump(transparent, palette_offset, palette)
+                indices = np.where(mask, indices, len(lut)).astype("uint8")
+                lut = np.concatenate([lut, np.zeros((1, 4), lut.dtype)])
+            # putpalette turns the "L" image into a "P" one.
+            image = Image.fromarray(indices)
+            image.putpalette(lut[:, :3].tobytes())
+            if (lut[:, 3] != 255).any():
+                image.info["transparency"] = lut[:, 3].tobytes()
         return image
@@ -7,6 +7,7 @@
 from PIL import Image
 import numpy as np
 from io import BytesIO
+from typing import Tuple
 from .common import read_type
 
 
@@ -87,3 +88,150 @@ def dump_tile(
                 im_pixels[y, x] = to_rgba(color)
     image = Image.fromarray(im_pixels, "RGBA")
     return image
+
+
+# Vectorized pipeline. These operate on whole images at once and produce
+# the same pixels as read_tile/dump_tile above.
+
+TRANSPARENT_RGBA = (0, 255, 255, 0)
+
+
+def read_rgb555_palette_lut(data: BytesIO, bpp: int) -> np.ndarray:
+    """
+    Read an RGB555 palette as an (N, 4) uint8 RGBA lookup table.
+    """
+    palette_size = 16 if bpp == 4 else 256
+    raw = data.read(palette_size * 2)
+    if len(raw) != palette_size * 2:
+        raise ValueError("Palette data is truncated")
+    return rgb555_to_rgba(np.frombuffer(raw, dtype="<u2"))
+
+
+def rgb555_to_rgba(colors: np.ndarray) -> np.ndarray:
+    # Equivalent to to_rgba(from555(color)): to_rgba drops the low bits
+    # scale_up fills in, so each channel ends up as just c5 << 3.
+    lut = np.empty((len(colors), 4), dtype="uint8")
+    lut[:, 0] = (colors & 0x1F) << 3
+    lut[:, 1] = ((colors >> 5) & 0x1F) << 3
+    lut[:, 2] = ((colors >> 10) & 0x1F) << 3
+    lut[:, 3] = 255
+    return lut
+
+
+def read_tiles(
+    bpp: int, data: BytesIO, tile_count: int, tile_size=(8, 8)
+) -> np.ndarray:
+    """
+    Read ``tile_count`` tiles as a (tile_count, height, width) array of
+    palette indices.
+    """
+    pixel_count = tile_count * tile_size[0] * tile_size[1]
+    byte_count = pixel_count // 2 if bpp == 4 else pixel_count
+    raw = data.read(byte_count)
+    if len(raw) != byte_count:
+        raise ValueError("Tile data is truncated")
+    raw = np.frombuffer(raw, dtype="uint8")
+    if bpp == 4:
+        indices = np.empty(pixel_count, dtype="uint8")
+        indices[0::2] = raw & 0xF
+        indices[1::2] = raw >> 4
+    else:
+        indices = raw
+    return indices.reshape((tile_count, tile_size[1], tile_size[0]))
+
+
+def arrange_tiles(
+    tiles: np.ndarray, width: int, height: int, bigtile=(2, 2)
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lay out tiles stored in ``bigtile``-sized groups into a (height, width)
+    index array.
+
+    As in TiledImage.dump, tiles that don't fill a whole big tile at the
+    right or bottom edge are left out; the returned mask is False there.
+    """
+    tile_h, tile_w = tiles.shape[1:]
+    bigxtiles = width // tile_w // bigtile[0]
+    bigytiles = height // tile_h // bigtile[1]
+    used = bigxtiles * bigytiles * bigtile[0] * bigtile[1]
+    grid = (
+        tiles[:used]
+        .reshape(bigytiles, bigxtiles, bigtile[1], bigtile[0], tile_h, tile_w)
+        .transpose(0, 2, 4, 1, 3, 5)
+        .reshape(
+            bigytiles * bigtile[1] * tile_h, bigxtiles * bigtile[0] * tile_w
+        )
+    )
+    indices = np.zeros((height, width), dtype=tiles.dtype)
+    mask = np.zeros((height, width), dtype=bool)
+    indices[: grid.shape[0], : grid.shape[1]] = grid
+    mask[: grid.shape[0], : grid.shape[1]] = True
+    return indices, mask
+
+
+def render_indices(
+    indices: np.ndarray,
+    lut: np.ndarray,
+    palette_offset=0,
+    use_transparency=True,
+    mask: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Map an array of palette indices to RGBA through ``lut``.
+
+    Pixels outside ``mask`` are left fully transparent black.
+    """
+    pixels = lut[indices.astype("intp") + palette_offset * 16]
+    if use_transparency:
+        pixels[indices == 0] = TRANSPARENT_RGBA
+    if mask is not None:
+        pixels[~mask] = 0
+    return pixels
+
+
+def dedup_tiles(
+    tiles: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Deduplicate a (tile_count, height, width) array of tiles by content,
+    counting flipped copies as the same tile.
+
+    Returns the unique tiles in order of first appearance, and for each
+    input tile the index of its unique tile and the flips that turn the
+    one into the other (bit 0 horizontal, bit 1 vertical).
+    """
+    count = len(tiles)
+    if not count:
+        empty = np.zeros(0, dtype="intp")
+        return tiles, empty, empty.astype("uint8")
+    flat = np.ascontiguousarray(tiles).reshape(count, -1)
+    # Exact duplicates in one go, hashing each tile's bytes as a whole.
+    keys = flat.view(np.dtype((np.void, flat[0].nbytes))).reshape(count)
+    _, first, inverse = np.unique(
+        keys, return_index=True, return_inverse=True
+    )
+    inverse = inverse.reshape(count)
+    # Then flipped duplicates among the distinct tiles, which are few.
+    distinct_index = np.empty(len(first), dtype="intp")
+    distinct_flips = np.zeros(len(first), dtype="uint8")
+    seen = {}
+    unique = []
+    for d in np.argsort(first):
+        tile = tiles[first[d]]
+        variants = (
+            tile, tile[:, ::-1], tile[::-1, :], tile[::-1, ::-1]
+        )
+        for flips, variant in enumerate(variants):
+            match = seen.get(variant.tobytes())
+            if match is not None:
+                distinct_index[d] = match
+                distinct_flips[d] = flips
+                break
+        else:
+            distinct_index[d] = seen[tile.tobytes()] = len(unique)
+            unique.append(tile)
+    return (
+        np.stack(unique),
+        distinct_index[inverse],
+        distinct_flips[inverse],
+    )
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import random
+import struct
+
+import pytest
+
+from benchmarks.synthetic import lz77_compress, make_image
+from gtcpacdump.compression import stock_decompress
+from gtcpacdump.encoders import lz77_encode
+
+
+def lz77(tokens, decoded_length: int, longlengths: bool = False) -> bytes:
+    """
+    Assemble LZ77 data from literal bytes and (length, distance) tuples,
+    where distance is as stored (0 copies the previous byte).
+    """
+    out = bytearray(
+        struct.pack("<I", (0x11 if longlengths else 0x10)
+                    | (decoded_length << 8))
+    )
+    for start in range(0, len(tokens), 8):
+        flag_pos = len(out)
+        out.append(0)
+        for bit, token in enumerate(tokens[start:start + 8]):
+            if isinstance(token, int):
+                out.append(token)
+                continue
+            out[flag_pos] |= 0x80 >> bit
+            length, distance = token
+            if not longlengths:
+                out.append(((length - 3) << 4) | (distance >> 8))
+            elif length <= 0x10:
+                out.append(((length - 1) << 4) | (distance >> 8))
+            elif length <= 0x110:
+                out.append((length - 0x11) >> 4)
+                out.append((((length - 0x11) & 0xF) << 4) | (distance >> 8))
+            else:
+                out.append(0x10 | ((length - 0x111) >> 12))
+                out.append(((length - 0x111) >> 4) & 0xFF)
+                out.append((((length - 0x111) & 0xF) << 4) | (distance >> 8))
+            out.append(distance & 0xFF)
+    return bytes(out)
+
+
+def outcome(data: bytes, engine: str):
+    try:
+        return bytes(stock_decompress(data, engine))
+    except (ValueError, struct.error):
+        return "error"
+
+
+rng = random.Random(0)
+TILES = make_image(rng, 128, 64, 4, 8) + make_image(rng, 64, 64, 8, 16)
+TEXT = b"It's a trick, a ghost trick. " * 50
+SAMPLES = {
+    # Distance 0 and 1 copies overlap their own output.
+    "overlap 1": lz77([ord("a"), (18, 0), (18, 0)], 37),
+    "overlap 2": lz77([ord("a"), ord("b"), (17, 1), (5, 1)], 24),
+    "overlap 3": lz77([1, 2, 3, (18, 2), (18, 1)], 39),
+    # The last copy runs past the decoded length and is cut short.
+    "overlong copy": lz77([ord("x"), ord("y"), (18, 1)], 10),
+    "long 0x11": lz77([7, 8, (0x10, 1), (0x110, 0), (0x111, 1)], 0x233,
+                      True),
+    "long 0x10110": lz77([9, (0x10110, 0), (3, 5)], 0x10114, True),
+    "encoder tiles": lz77_encode(TILES),
+    "encoder tiles long": lz77_encode(TILES, True),
+    "encoder text long": lz77_encode(TEXT, True),
+    "encoder zeros long": lz77_encode(bytes(70000), True),
+    "greedy tiles": lz77_compress(TILES),
+    "greedy text long": lz77_compress(TEXT, True),
+    "random": lz77_encode(bytes(rng.randrange(256) for _ in range(3000))),
+    # Copies from before the start of the output
+    "seek past start": lz77([1, (3, 1)], 4),
+}
+
+
+@pytest.mark.parametrize("sample", sorted(SAMPLES))
+def test_fast_matches_stream(sample):
+    data = SAMPLES[sample]
+    assert outcome(data, "fast") == outcome(data, "stream")
+
+
+def test_expected_output():
+    assert outcome(SAMPLES["overlap 1"], "fast") == b"a" * 37
+    assert outcome(SAMPLES["overlap 2"], "fast") == b"ab" * 12
+    assert outcome(SAMPLES["overlong copy"], "fast") == b"xy" * 5
+    assert outcome(SAMPLES["long 0x10110"], "fast") == b"\t" * 0x10114
+    assert outcome(SAMPLES["encoder tiles"], "fast") == TILES
+    assert outcome(SAMPLES["seek past start"], "fast") == "error"
+
+
+@pytest.mark.parametrize(
+    "sample", ["overlap 2", "long 0x11", "encoder tiles long", "greedy tiles"]
+)
+def test_truncated(sample):
+    data = SAMPLES[sample]
+    cuts = sorted(set(range(4, len(data), max(1, len(data) // 200))))
+    for cut in cuts:
+        truncated = data[:cut]
+        assert outcome(truncated, "fast") == outcome(truncated, "stream")
+    assert outcome(data[:len(data) // 2], "fast") == "error"
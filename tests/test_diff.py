@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+from benchmarks.synthetic import make_cpac, make_subarchive
+from gtcpacdump.archive import Archive
+from gtcpacdump.diff import diff_archives
+from gtcpacdump.encoders import lz77_encode
+
+
+def diff(tmp_path, old, new):
+    (tmp_path / "old.bin").write_bytes(make_cpac(old))
+    (tmp_path / "new.bin").write_bytes(make_cpac(new))
+    with Archive(tmp_path / "old.bin") as old_archive, Archive(
+        tmp_path / "new.bin"
+    ) as new_archive:
+        return [
+            (change.status, change.subarchive, change.subfile)
+            for change in diff_archives(old_archive, new_archive)
+        ]
+
+
+def test_diff(tmp_path):
+    data = b"ghost trick " * 20
+    base = make_subarchive([(bytes(8), False), (data, False)])
+    old = [
+        base,
+        make_subarchive([(bytes(8), False), (lz77_encode(data), True)]),
+        base,
+    ]
+    new = [
+        # A subfile added
+        make_subarchive(
+            [(bytes(8), False), (data, False), (b"new", False)]
+        ),
+        # Same content, stored instead of compressed
+        base,
+        # Unparseable
+        base[:12],
+        # Only in the new file
+        base,
+    ]
+    assert diff(tmp_path, old, new) == [
+        ("added", 0, 2),
+        ("recompressed", 1, 1),
+        ("changed", 2, None),
+        ("added", 3, 0),
+        ("added", 3, 1),
+    ]
+    assert diff(tmp_path, old, old) == []
@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import os
+import random
+
+import pytest
+
+from benchmarks.synthetic import lz77_compress, make_image
+from gtcpacdump.compression import decompress_stream, stock_decompress
+from gtcpacdump.encoders import COMPRESSORS, METHOD_HEADERS, stock_compress
+
+
+def decompress(data: bytes, engine: str) -> bytes:
+    if engine == "chunked":
+        chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        return b"".join(decompress_stream(chunks))
+    return bytes(stock_decompress(data, engine))
+
+
+def tile_images():
+    rng = random.Random(0)
+    return [
+        make_image(rng, width, height, bpp, 8)
+        for width, height in ((64, 64), (256, 192), (32, 128))
+        for bpp in (4, 8)
+    ]
+
+
+SAMPLES = {
+    "empty": b"",
+    "one byte": b"x",
+    "run": b"\0" * 5000,
+    "random": os.urandom(4096),
+    "text": b"the quick brown fox jumps over the lazy dog " * 100,
+    "two symbols": bytes(random.Random(1).choice(b"ab") for _ in range(999)),
+    "tiles 4bpp": tile_images()[0],
+    "tiles 8bpp": tile_images()[1],
+}
+
+
+@pytest.mark.parametrize("engine", ["fast", "stream", "chunked"])
+@pytest.mark.parametrize("method", sorted(COMPRESSORS))
+@pytest.mark.parametrize("sample", sorted(SAMPLES))
+def test_round_trip(sample, method, engine):
+    data = SAMPLES[sample]
+    compressed = stock_compress(data, method)
+    assert compressed[0] == METHOD_HEADERS[method]
+    assert decompress(compressed, engine) == data
+
+
+@pytest.mark.parametrize("method", ["huffman4", "huffman8"])
+@pytest.mark.parametrize("data", [b"abcabcab", b"aab", SAMPLES["text"]])
+def test_huffman_alignment(method, data):
+    compressed = stock_compress(data, method)
+    tree_end = 4 + (compressed[4] + 1) * 2
+    assert tree_end % 4 == 0
+    assert len(compressed) % 4 == 0
+    assert stock_decompress(compressed) == data
+
+
+def test_huffman8_wide_trees():
+    # Every byte value, evenly spread: the widest possible 8-bit tree.
+    data = bytes(range(256)) * 16 + os.urandom(4096)
+    assert stock_decompress(stock_compress(data, "huffman8")) == data
+
+
+def test_best_is_smallest():
+    data = SAMPLES["tiles 8bpp"]
+    best = stock_compress(data, "best")
+    assert len(best) == min(
+        len(stock_compress(data, method)) for method in COMPRESSORS
+    )
+    assert stock_decompress(best) == data
+
+
+def test_lz77_ratio_on_tiles():
+    # The synthetic compressor stands in for the game's own: greedy
+    # matching against the last occurrence of each prefix.
+    images = tile_images()
+    for longlengths in (False, True):
+        ratios = [
+            len(stock_compress(image, "lz77-long" if longlengths else "lz77"))
+            / len(lz77_compress(image, longlengths))
+            for image in images
+        ]
+        assert sum(ratios) / len(ratios) <= 1
+    ratios = [len(stock_compress(image, "best")) / len(image)
+              for image in images]
+    assert sum(ratios) / len(ratios) < 0.3
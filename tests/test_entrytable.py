@@ -0,0 +1,19 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import struct
+from io import BytesIO
+
+import pytest
+
+from gtcpacdump.entrytable import read_yekp
+
+
+@pytest.mark.parametrize("count", range(1, 7))
+def test_yekp_last_three_unsized(count):
+    offsets = [16 * n for n in range(count)]
+    table = struct.pack(f"<{count}I", *offsets)
+    subfiles = read_yekp(BytesIO(table), 0, len(table), 16 * count + 16)
+    sizes = [subfile.size for subfile in subfiles]
+    sized = max(count - 3, 0)
+    assert sizes == [16] * sized + [None] * (count - sized)
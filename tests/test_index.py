@@ -0,0 +1,25 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+from benchmarks.synthetic import make_cpac, make_subarchive
+from gtcpacdump.index import CPACIndex
+
+
+def test_broken_subarchives_are_recorded(tmp_path):
+    subarchive = make_subarchive([(bytes(8), False), (b"hello", False)])
+    path = tmp_path / "cpac_2d.bin"
+    # Cut off inside the header (struct.error) and inside the table
+    # (ValueError)
+    path.write_bytes(
+        make_cpac([subarchive, subarchive[:12], subarchive[:30]])
+    )
+    with CPACIndex.open(path, tmp_path / "index.json") as index:
+        good, header, table = index.subarchives
+        assert good.error is None
+        assert header.error is not None
+        assert table.error is not None
+        assert index.read_subfile(0, 1) == b"hello"
+    with CPACIndex.open(path, tmp_path / "index.json") as index:
+        assert [sa.error is None for sa in index.subarchives] == [
+            True, False, False,
+        ]
@@ -0,0 +1,33 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import tarfile
+import zipfile
+
+import pytest
+
+from gtcpacdump.output import BackgroundWriter, open_output
+
+
+def failing_chunks():
+    yield b"partial"
+    raise ValueError("bad data")
+
+
+@pytest.mark.parametrize("archive_format", [None, "zip", "tar"])
+def test_failed_write_leaves_nothing(tmp_path, archive_format):
+    output = open_output(tmp_path, "0", "files", archive_format)
+    with BackgroundWriter(output, keep_going=True) as writer:
+        writer.submit(1, "1.bin", failing_chunks)
+        writer.submit(2, "2.bin", [b"whole"])
+    assert [name for _, name, _ in writer.errors] == ["1.bin"]
+    assert [name for _, name, _ in writer.records] == ["2.bin"]
+    if archive_format is None:
+        names = [path.name for path in (tmp_path / "0").iterdir()]
+    elif archive_format == "zip":
+        with zipfile.ZipFile(output.path) as archive:
+            names = archive.namelist()
+    else:
+        with tarfile.open(output.path) as archive:
+            names = archive.getnames()
+    assert names == ["2.bin"]
@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import threading
+from http.client import HTTPConnection
+
+import pytest
+
+from benchmarks.synthetic import make_cpac, make_subarchive
+from gtcpacdump.archive import Archive
+from gtcpacdump.server import etag_matches, make_server
+
+
+@pytest.fixture
+def server(tmp_path):
+    subarchive = make_subarchive([(bytes(8), False), (b"hello", False)])
+    # The second subarchive is cut off inside its header.
+    path = tmp_path / "cpac_2d.bin"
+    path.write_bytes(make_cpac([subarchive, subarchive[:12]]))
+    with Archive(path) as archive:
+        server = make_server(archive, "127.0.0.1", 0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield HTTPConnection(*server.server_address)
+        server.shutdown()
+        server.server_close()
+
+
+def get(connection, path, headers=None):
+    connection.request("GET", path, headers=headers or {})
+    response = connection.getresponse()
+    return response, response.read()
+
+
+def test_corrupt_subarchive(server):
+    response, _ = get(server, "/1/1.raw")
+    assert response.status == 422
+    response, _ = get(server, "/1/")
+    assert response.status == 422
+
+
+def test_etag_revalidation(server):
+    response, body = get(server, "/0/1.raw")
+    assert response.status == 200
+    assert body == b"hello"
+    etag = response.getheader("ETag")
+    response, _ = get(server, "/0/1.raw", {"If-None-Match": etag})
+    assert response.status == 304
+    # A longer ETag containing this one doesn't match.
+    longer = etag[:-1] + 'x"'
+    response, _ = get(server, "/0/1.raw", {"If-None-Match": longer})
+    assert response.status == 200
+    response, _ = get(server, "/0/1.bin", {"If-None-Match": etag})
+    assert response.status == 200
+
+
+def test_etag_matches():
+    assert etag_matches('"a"', '"a"')
+    assert etag_matches('"b", W/"a"', '"a"')
+    assert etag_matches("*", '"a"')
+    assert not etag_matches('"ab"', '"a"')
+    assert not etag_matches('"a-raw"', '"a"')
+    assert not etag_matches("", '"a"')
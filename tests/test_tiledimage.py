@@ -0,0 +1,235 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import json
+import random
+import struct
+import subprocess
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmarks.synthetic import make_cpac, make_image, make_subarchive
+from gtcpacdump.common import read_type
+from gtcpacdump.tiledimage import TiledImage
+from gtcpacdump.tileutils import (
+    arrange_tiles,
+    dedup_tiles,
+    dump_tile,
+    read_rgb555_palette,
+    read_tile,
+    rgb555_to_rgba,
+)
+
+
+def make_4bpp(colors: int, width: int = 32, height: int = 16):
+    rng = random.Random(colors)
+    header = struct.pack("<HH", width, height | 0x8000).ljust(512, b"\0")
+    palette = [rng.randrange(0x8000) for _ in range(colors)]
+    tiles = bytes(rng.randrange(256) for _ in range(width * height // 2))
+    data = header + struct.pack(f"<{colors}H", *palette) + tiles
+    return data, rgb555_to_rgba(np.array(palette, dtype="<u2"))
+
+
+def expected_rgba(image: TiledImage, lut: np.ndarray) -> np.ndarray:
+    indices, mask = arrange_tiles(image.tiles, image.width, image.height)
+    pixels = lut[indices]
+    pixels[~mask] = 0
+    return pixels
+
+
+def test_trailing_bytes_ignored():
+    data, palette = make_4bpp(16)
+    image = TiledImage(data)
+    image.parse()
+    # Unsized YEKP entries run to the end of the subarchive.
+    padded = TiledImage(data + bytes(480))
+    padded.parse()
+    assert padded.palette_banks == 1
+    assert np.array_equal(padded.rgba(False), image.rgba(False))
+    assert np.array_equal(
+        image.rgba(False), expected_rgba(image, palette)
+    )
+
+
+def test_palette_bank_of_borrowed_palette():
+    data, _ = make_4bpp(16)
+    image = TiledImage(data)
+    image.parse()
+    assert image.palette_banks == 1
+    with pytest.raises(ValueError):
+        image.rgba(False, palette_offset=1)
+    _, borrowed = make_4bpp(256)
+    rendered = image.rgba(False, palette_offset=1, palette=borrowed)
+    assert np.array_equal(rendered, expected_rgba(image, borrowed[16:32]))
+    indexed = np.array(
+        image.dump_indexed(False, 1, borrowed).convert("RGBA")
+    )
+    assert np.array_equal(indexed, rendered)
+
+
+def test_single_bank_tiles_unchanged():
+    data = make_image(random.Random(0), 64, 32, 4, 8)
+    image = TiledImage(data)
+    image.parse()
+    assert image.palette_banks == 1
+    raw = np.frombuffer(data, dtype="uint8", offset=512 + 32)
+    assert np.array_equal(image.tiles.reshape(-1)[0::2], raw & 0xF)
+
+
+def reference_dump(data: bytes, tile_size) -> np.ndarray:
+    """
+    Render an image tile by tile with read_tile and dump_tile, laying
+    out 2x2 big tiles like TiledImage.dump did before it was vectorized.
+    """
+    stream = BytesIO(data)
+    width, flags = read_type(stream, "HH")
+    height = flags & ~0x8000
+    bpp = 4 if flags & 0x8000 else 8
+    stream.seek(512)
+    palette = read_rgb555_palette(stream, bpp)
+    xtiles = width // tile_size[0]
+    ytiles = height // tile_size[1]
+    tiles = [
+        read_tile(bpp, stream, tile_size) for _ in range(xtiles * ytiles)
+    ]
+    image = Image.new("RGBA", (width, height))
+    for bigy in range(ytiles // 2):
+        for bigx in range(xtiles // 2):
+            for small in range(4):
+                tile = tiles[4 * (bigx + bigy * (xtiles // 2)) + small]
+                image.paste(
+                    dump_tile(tile, palette, 0, False, tile_size),
+                    (
+                        (bigx * 2 + small % 2) * tile_size[0],
+                        (bigy * 2 + small // 2) * tile_size[1],
+                    ),
+                )
+    return np.array(image)
+
+
+@pytest.mark.parametrize("tile_size", [8, 16])
+@pytest.mark.parametrize("bpp", [4, 8])
+@pytest.mark.parametrize("width, height", [(64, 32), (48, 80), (80, 48)])
+def test_matches_per_tile_rendering(tile_size, bpp, width, height):
+    # 48 and 80 aren't whole big tiles of 16x16 tiles, so the edges are
+    # left out.
+    data = make_image(random.Random(bpp), width, height, bpp, tile_size)
+    image = TiledImage(data, (tile_size, tile_size))
+    image.parse()
+    expected = reference_dump(data, (tile_size, tile_size))
+    assert np.array_equal(np.array(image.dump(False)), expected)
+
+
+def make_8bpp(tiles: np.ndarray, width: int, height: int) -> bytes:
+    rng = random.Random(0)
+    header = struct.pack("<HH", width, height).ljust(512, b"\0")
+    palette = [rng.randrange(0x8000) for _ in range(256)]
+    return (
+        header + struct.pack("<256H", *palette)
+        + tiles.astype("uint8").tobytes()
+    )
+
+
+def flip(tile: np.ndarray, flips: int) -> np.ndarray:
+    if flips & 1:
+        tile = tile[:, ::-1]
+    if flips & 2:
+        tile = tile[::-1, :]
+    return tile
+
+
+def flipped_tiles():
+    rng = np.random.default_rng(0)
+    a, b, c = rng.integers(0, 256, (3, 8, 8))
+    return np.stack([
+        a, flip(a, 1), flip(a, 2), flip(a, 3),
+        b, b, flip(b, 2), c,
+    ])
+
+
+def test_dedup_flipped_tiles():
+    tiles = flipped_tiles()
+    unique, index, flips = dedup_tiles(tiles)
+    assert np.array_equal(dedup_tiles(tiles.astype("uint8"))[0], unique)
+    assert len(unique) == 3
+    assert index.tolist() == [0, 0, 0, 0, 1, 1, 1, 2]
+    assert flips.tolist() == [0, 1, 2, 3, 0, 0, 2, 0]
+    image = TiledImage(make_8bpp(tiles, 32, 16))
+    image.parse()
+    assert len(image.unique_tiles()[0]) == 3
+
+
+@pytest.mark.parametrize("tile_size", [8, 16])
+@pytest.mark.parametrize("width, height", [(64, 32), (48, 80), (80, 48)])
+def test_tilemap_rebuilds_image(tile_size, width, height):
+    data = make_image(random.Random(1), width, height, 4, tile_size)
+    image = TiledImage(data, (tile_size, tile_size))
+    image.parse()
+    unique, tilemap, flipmap = image.unique_tiles()
+    indices, mask = arrange_tiles(image.tiles, width, height)
+    for (row, column), number in np.ndenumerate(tilemap):
+        y, x = row * tile_size, column * tile_size
+        shown = mask[y, x]
+        assert (number >= 0) == shown
+        if shown:
+            tile = flip(unique[number], flipmap[row, column])
+            block = indices[y:y + tile_size, x:x + tile_size]
+            assert np.array_equal(tile, block)
+        else:
+            assert flipmap[row, column] == 0
+    # Only 16x16 tiles leave out partial big tiles at 48 and 80.
+    assert (-1 in tilemap) == (tile_size == 16 and width != 64)
+    described = image.tilemap(4)
+    assert described["map"] == tilemap.tolist()
+    assert described["tiles"] == len(unique)
+    assert described["sheet_columns"] == min(4, len(unique))
+
+
+def test_tile_sheet_dump():
+    tiles = flipped_tiles()
+    image = TiledImage(make_8bpp(tiles, 32, 16))
+    image.parse()
+    unique = image.unique_tiles()[0]
+    sheet = image.tile_sheet(2)
+    pixels = np.array(sheet.dump(False))
+    assert pixels.shape == (16, 16, 4)
+    lut = image.bank_lut()
+    for slot in range(4):
+        y, x = slot // 2 * 8, slot % 2 * 8
+        block = pixels[y:y + 8, x:x + 8]
+        if slot < len(unique):
+            assert np.array_equal(block, lut[unique[slot]])
+        else:
+            assert not block.any()
+
+
+def test_tilemap_command(tmp_path):
+    data = make_image(random.Random(2), 64, 32, 4, 8)
+    archive = tmp_path / "cpac_2d.bin"
+    archive.write_bytes(
+        make_cpac([make_subarchive([(bytes(8), False), (data, False)])])
+    )
+    script = Path(__file__).parent.parent / "ghosttrick.py"
+    subprocess.run(
+        [
+            sys.executable, str(script), "-i", str(archive), "--no-index",
+            "subarchive_images", "--tilemap", "0", str(tmp_path / "out"),
+        ],
+        check=True, capture_output=True,
+    )
+    out = tmp_path / "out" / "0"
+    assert sorted(path.name for path in out.iterdir()) == [
+        "1.tilemap.json", "1.tiles.png",
+    ]
+    image = TiledImage(data)
+    image.parse()
+    described = json.loads((out / "1.tilemap.json").read_text())
+    assert described == image.tilemap(32)
+    sheet = Image.open(out / "1.tiles.png")
+    expected = image.tile_sheet().dump(False)
+    assert np.array_equal(np.array(sheet), np.array(expected))